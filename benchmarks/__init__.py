@@ -0,0 +1,104 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import platform
+import subprocess
+import tracemalloc
+import types
+from time import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Like in the tests, the helper modules of the plugin are benchmarked
+# without OctoPrint by registering the package without running its __init__
+try:
+    import octoprint  # noqa: F401
+except ImportError:
+    package = types.ModuleType("octoprint_firmwareupdate")
+    package.__path__ = [os.path.join(ROOT, "octoprint_firmwareupdate")]
+    sys.modules["octoprint_firmwareupdate"] = package
+
+
+# Run function and return its result and the seconds it took
+def timed(function, *args, **kwargs):
+    started = time()
+    result = function(*args, **kwargs)
+    return result, time() - started
+
+
+# Run function and return its result and the peak of the memory Python
+# allocated meanwhile, in bytes. Tracing slows Python down a lot, so times
+# are measured in separate runs.
+def peak_memory(function, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+# Version of the tree being measured, so results of two versions can be
+# told apart
+def describe():
+    try:
+        with open(os.devnull, "w") as devnull:
+            revision = subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                stderr=devnull).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return dict(revision=revision, python=platform.python_version(),
+                machine=platform.machine(), time=time())
+
+
+# Write the results of benchmark name to path as JSON
+def save(path, name, results):
+    with open(path, "w") as f:
+        json.dump(dict(benchmark=name, version=describe(),
+                       results=results), f, indent=2, sort_keys=True)
+
+
+# Print every number of results next to the one in the results saved at
+# path, with the ratio between the two
+def compare(path, results):
+    with open(path) as f:
+        previous = json.load(f)
+    print("Compared to %s:" % (previous['version'].get('revision') or path))
+    for name, value, old in _pairs(previous['results'], results):
+        ratio = "%.2fx" % (value / float(old)) if old else "-"
+        print("  %-50s %12.4g %12.4g %8s" % (name, old, value, ratio))
+
+
+def _pairs(old, new, prefix=""):
+    for name in sorted(new):
+        key = prefix + str(name)
+        if isinstance(new[name], dict) and isinstance(old.get(name), dict):
+            for pair in _pairs(old[name], new[name], key + "."):
+                yield pair
+        elif (isinstance(new[name], (int, float)) and
+              isinstance(old.get(name), (int, float)) and
+              not isinstance(new[name], bool)):
+            yield key, new[name], old[name]
+
+
+# Command line options every benchmark takes
+def add_arguments(parser):
+    parser.add_argument("--output", help="write the results to this JSON "
+                        "file")
+    parser.add_argument("--compare", help="JSON results of an earlier run "
+                        "to compare with")
+
+
+# Save, compare and print results as asked by the command line options
+def report(options, name, results):
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if options.compare:
+        compare(options.compare, results)
+    if options.output:
+        save(options.output, name, results)
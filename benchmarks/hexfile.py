@@ -0,0 +1,50 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import argparse
+import tempfile
+
+from benchmarks import add_arguments, peak_memory, report, timed
+from octoprint_firmwareupdate.hexfile import FLASH_SIZE, parse_hex
+from tests.fakes import make_image, write_records
+
+# Image sizes and bytes per record of the synthetic files. One byte records
+# turn a full flash image into a file of about 3.4 MB.
+CASES = [(64 * 1024, 16), (FLASH_SIZE, 16), (FLASH_SIZE, 4),
+         (FLASH_SIZE, 1)]
+
+
+# Parse synthetic Intel HEX files of growing size and measure the time and
+# memory peak of each parse
+def run(repeat=3):
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for size, record_size in CASES:
+            path = write_records(os.path.join(directory, "firmware.hex"),
+                                 make_image(size), record_size)
+            times = [timed(parse_hex, path)[1] for _ in range(repeat)]
+            _, peak = peak_memory(parse_hex, path)
+            file_size = os.path.getsize(path)
+            results["%dk_%db_records" % (size // 1024, record_size)] = dict(
+                file_bytes=file_size, seconds=min(times),
+                mb_per_second=file_size / min(times) / 1e6,
+                peak_bytes=peak)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Intel HEX "
+                                     "parser on large synthetic files")
+    parser.add_argument("--repeat", type=int, default=3)
+    add_arguments(parser)
+    options = parser.parse_args()
+    report(options, "hexfile", run(options.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import argparse
+import tempfile
+from contextlib import contextmanager
+from time import time
+
+from benchmarks import add_arguments, peak_memory, report, timed
+from octoprint_firmwareupdate import flasher
+from octoprint_firmwareupdate.hexfile import FLASH_SIZE
+from octoprint_firmwareupdate.scheduler import UpdateRequest
+from tests.fakes import (DIRECTORY, NoResetSerial, make_image,
+                         write_firmware, write_records)
+from tests.fakes.board import FakeBoard
+from tests.fakes.plugin import call_route, create_plugin, wait_idle
+from tests.fakes.server import ReleaseServer
+
+# Benchmark of the whole update pipeline against the stand-ins of the
+# tests: the GitHub releases server, the fake avrdude and pty fake boards.
+# Like the plugin tests it needs OctoPrint installed.
+
+# Stages of the metrics records, in pipeline order
+STAGES = ("lookup", "download", "decode", "reset", "write", "verify",
+          "total")
+
+
+# Scratch HOME with the fake avrdude first on PATH. avrdude engine runs use
+# fake ports, so their reset pulse is skipped.
+@contextmanager
+def sandbox():
+    directory = tempfile.mkdtemp()
+    environment = dict(os.environ)
+    serial = flasher.Serial
+    os.environ["HOME"] = os.path.join(directory, "home")
+    os.mkdir(os.environ["HOME"])
+    os.environ["PATH"] = DIRECTORY + os.pathsep + os.environ["PATH"]
+    flasher.Serial = NoResetSerial
+    try:
+        yield directory
+    finally:
+        flasher.Serial = serial
+        os.environ.clear()
+        os.environ.update(environment)
+        shutil.rmtree(directory)
+
+
+# Fresh plugin with its own data folder, so nothing is cached yet
+def plugin_in(directory, devices, **settings):
+    data_folder = tempfile.mkdtemp(dir=directory)
+    return create_plugin(data_folder, devices, **settings)
+
+
+def close(plugin):
+    plugin._prefetcher.stop()
+    plugin._scheduler.clear()
+    plugin._cancel_update()
+    wait_idle(plugin)
+
+
+# Run a release update of every attached board and return the seconds it
+# took
+def update(plugin, ports=None):
+    started = time()
+    plugin._schedule(UpdateRequest(UpdateRequest.MANUAL, ports=ports))
+    wait_idle(plugin, timeout=600)
+    elapsed = time() - started
+    if plugin._update.state != "completed":
+        raise RuntimeError("Update ended in %s: %s" % (
+            plugin._update.state, plugin._last_error))
+    return elapsed
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    median = values[middle] if len(values) % 2 else (
+        values[middle - 1] + values[middle]) / 2
+    return dict(median=median, min=values[0], max=values[-1],
+                count=len(values))
+
+
+def read_stamps(path):
+    stamps = {}
+    with open(path) as f:
+        for line in f:
+            event, moment = line.split()
+            stamps[event] = float(moment)
+    return stamps
+
+
+# Seconds spent in each stage of full release updates, from the metrics the
+# plugin records
+def stage_latency(directory, options, server, image):
+    timings = dict((stage, []) for stage in STAGES)
+    for run in range(options.runs):
+        server.publish("v%d" % run, firmware_content(directory, image))
+        plugin = plugin_in(directory, ["/dev/ttyFAKE0"],
+                           release_url=server.release_url)
+        try:
+            update(plugin)
+            record = plugin._metrics.records[-1]
+        finally:
+            close(plugin)
+        for stage in STAGES:
+            if stage in record['timings']:
+                timings[stage].append(record['timings'][stage])
+    return dict((stage, summarize(values))
+                for stage, values in timings.items() if values)
+
+
+# Seconds between avrdude printing the outcome and the plugin reporting it,
+# while avrdude keeps running for a while after the last line like it does
+# when it closes a slow port
+def status_lag(directory, options, server, image):
+    results = {}
+    for mode, event, status in (("ok", "verified", "completed"),
+                                ("fail", "failed", "error")):
+        lags = []
+        for run in range(options.runs):
+            stamp = os.path.join(directory, "stamp")
+            if os.path.exists(stamp):
+                os.remove(stamp)
+            os.environ.update(FAKE_AVRDUDE_MODE=mode,
+                              FAKE_AVRDUDE_STAMP=stamp,
+                              FAKE_AVRDUDE_EXIT_DELAY="2")
+            server.publish("lag%d" % run,
+                           firmware_content(directory, image))
+            plugin = plugin_in(directory, ["/dev/ttyFAKE0"],
+                               release_url=server.release_url,
+                               flash_retries=0)
+            try:
+                plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+                wait_idle(plugin, timeout=600)
+                reported, _ = plugin._plugin_manager.statuses(status)[-1]
+                lags.append(reported - read_stamps(stamp)[event])
+            finally:
+                close(plugin)
+                for name in ("FAKE_AVRDUDE_MODE", "FAKE_AVRDUDE_STAMP",
+                             "FAKE_AVRDUDE_EXIT_DELAY"):
+                    del os.environ[name]
+        results[status] = summarize(lags)
+    return results
+
+
+# Memory peak and seconds of receiving an upload, which saves, hashes and
+# decodes it, for files of up to 3.6 MB holding a full flash image. Tracing
+# memory slows Python down, so the upload is timed in a run of its own.
+def upload_memory(directory, options, server, image):
+    image = make_image(FLASH_SIZE)
+    results = {}
+    for record_size in (16, 4, 1):
+        path = write_records(os.path.join(directory, "upload.hex"), image,
+                             record_size)
+        results["%db_records" % record_size] = dict(
+            file_bytes=os.path.getsize(path),
+            seconds=upload(directory, path, timed),
+            peak_bytes=upload(directory, path, peak_memory))
+    return results
+
+
+# Post the firmware file at path to the upload route of a fresh plugin,
+# the way OctoPrint passes on a file it has streamed to disk. Returns what
+# measure found out about the request; the update it starts is waited for.
+def upload(directory, path, measure):
+    import flask
+
+    plugin = plugin_in(directory, ["/dev/ttyFAKE0"])
+    try:
+        with flask.Flask(__name__).test_request_context(
+                method="POST", data={"file.path": path}):
+            response, value = measure(call_route, plugin, "upload_file")
+        if response.status_code != 200:
+            raise RuntimeError(response.get_data(as_text=True))
+        wait_idle(plugin, timeout=600)
+    finally:
+        close(plugin)
+    return value
+
+
+# Boards flashed per minute when flashing several pty boards one after
+# the other and all at once
+def throughput(directory, options, server, image):
+    results = {}
+    boards = [FakeBoard(page_delay=options.page_delay)
+              for _ in range(options.boards)]
+    try:
+        for concurrency in sorted(set([1, options.boards])):
+            server.publish("boards%d" % concurrency,
+                           firmware_content(directory, image))
+            plugin = plugin_in(directory, [board.port for board in boards],
+                               release_url=server.release_url,
+                               flash_engine="stk500v2",
+                               max_concurrent_flashes=concurrency)
+            try:
+                elapsed = update(plugin, "all")
+            finally:
+                close(plugin)
+            results["concurrency_%d" % concurrency] = dict(
+                seconds=elapsed,
+                boards_per_minute=len(boards) * 60 / elapsed)
+    finally:
+        for board in boards:
+            board.close()
+    return results
+
+
+def firmware_content(directory, image):
+    path = write_firmware(os.path.join(directory, "release.hex"), image)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+BENCHMARKS = dict(stages=stage_latency, status_lag=status_lag,
+                  upload_memory=upload_memory, throughput=throughput)
+
+
+def run(options):
+    results = dict(settings=dict(image_bytes=options.image_size,
+                                 write_time=options.write_time,
+                                 read_time=options.read_time,
+                                 boards=options.boards,
+                                 page_delay=options.page_delay))
+    with sandbox() as directory, ReleaseServer() as server:
+        os.environ["FAKE_AVRDUDE_WRITE_TIME"] = str(options.write_time)
+        os.environ["FAKE_AVRDUDE_READ_TIME"] = str(options.read_time)
+        server.rate = options.download_rate
+        image = make_image(options.image_size)
+        for name in options.only or sorted(BENCHMARKS):
+            results[name] = BENCHMARKS[name](directory, options, server,
+                                             image)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the update "
+                                     "pipeline against local stand-ins of "
+                                     "GitHub, avrdude and the boards")
+    parser.add_argument("--only", action="append",
+                        choices=sorted(BENCHMARKS),
+                        help="run only this benchmark, can be repeated")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="updates per stage and lag measurement")
+    parser.add_argument("--image-size", type=int, default=64 * 1024,
+                        help="bytes of the release firmware image")
+    parser.add_argument("--write-time", type=float, default=0.5,
+                        help="seconds the fake avrdude takes to write")
+    parser.add_argument("--read-time", type=float, default=0.3,
+                        help="seconds the fake avrdude takes to verify")
+    parser.add_argument("--download-rate", type=int, default=None,
+                        help="download speed of the releases server in "
+                        "bytes per second")
+    parser.add_argument("--boards", type=int, default=4,
+                        help="pty boards flashed for the throughput")
+    parser.add_argument("--page-delay", type=float, default=0.002,
+                        help="seconds a pty board takes per flash page")
+    add_arguments(parser)
+    options = parser.parse_args()
+    try:
+        import octoprint  # noqa: F401
+    except ImportError:
+        parser.error("OctoPrint has to be installed to run the plugin")
+    report(options, "pipeline", run(options))
+
+
+if __name__ == "__main__":
+    main()
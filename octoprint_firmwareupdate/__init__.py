@@ -2,22 +2,62 @@
 from __future__ import absolute_import
 
 import os
+import re
+import hmac
+import json
+import uuid
+import shutil
 import base64
-from subprocess import Popen
-import psutil
-from time import sleep
+import hashlib
+import tempfile
+from time import time
 import requests
-from threading import Thread
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+from threading import Thread, Lock, RLock
 from glob import glob
-from serial import Serial, SerialException
 import flask
 import octoprint.plugin
 from octoprint.events import eventManager, Events
 from octoprint.server.util.flask import restricted_access
 from octoprint.server import admin_permission, VERSION
 
+from .bootcheck import BootError, check_boot, image_firmware_name
+from .cache import FirmwareCache, release_key
+from .delta import DeltaError, apply_patch, make_patch
+from .downloader import (Downloader, DownloadError, DownloadStopped,
+                         asset_digest, asset_image_digest)
+from .fleet import (FINAL_STATUSES, Rollout, RolloutStore, parse_range,
+                    read_range)
+from .flasher import Flasher, AvrdudeFlasher
+from .hexfile import (FLASH_SIZE, PAGE_SIZE, FirmwareImage, HexError,
+                      parse_hex, read_hex, write_hex, diff_pages, page_count)
+from .joblog import JobLogStore
+from .jobs import FlashJob, FlashJobManager, UpdateJob
+from .metrics import FlashMetrics
+from .ports import PortIndex
+from .prefetch import ReleasePrefetcher
+from .releases import NoRelease, ReleaseClient
+from .scheduler import QueueFull, UpdateRequest, UpdateScheduler
+from .status import StatusFeed
+from .stk500v2 import Stk500v2Flasher
+from .uploads import (ChunkedUploads, UploadError, check_digest,
+                      copy_with_digest)
+
 Events.FIRMWARE_UPDATE = "FirmwareUpdate"
 
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Largest firmware file accepted, in one request or in chunks
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+
+# Errors that mean the release lookup or download couldn't be completed
+CONNECTION_ERRORS = (requests.exceptions.ConnectionError,
+                     requests.exceptions.HTTPError,
+                     requests.exceptions.Timeout)
+
 __author__ = "Kevin Murphy <kevin@voxel8.co>"
 __license__ = ("GNU Affero General Public License "
                "http://www.gnu.org/licenses/agpl.html")
@@ -26,12 +66,19 @@ __copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
 
 
 class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
+                           octoprint.plugin.EventHandlerPlugin,
                            octoprint.plugin.TemplatePlugin,
                            octoprint.plugin.AssetPlugin,
                            octoprint.plugin.SettingsPlugin,
                            octoprint.plugin.SimpleApiPlugin,
                            octoprint.plugin.BlueprintPlugin):
 
+    # Sparse hex written for differential flashes. It doesn't end in .hex so
+    # it is never picked up as a custom firmware file.
+    DIFF_FILE_NAME = "firmware.hex.diff"
+    # Patch of a delta update, kept while it is downloaded and applied
+    DELTA_FILE_NAME = "firmware.delta"
+
     def __init__(self):
         # State to keep track if an update is in progress
         self.isUpdating = False
@@ -41,27 +88,115 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
         self.local_file_name = None
         # Location of the version file
         self.version_file = os.path.expanduser('~/Marlin/.version')
-        # PID of the update process (avrdude) so we can kill if timeout
-        self.updatePID = None
-        # Update build log
-        self.build_log = None
-        # How long it took to complete the update
-        self.completion_time = 0
-        # Write time and read time variables to be added together
-        self.write_time = None
-        self.read_time = None
-        # 'Autodetected' port that avrdude will flash to
-        self.port = None
+        # Ports to flash: None to pick one, "all" or a list of device paths
+        # or board identifiers
+        self.target_ports = None
+        # Attached USB serial devices
+        self._ports = PortIndex()
         # Version to compare against latest Marlin release on GitHub
         self.version = None
-        # Update process Popen object
-        self.process = None
+        # Stage and cancellation of the running update, None before the
+        # first one
+        self._update = None
+        # Whether the printer was disconnected for the running update
+        self._printer_disconnected = False
+        # Per-port flash jobs of the running update
+        self._jobs = FlashJobManager()
+        self._record_lock = Lock()
         # Directories where firmware lives
         self.firmware_directory = os.path.expanduser(
             '~/Marlin/.build/mega2560/')
         self.src_directory = os.path.expanduser('~/Marlin/src')
         # Variable that defines if the update was started on startup
         self.updating_on_startup = False
+        # Content-addressed store of previously used firmware images
+        self._cache = None
+        # Client for the latest release metadata on GitHub
+        self._releases = None
+        # Partial files of resumable uploads
+        self._uploads = None
+        # Digest of the image being flashed
+        self.firmware_digest = None
+        # Seconds spent in each stage of the running update, when it started
+        # and whether its outcome has already been added to the metrics
+        self._metrics = None
+        self._timings = {}
+        self._update_started = None
+        self._metrics_recorded = True
+        # Download bytes a delta update saved for the running update
+        self._download_saved = 0
+        # Validated, parsed form of firmware_file
+        self.firmware_image = None
+        # Structured logs of past updates and the log of the running one
+        self._logs = None
+        self._job_log = None
+        # Background download of new releases
+        self._prefetcher = None
+        # Release rollout to the fleet, when acting as coordinator
+        self._rollouts = None
+        # Resumable downloads over one pooled session, shared with the
+        # release lookups
+        self._downloader = None
+        # Numbered status changes, and the last status and error sent
+        self._status = StatusFeed()
+        self._last_status = None
+        self._last_error = None
+        # Runs update requests one at a time; the request being carried out
+        self._scheduler = None
+        self._request = None
+        # Version of the release the running update installs, None for
+        # uploads and local files
+        self._release_version = None
+        # Held while an update is started or its outcome is distributed, so
+        # the next update can't start before the last one is wrapped up
+        self._update_lock = RLock()
+
+    def initialize(self):
+        self._cache = FirmwareCache(
+            os.path.join(self.get_plugin_data_folder(), "cache"),
+            self._settings.get_int(["cache_size"]) * 1024 * 1024,
+            logger=self._logger)
+        self._scheduler = UpdateScheduler(
+            self._execute_request,
+            max_queued=self._settings.get_int(["update_queue_size"]),
+            logger=self._logger)
+        self._downloader = Downloader(
+            chunk_size=self._settings.get_int(["download_chunk_size"]) * 1024,
+            retries=self._settings.get_int(["download_retries"]))
+        if self._settings.get(["fleet_mode"]) == "peer":
+            # Peers get their releases from the fleet coordinator, and send
+            # the fleet token along with every request to it
+            token = self._settings.get(["fleet_token"])
+            if token:
+                self._downloader.session.headers["X-Fleet-Token"] = token
+            self._releases = ReleaseClient(
+                os.path.join(self.get_plugin_data_folder(),
+                             "fleet_release.json"),
+                ttl=self._settings.get_int(["release_ttl"]),
+                url=self._fleet_url("release", peer=self._fleet_peer_id()),
+                session=self._downloader.session)
+        else:
+            self._releases = ReleaseClient(
+                os.path.join(self.get_plugin_data_folder(), "release.json"),
+                ttl=self._settings.get_int(["release_ttl"]),
+                session=self._downloader.session)
+        self._rollouts = RolloutStore(
+            os.path.join(self.get_plugin_data_folder(), "rollout.json"))
+        self._uploads = ChunkedUploads(
+            os.path.join(self.get_plugin_data_folder(), "uploads"))
+        self._metrics = FlashMetrics(
+            os.path.join(self.get_plugin_data_folder(), "metrics.json"))
+        self._logs = JobLogStore(
+            os.path.join(self.get_plugin_data_folder(), "logs"),
+            self._settings.get_int(["log_size"]) * 1024 * 1024)
+        self._prefetcher = ReleasePrefetcher(
+            self._releases, self._cache,
+            interval=self._settings.get_int(["prefetch_interval"]),
+            rate_limit=self._settings.get_int(["prefetch_rate_limit"]) * 1024,
+            on_ready=self._on_release_ready, logger=self._logger,
+            downloader=self._downloader,
+            # Prefetched releases are only installed by automatic updates
+            enabled=lambda: self._settings.get_boolean(["auto_update"]))
 
     # Allow other OctoPrint plugins to get firmware updating status
     def _is_updating(self):
@@ -70,9 +205,95 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
     # Set default plugin settings for OctoPrint
     def get_settings_defaults(self):
         return dict(
-            auto_update=True
+            auto_update=True,
+            # Maximum number of flash progress updates per second
+            progress_rate=5,
+            # Size limit of the firmware cache in MB
+            cache_size=16,
+            # Seconds the latest release metadata is reused without asking
+            # GitHub again
+            release_ttl=600,
+            # Only write the flash pages that changed since the last update
+            differential_flash=False,
+            # Flasher engine, either "avrdude" or the built-in "stk500v2"
+            flash_engine="avrdude",
+            # Baud rate of the bootloader and lower rates to step down to
+            # when the board can't be synchronized with
+            baudrate=250000,
+            baudrate_fallbacks=[115200, 57600],
+            # "full" reads the flash back after writing, "none" doesn't check
+            # the board after writing at all, "boot" skips the readback and
+            # waits for the firmware to start and report the name compiled
+            # into the image in answer to M115
+            verify_mode="full",
+            # Baud rate the firmware talks at, for the boot check
+            boot_baudrate=250000,
+            # Further attempts at flashing a board after a failed one
+            flash_retries=2,
+            # Number of boards flashed at the same time
+            max_concurrent_flashes=4,
+            # Seconds after which the flash of a single board is cancelled
+            flash_timeout=300,
+            # Update requests that may wait behind the running update
+            update_queue_size=4,
+            # Request timeout in seconds of the release check on startup
+            startup_check_timeout=5,
+            # Attempts of the release check on startup and seconds to wait
+            # before the first retry, doubled after every failed attempt
+            startup_check_attempts=3,
+            startup_check_backoff=10,
+            # Seconds all attempts together may take before the cached
+            # release is used instead; 0 for no limit
+            startup_check_deadline=20,
+            # Size limit of the stored update logs in MB
+            log_size=2,
+            # Seconds between background checks for new releases, which are
+            # downloaded ahead of the update; 0 disables them
+            prefetch_interval=3600,
+            # Download rate limit of the background checks in KB/s, 0 for
+            # no limit
+            prefetch_rate_limit=64,
+            # Install a downloaded release as soon as a print has ended
+            install_when_idle=True,
+            # Size in KiB of the blocks downloads are read in and how often
+            # an interrupted download is resumed before giving up. Cancelling
+            # waits for the block being read, keep it small on slow links.
+            download_chunk_size=16,
+            download_retries=3,
+            # Build new releases from the previous one and a binary patch
+            # when the release or the fleet coordinator offers one
+            delta_updates=True,
+            # Fleet rollouts: "coordinator" mirrors releases to the peers of
+            # the fleet in waves, "peer" gets releases from the coordinator
+            # at fleet_coordinator instead of GitHub, "" for neither
+            fleet_mode="",
+            fleet_coordinator="",
+            # Shared secret of the fleet, sent with every peer request. A
+            # coordinator refuses peers until one is set.
+            fleet_token="",
+            # Identifier of this instance in the fleet, generated when empty
+            fleet_peer_id="",
+            # Peers that get a release first, the percentages of peers that
+            # get it in the following waves and the number of failures that
+            # halt a rollout
+            fleet_canary=1,
+            fleet_waves=[10, 50, 100],
+            fleet_max_failures=1,
+            # Seconds each stage of an update may take before it is aborted
+            stage_timeouts=dict(lookup=30, download=120, reset=30,
+                                program=240, verify=240, boot=30)
         )
 
+    def get_settings_version(self):
+        return 1
+
+    def on_settings_migrate(self, target, current):
+        # Version 1 renamed the "digest" verify mode, which never checked
+        # the board, to "none"
+        if ((current is None or current < 1) and
+                self._settings.get(["verify_mode"]) == "digest"):
+            self._settings.set(["verify_mode"], "none")
+
     def get_assets(self):
         return {
             "js": ["js/firmwareupdate.js",
@@ -84,12 +305,35 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
     def get_api_commands(self):
         return dict(
             update_firmware=[],
-            toggle_auto_update=[]
+            cancel_update=[],
+            toggle_auto_update=[],
+            start_rollout=[],
+            halt_rollout=[]
         )
 
     def on_api_command(self, command, data):
         if command == "update_firmware":
-            self._start_update()
+            # Optional list of ports to flash, or "all"
+            ports = data.get("ports")
+            error = self._check_ports(ports)
+            if error is not None:
+                return flask.make_response(error, 400)
+            request = self._schedule(UpdateRequest(UpdateRequest.MANUAL,
+                                                   ports=ports))
+            if request is None:
+                return flask.make_response("Too many updates are waiting",
+                                           409)
+            return flask.jsonify(job=request.id, state=request.state)
+        elif command == "cancel_update":
+            # Updates waiting behind the running one are dropped as well
+            for request in self._scheduler.clear():
+                if request.path is not None:
+                    self._remove_file(request.path)
+            self._cancel_update()
+        elif command == "start_rollout":
+            return self._start_rollout()
+        elif command == "halt_rollout":
+            self._rollouts.halt()
         elif command == "toggle_auto_update":
             if data['current']:
                 auto_update = False
@@ -101,124 +345,723 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
         else:
             self._logger.info("Unknown command: " + command)
 
+    # Peers of a fleet reach the fleet routes with the fleet token instead of
+    # a login; every other route checks access itself
+    def is_blueprint_protected(self):
+        return False
+
     def on_api_get(self, request):
-        return flask.jsonify(isUpdating=self.isUpdating)
+        status = self._status_snapshot()
+        status['devices'] = [port.as_dict() for port in self._ports.ports()]
+        return flask.jsonify(**status)
 
     def on_after_startup(self):
         if self._settings.get_boolean(["auto_update"]):
-            self._start_update(True)
+            self._schedule(UpdateRequest(UpdateRequest.AUTO, onstartup=True))
         else:
             self._logger.info("Auto firmware update disabled, skipping...")
+        self._prefetcher.start()
+
+    # Install a prefetched release once a print has ended
+    def on_event(self, event, payload):
+        if event not in (Events.PRINT_DONE, Events.PRINT_FAILED,
+                         Events.PRINT_CANCELLED):
+            return
+        if (not self._settings.get_boolean(["auto_update"]) or
+                not self._settings.get_boolean(["install_when_idle"]) or
+                self.isUpdating or
+                (self._update is not None and not self._update.done)):
+            return
+        if self._prefetched_release() is not None:
+            self._logger.info("Printer is idle, installing prefetched "
+                              "release firmware")
+            self._schedule(UpdateRequest(UpdateRequest.AUTO, onstartup=True))
 
     # Creates endpoint located at /plugin/firmwareupdate/upload
-    # Allows for custom firmware upload by accepting a base64-encoded string
+    # Allows for custom firmware upload either as a multipart file, which
+    # OctoPrint has already streamed to disk, or as a base64-encoded string
+    # for older clients. An optional sha256 value is checked before flashing.
     # Saves file to filesystem and begins the update process
     @octoprint.plugin.BlueprintPlugin.route("/upload", methods=["POST"])
     @restricted_access
     @admin_permission.require(403)
     def upload_file(self):
-        if "base64String" not in flask.request.values:
-            return flask.make_response("Expected a base64String value", 400)
+        values = flask.request.values
+        upload_path = values.get("file." + self._upload_path_suffix())
+        if upload_path is None and "base64String" not in values:
+            return flask.make_response(
+                "Expected a file or a base64String value", 400)
 
+        start = time()
+        path = None
         try:
-            decode = base64.b64decode(flask.request.values['base64String'])
-            self._check_directories()
+            path = self._pending_upload_file()
+            if upload_path is not None:
+                digest = copy_with_digest(upload_path, path)
+            else:
+                decode = base64.b64decode(values['base64String'])
+                with open(path, "wb") as firmware:
+                    firmware.write(decode)
+                digest = hashlib.sha256(decode).hexdigest()
+            check_digest(digest, values.get("sha256"))
+            image = parse_hex(path)
+        except (TypeError, ValueError, IOError, OSError, UploadError) as e:
+            if path is not None:
+                self._remove_file(path)
+            return self._upload_error(e)
+
+        request = self._schedule_upload(path, digest, image,
+                                        dict(decode=time() - start))
+        if request is None:
+            return flask.make_response("Too many updates are waiting", 409)
+        response = flask.make_response("OK", 200)
+        response.headers["X-Update-Job"] = request.id
+        return response
+
+    # Creates endpoint located at /plugin/firmwareupdate/upload_chunk
+    # Receives one multipart chunk of a resumable upload at the given offset.
+    # Once all bytes have arrived the digest is checked and the update begins.
+    @octoprint.plugin.BlueprintPlugin.route("/upload_chunk",
+                                            methods=["POST"])
+    @restricted_access
+    @admin_permission.require(403)
+    def upload_chunk(self):
+        values = flask.request.values
+        chunk_path = values.get("chunk." + self._upload_path_suffix())
+        try:
+            upload_id = values["upload_id"]
+            offset = int(values["offset"])
+            total = int(values["total"])
+        except (KeyError, ValueError):
+            return flask.make_response(
+                "Expected upload_id, offset and total values", 400)
+        if chunk_path is None:
+            return flask.make_response("Expected a chunk file", 400)
+        if not 0 < total <= MAX_UPLOAD_SIZE:
+            return flask.make_response(
+                "Uploads must be larger than 0 and at most %d bytes"
+                % MAX_UPLOAD_SIZE, 400)
+        # The answer to the last chunk got lost and the client sent it again
+        completed = self._uploads.completed(upload_id)
+        if completed is not None:
+            return flask.jsonify(complete=True, **completed)
+
+        path = None
+        try:
+            received = self._uploads.append(upload_id, offset, chunk_path)
+            if received < total:
+                return flask.jsonify(offset=received, complete=False)
+            if received > total:
+                self._uploads.discard(upload_id)
+                raise UploadError("Received more data than announced")
+
+            start = time()
+            path = self._pending_upload_file()
+            digest = self._uploads.finish(upload_id, path,
+                                          values.get("sha256"))
+            image = parse_hex(path)
+        except (IOError, OSError, UploadError, HexError) as e:
+            if path is not None:
+                self._remove_file(path)
+            return self._upload_error(e)
+
+        request = self._schedule_upload(path, digest, image,
+                                        dict(decode=time() - start))
+        if request is None:
+            return flask.make_response("Too many updates are waiting", 409)
+        self._uploads.complete(upload_id, received, request.id)
+        return flask.jsonify(offset=received, complete=True, job=request.id)
+
+    # Lets a client find out where to resume an interrupted upload, or that
+    # it is complete already and which update job handles it
+    @octoprint.plugin.BlueprintPlugin.route("/upload_chunk/<upload_id>",
+                                            methods=["GET"])
+    @restricted_access
+    @admin_permission.require(403)
+    def upload_chunk_offset(self, upload_id):
+        completed = self._uploads.completed(upload_id)
+        if completed is not None:
+            return flask.jsonify(complete=True, **completed)
+        try:
+            return flask.jsonify(offset=self._uploads.offset(upload_id))
+        except UploadError as e:
+            return flask.make_response(str(e), 400)
+
+    # Creates endpoint located at /plugin/firmwareupdate/metrics
+    # Flash counters and stage histograms in the Prometheus text format
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    @restricted_access
+    def get_metrics(self):
+        return flask.Response(self._metrics.prometheus(),
+                              mimetype="text/plain; version=0.0.4")
 
-            # Delete any firmware files that may exist when using
-            # custom firmware
-            self._delete_firmware_files()
-            with open(os.path.join(self.firmware_directory,
-                                   "firmware.hex"), "wb") as firmware:
-                firmware.write(decode)
-                firmware.close()
-        except (TypeError, IOError) as e:
+    # Creates endpoint located at /plugin/firmwareupdate/metrics/summary
+    # Flash history overview for the settings page
+    @octoprint.plugin.BlueprintPlugin.route("/metrics/summary",
+                                            methods=["GET"])
+    @restricted_access
+    def get_metrics_summary(self):
+        return flask.jsonify(**self._metrics.summary())
+
+    # Creates endpoint located at /plugin/firmwareupdate/logs
+    # Stored update logs, newest first
+    @octoprint.plugin.BlueprintPlugin.route("/logs", methods=["GET"])
+    @restricted_access
+    @admin_permission.require(403)
+    def get_logs(self):
+        return flask.jsonify(logs=self._logs.history())
+
+    # Creates endpoint located at /plugin/firmwareupdate/logs/<log_id>
+    # Entries of a log after the byte offset given as offset parameter. The
+    # returned offset is passed on the next request to tail a running update.
+    @octoprint.plugin.BlueprintPlugin.route("/logs/<log_id>",
+                                            methods=["GET"])
+    @restricted_access
+    @admin_permission.require(403)
+    def get_log(self, log_id):
+        if not self._logs.is_valid(log_id):
+            return flask.make_response("Unknown log", 404)
+        try:
+            offset = int(flask.request.values.get("offset", 0))
+        except ValueError:
+            return flask.make_response("Invalid offset", 400)
+        entries, offset = self._logs.tail(log_id, offset)
+        running = (self._job_log is not None and
+                   self._job_log.id == log_id and not self._job_log.closed)
+        return flask.jsonify(entries=entries, offset=offset, running=running)
+
+    # Creates endpoint located at /plugin/firmwareupdate/fleet/release
+    # Release of the running rollout in the format of the GitHub releases
+    # API, if the asking peer is part of a wave that has been opened
+    @octoprint.plugin.BlueprintPlugin.route("/fleet/release",
+                                            methods=["GET"])
+    def fleet_release(self):
+        error = self._check_fleet_request()
+        if error is not None:
+            return error
+        peer = flask.request.values.get("peer")
+        rollout = self._rollouts.rollout
+        if not peer or rollout is None or not self._rollouts.allow(peer):
+            return flask.make_response("No release for this peer", 404)
+        url = "%splugin/firmwareupdate/fleet/firmware/%s.hex" % (
+            flask.request.url_root, rollout.digest)
+        delta_url = "%splugin/firmwareupdate/fleet/delta/{digest}/%s.delta" \
+            % (flask.request.url_root, rollout.digest)
+        return flask.jsonify(tag_name=rollout.version, assets=[dict(
+            id=rollout.digest[:16], updated_at=rollout.version,
+            size=rollout.size, sha256=rollout.digest,
+            image_sha256=rollout.image_digest,
+            browser_download_url=url, delta_url=delta_url)])
+
+    # Creates endpoint located at /plugin/firmwareupdate/fleet/firmware/
+    # Serves cached firmware images to the peers, with support for Range
+    # requests so interrupted downloads can be resumed
+    @octoprint.plugin.BlueprintPlugin.route("/fleet/firmware/<digest>.hex",
+                                            methods=["GET"])
+    def fleet_firmware(self, digest):
+        error = self._check_fleet_request()
+        if error is not None:
+            return error
+        path = None
+        if DIGEST_PATTERN.match(digest):
+            path = self._cache.get_digest(digest)
+        if path is None:
+            return flask.make_response("Unknown firmware", 404)
+
+        size = os.path.getsize(path)
+        try:
+            byte_range = parse_range(flask.request.headers.get("Range"), size)
+        except ValueError:
+            response = flask.make_response("Range not satisfiable", 416)
+            response.headers["Content-Range"] = "bytes */%d" % size
+            return response
+        status = 200
+        start, end = 0, size - 1
+        if byte_range is not None:
+            status = 206
+            start, end = byte_range
+        response = flask.Response(read_range(path, start, end), status,
+                                  mimetype="application/octet-stream",
+                                  direct_passthrough=True)
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["Content-Length"] = str(end - start + 1)
+        if status == 206:
+            response.headers["Content-Range"] = "bytes %d-%d/%d" % (
+                start, end, size)
+        return response
+
+    # Creates endpoint located at /plugin/firmwareupdate/fleet/delta/
+    # Patch from the cached firmware whose parsed image has the digest
+    # source to the cached file with digest target. Peers know their
+    # firmware by its image, as patched releases are written out anew.
+    # Patches are made on the first request and kept.
+    @octoprint.plugin.BlueprintPlugin.route(
+        "/fleet/delta/<source>/<target>.delta", methods=["GET"])
+    def fleet_delta(self, source, target):
+        error = self._check_fleet_request()
+        if error is not None:
+            return error
+        if not (DIGEST_PATTERN.match(source) and
+                DIGEST_PATTERN.match(target)):
+            return flask.make_response("Unknown firmware", 404)
+        path = os.path.join(self._delta_directory(),
+                            "%s-%s.delta" % (source, target))
+        if not os.path.isfile(path):
+            source_path = self._cache.get_image(source)
+            target_path = self._cache.get_digest(target)
+            if source_path is None or target_path is None:
+                return flask.make_response("Unknown firmware", 404)
+            try:
+                patch = make_patch(bytes(parse_hex(source_path).data),
+                                   bytes(parse_hex(target_path).data))
+                with open(path + ".tmp", "wb") as f:
+                    f.write(patch)
+                os.rename(path + ".tmp", path)
+            except (IOError, OSError, HexError) as e:
+                self._logger.warn("Could not create patch: %s" % str(e))
+                return flask.make_response("Could not create patch", 500)
+        return flask.send_file(path, mimetype="application/octet-stream")
+
+    # Creates endpoint located at /plugin/firmwareupdate/fleet/report
+    # Takes the FirmwareUpdate event payload of a peer's finished update
+    @octoprint.plugin.BlueprintPlugin.route("/fleet/report",
+                                            methods=["POST"])
+    def fleet_report(self):
+        error = self._check_fleet_request()
+        if error is not None:
+            return error
+        data = flask.request.get_json(silent=True) or {}
+        if not data.get("peer") or data.get("status") not in FINAL_STATUSES:
+            return flask.make_response("Expected peer and status", 400)
+        self._rollouts.report(data["peer"], data.get("version"),
+                              data["status"], data.get("message"))
+        return flask.make_response("OK", 200)
+
+    # Creates endpoint located at /plugin/firmwareupdate/fleet/status
+    # Progress of the running rollout
+    @octoprint.plugin.BlueprintPlugin.route("/fleet/status", methods=["GET"])
+    @restricted_access
+    def fleet_status(self):
+        return flask.jsonify(mode=self._settings.get(["fleet_mode"]),
+                             rollout=self._rollouts.status())
+
+    # Creates endpoint located at /plugin/firmwareupdate/status
+    # Snapshot of the running or last update. /status/wait is the long-poll
+    # version, see status_routes.
+    @octoprint.plugin.BlueprintPlugin.route("/status", methods=["GET"])
+    @restricted_access
+    def status(self):
+        return flask.jsonify(**self._status_snapshot())
+
+    # Creates endpoint located at /plugin/firmwareupdate/jobs/<job_id>
+    # State of an update request, as returned by update_firmware and uploads
+    @octoprint.plugin.BlueprintPlugin.route("/jobs/<job_id>", methods=["GET"])
+    @restricted_access
+    def job(self, job_id):
+        request = self._scheduler.get(job_id)
+        if request is None:
+            return flask.make_response("Unknown update job", 404)
+        return flask.jsonify(**request.as_dict())
+
+    # Creates endpoint located at /plugin/firmwareupdate/metrics/export
+    # All flash records and histograms as a JSON download, tagged with the
+    # plugin version so runs of different versions can be compared
+    @octoprint.plugin.BlueprintPlugin.route("/metrics/export",
+                                            methods=["GET"])
+    @restricted_access
+    def export_metrics(self):
+        response = flask.jsonify(**self._metrics.export(self._plugin_version))
+        response.headers["Content-Disposition"] = \
+            "attachment; filename=firmwareupdate-metrics.json"
+        return response
+
+    def _upload_error(self, e):
+        if isinstance(e, HexError):
+            error_text = "Invalid firmware file: %s" % str(e)
+        elif isinstance(e, UploadError):
+            error_text = str(e)
+        else:
             error_text = "There was an issue saving the firmware file."
-            self._logger.warn("Error saving firmware file: %s" % str(e))
+        self._logger.warn("Error saving firmware file: %s" % str(e))
+        # A running update is left alone
+        if self._update is None or self._update.done:
             self._update_status(
                 False, "error", error_text)
-            return flask.make_response(error_text, 400)
+        return flask.make_response(error_text, 400)
 
-        self._start_update()
-        return flask.make_response("OK", 200)
+    # Queue request with the scheduler. Returns the request that will carry
+    # out the update, which is an earlier one if request is a duplicate, or
+    # None if too many updates are waiting.
+    def _schedule(self, request):
+        try:
+            scheduled = self._scheduler.submit(request)
+        except QueueFull as e:
+            self._logger.warn("Update request dropped: %s" % str(e))
+            return None
+        if scheduled is not request:
+            self._logger.info("Update request joins %s update %s"
+                              % (scheduled.state, scheduled.id))
+        return scheduled
 
-    def _start_update(self, onstartup=False):
-        # If by any chance the API command was called outside of Octoprint,
-        # we want to make sure we don't cancel a print.
-        if self.printer_is_printing():
-            self._logger.warn("Firmware called but print in progress.")
-        else:
-            # Make sure printer is disconnected before continuing
-            self._printer.disconnect()
+    # Queue the update of a validated upload that was saved at path
+    def _schedule_upload(self, path, digest, image, timings):
+        try:
+            self._cache.put(path, digest=digest, image_digest=image.digest)
+        except (IOError, OSError) as e:
+            self._logger.warn("Could not cache firmware file: %s" % str(e))
+        # The end of a print must not flash a prefetched release over it
+        self._cache.clear_prefetched()
+        request = UpdateRequest(UpdateRequest.UPLOAD, digest=digest,
+                                image=image, timings=timings, path=path)
+        scheduled = self._schedule(request)
+        if scheduled is not request:
+            self._remove_file(path)
+        return scheduled
+
+    # New file for an upload to wait in until its update runs
+    def _pending_upload_file(self):
+        directory = os.path.join(self.get_plugin_data_folder(), "pending")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, path = tempfile.mkstemp(dir=directory, suffix=".hex")
+        os.close(handle)
+        return path
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
+    # Carry out request and return once its update is over
+    def _execute_request(self, request):
+        self._request = request
+        try:
+            if (request.kind == UpdateRequest.UPLOAD and
+                    not self._install_upload(request)):
+                return
+            if not self._start_update(request.onstartup, request.ports,
+                                      request.timings):
+                return
+            self._update_firmware_init_thread.join()
+            if self._update_firmware_thread is not None:
+                self._update_firmware_thread.join()
+            # A worker that died on an unexpected error left the update
+            # without an outcome; end it so the printer is reconnected and
+            # the next update can run
+            if not self._update.done:
+                self._logger.error("Update %s ended without an outcome"
+                                   % request.id)
+                self._end_update(UpdateJob.ERROR,
+                                 "Update failed unexpectedly.")
+                self._clean_up()
+            request.outcome = self._update.state
+        finally:
+            self._request = None
+
+    # Move the file of an upload request into place for flashing
+    def _install_upload(self, request):
+        self._check_directories()
+        # Delete any firmware files that may exist when using custom
+        # firmware
+        self._delete_firmware_files()
+        self.firmware_file = os.path.join(self.firmware_directory,
+                                          "firmware.hex")
+        try:
+            shutil.move(request.path, self.firmware_file)
+        except (IOError, OSError) as e:
+            self._logger.warn("Uploaded firmware is gone: %s" % str(e))
+            return False
+        self.firmware_image = request.image
+        return True
+
+    # Form field suffix under which OctoPrint passes the path of an upload
+    # it has streamed to disk
+    def _upload_path_suffix(self):
+        return self._settings.global_get(["server", "uploads", "pathSuffix"])
+
+    # Stage timings measured before the update started, like decoding an
+    # upload, can be passed in timings. Returns False if no update was
+    # started. Updates are meant to be started through the scheduler only.
+    def _start_update(self, onstartup=False, ports=None, timings=None):
+        with self._update_lock:
+            if self._update is not None and not self._update.done:
+                self._logger.warn("Update already in progress.")
+                return False
+            # If by any chance the API command was called outside of
+            # Octoprint, we want to make sure we don't cancel a print.
+            if self.printer_is_printing():
+                self._logger.warn("Firmware called but print in progress.")
+                return False
+            # Make sure printer is disconnected before continuing. On startup
+            # this waits until an update is known to be needed.
+            if not onstartup:
+                self._printer.disconnect()
+                self._printer_disconnected = True
+            self._update = UpdateJob(self._stage_timeouts())
+            self._job_log = self._logs.create()
+            self._log("Update started on startup" if onstartup
+                      else "Update started")
+            self.target_ports = ports
+            self._release_version = None
+            self._timings = dict(timings or {})
+            self._update_started = time()
+            self._metrics_recorded = False
+            self._download_saved = 0
+
+            self._update_firmware_thread = None
             self._update_firmware_init_thread = Thread(
                 target=self._update_firmware_init, args=(onstartup,))
             self._update_firmware_init_thread.daemon = True
             self._update_firmware_init_thread.start()
+            return True
 
-    # Loop that is constantly checking the build log for errors or success
-    # messages
-    def checkStatus(self):
-        while True:
-            with open(os.path.expanduser('~/Marlin/.build_log')) as f:
-                update_result = f.read()
-            if 'No device matching following was found' in update_result:
-                self._logger.info("Failed update...")
-                self._update_status(
-                    False, "error", "A connected device was not found.")
-                self._clean_up()
-                break
-            elif 'FAILED' in update_result:
-                self._logger.info("Failed update...")
-                self._update_status(False, "error")
-                self._clean_up()
-                break
-            elif ('bytes of flash verified' in update_result and
-                  'avrdude done' in update_result):
-                self._logger.info("Successful update!")
-                for line in update_result.splitlines():
-                    if "Reading" in line:
-                        self.read_time = self.find_between(line, " ", "s")
-                        self.completion_time += float(self.read_time)
-                    elif "Writing" in line:
-                        self.write_time = self.find_between(line, " ", "s")
-                        self.completion_time += float(self.write_time)
-
-                self._update_status(False, "completed",
-                                    round(self.completion_time, 2))
-                self._clean_up()
-                break
-            elif 'ReceiveMessage(): timeout' in update_result:
-                self._logger.info(
-                    "Update timed out. Check if port is already in use!")
-                self._update_status(
-                    False, "error", "Device timed out. Please check that the "
-                                    "port is not in use!")
-
-                p = psutil.Process(self.updatePID)
-                for child in p.children(recursive=True):
-                    child.kill()
-                    p.kill()
-                self._clean_up()
-                break
+    # Roll the most recent cached release out to the fleet
+    def _start_rollout(self):
+        if self._settings.get(["fleet_mode"]) != "coordinator":
+            return flask.make_response("Not a fleet coordinator", 409)
+        latest = self._cache.get_latest()
+        if latest is None:
+            return flask.make_response("No release to roll out", 409)
+        digest = self._cache.digest_of(latest['key'])
+        path = self._cache.get(latest['key'])
+        try:
+            image_digest = parse_hex(path).digest
+        except (IOError, HexError) as e:
+            self._logger.warn("Cached release is invalid: %s" % str(e))
+            return flask.make_response("No release to roll out", 409)
+        rollout = Rollout(
+            latest['key'], latest['version'], digest, os.path.getsize(path),
+            canary=self._settings.get_int(["fleet_canary"]),
+            waves=[int(wave) for wave in self._settings.get(["fleet_waves"])],
+            max_failures=self._settings.get_int(["fleet_max_failures"]),
+            image_digest=image_digest)
+        self._rollouts.start(rollout)
+        # Patches to the previous release aren't needed anymore
+        for name in os.listdir(self._delta_directory()):
+            try:
+                os.remove(os.path.join(self._delta_directory(), name))
+            except OSError:
+                pass
+        self._logger.info("Rolling out release %s to the fleet"
+                          % latest['version'])
+        return flask.jsonify(rollout=rollout.as_dict())
+
+    # Patches served to the peers of the fleet
+    def _delta_directory(self):
+        directory = os.path.join(self.get_plugin_data_folder(), "deltas")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+
+    # Requests from peers are only served by coordinators that have a fleet
+    # token and need to carry it in the X-Fleet-Token header. Returns an error
+    # response or None.
+    def _check_fleet_request(self):
+        if self._settings.get(["fleet_mode"]) != "coordinator":
+            return flask.make_response("Not a fleet coordinator", 404)
+        token = self._settings.get(["fleet_token"])
+        if not token:
+            self._logger.warn("Fleet request refused, no fleet token is set")
+            return flask.make_response("No fleet token configured", 403)
+        supplied = flask.request.headers.get("X-Fleet-Token") or ""
+        if not hmac.compare_digest(supplied.encode("utf-8"),
+                                   token.encode("utf-8")):
+            return flask.make_response("Invalid fleet token", 403)
+        return None
+
+    # URL of a fleet route of the coordinator with the query params
+    def _fleet_url(self, route, **params):
+        url = "%s/plugin/firmwareupdate/fleet/%s" % (
+            self._settings.get(["fleet_coordinator"]).rstrip("/"), route)
+        if params:
+            url += "?" + urlencode(sorted(params.items()))
+        return url
+
+    def _fleet_peer_id(self):
+        peer = self._settings.get(["fleet_peer_id"])
+        if not peer:
+            peer = uuid.uuid4().hex
+            self._settings.set(["fleet_peer_id"], peer)
+            self._settings.save()
+        return peer
+
+    # Pass the outcome of installing release version on to the coordinator
+    # of the fleet
+    def _fleet_report(self, version, status, message=None):
+        if self._settings.get(["fleet_mode"]) != "peer":
+            return
+        report = dict(peer=self._fleet_peer_id(), version=version,
+                      status=status, message=message)
+
+        def send():
+            try:
+                self._downloader.session.post(
+                    self._fleet_url("report"), json=report,
+                    timeout=27).raise_for_status()
+            except CONNECTION_ERRORS as e:
+                self._logger.warn("Could not report to the fleet "
+                                  "coordinator: %s" % str(e))
+        thread = Thread(target=send)
+        thread.daemon = True
+        thread.start()
+
+    # Cancel the running update. Flashes in progress are stopped and the
+    # printer is reconnected right away; work blocked on the network notices
+    # once it returns and is discarded.
+    def _cancel_update(self):
+        with self._update_lock:
+            if self._update is None or not self._update.cancel():
+                self._logger.info("No update in progress to cancel")
+                return False
+            self._logger.info("Cancelling update")
+            self._jobs.cancel_all()
+            if self.isUpdating or self._printer_disconnected:
+                self._update_status(False, "cancelled", "Update cancelled.")
             else:
-                # Catch all other potential errors. Here we want to check if
-                # the firmware flash process is still running. If it's not,
-                # emit an error.
-                if self.process.poll() is not None:
-                    self._logger.info("Failed update. Consult the build log")
-                    self._update_status(
-                        False, "error", "An unknown error occurred. Please "
-                                        "consult the build log for more "
-                                        "information.")
-                    self._clean_up()
-                    break
-            sleep(1)
+                self._log("Update cancelled")
+                self._job_log.close()
+            return True
+
+    # Deadlines of the update stages in seconds, by stage name
+    def _stage_timeouts(self):
+        return dict((stage, self._settings.get_float(["stage_timeouts",
+                                                      stage]))
+                    for stage in (UpdateJob.LOOKUP, UpdateJob.DOWNLOAD,
+                                  FlashJob.RESET, FlashJob.PROGRAM,
+                                  FlashJob.VERIFY, FlashJob.BOOT))
+
+    # Create the flasher engine selected in the settings for job
+    def _create_flasher(self, job):
+        progress_rate = self._settings.get_float(["progress_rate"])
+        if progress_rate and progress_rate > 0:
+            progress_interval = 1.0 / progress_rate
+        else:
+            progress_interval = 0
+        options = dict(
+            on_result=lambda flasher: self._on_flash_result(job, flasher),
+            on_progress=lambda phase, progress: self._update_progress(
+                phase, progress, job),
+            progress_interval=progress_interval,
+            baudrate=job.baudrate,
+            verify=self._settings.get(["verify_mode"]) == "full")
+
+        if self._settings.get(["flash_engine"]) == "stk500v2":
+            return Stk500v2Flasher(**options)
+        return AvrdudeFlasher(os.path.expanduser('~/Marlin'), **options)
+
+    def _on_flash_result(self, job, flasher):
+        if (flasher.result in (Flasher.ERROR, Flasher.TIMEOUT) and
+                job.retries > 0 and not job.cancelled and not job.timed_out):
+            self._logger.info("Flash of %s at %d baud failed, retrying: %s"
+                              % (job.port, job.baudrate, flasher.message))
+            self._log("Flash at %d baud failed, retrying: %s"
+                      % (job.baudrate, flasher.message),
+                      port=job.port, level="warning")
+            job.retry_result = flasher.result
+            return
+
+        job.completion_time = flasher.completion_time
+        if flasher.result == Flasher.COMPLETED:
+            self._remember_baudrate(job.port, job.baudrate)
+            if (self._settings.get(["verify_mode"]) == "boot" and
+                    not self._check_boot(job)):
+                self._finish_job(job, FlashJob.ERROR)
+                return
+            self._logger.info("Successful update of %s!" % job.port)
+            self._finish_job(job, FlashJob.COMPLETED)
+        elif flasher.result == Flasher.TIMEOUT or job.timed_out:
+            self._logger.info(
+                "Update of %s timed out. Check if port is already in use!"
+                % job.port)
+            job.message = flasher.message
+            if job.timeout_stage is not None:
+                job.message = ("The %s stage did not finish in time."
+                               % job.timeout_stage)
+            elif job.timed_out:
+                job.message = "Update did not finish in time."
+            self._finish_job(job, FlashJob.ERROR)
+        else:
+            self._logger.info("Failed update of %s..." % job.port)
+            job.message = flasher.message
+            self._finish_job(job, FlashJob.ERROR)
+
+    # Wait for the board of job to start the firmware just flashed and to
+    # report the name compiled into it. Returns False with the reason in
+    # job.message if it doesn't.
+    def _check_boot(self, job):
+        self._update_progress("booting", 0, job)
+        expected = None
+        if self.firmware_image is not None:
+            expected = image_firmware_name(self.firmware_image.data)
+        start = time()
+        try:
+            report = check_boot(
+                job.port, self._settings.get_int(["boot_baudrate"]),
+                expected=expected,
+                timeout=self._settings.get_float(["stage_timeouts",
+                                                  FlashJob.BOOT]),
+                cancelled=lambda: job.cancelled)
+        except BootError as e:
+            self._logger.info("Boot check of %s failed: %s"
+                              % (job.port, str(e)))
+            if job.timed_out:
+                job.message = ("The %s stage did not finish in time."
+                               % FlashJob.BOOT)
+            elif job.cancelled:
+                job.message = "Update cancelled."
+            else:
+                job.message = str(e)
+            return False
+        job.boot_time = time() - start
+        job.completion_time += job.boot_time
+        self._log("Firmware started: %s" % report, port=job.port)
+        self._update_progress("booting", 100, job)
+        return True
+
+    # Record the outcome of a single board and, once every board is done,
+    # distribute the outcome of the whole update
+    def _finish_job(self, job, state):
+        if job.done:
+            return
+        self._log("Flash %s%s" % (state, ": %s" % job.message
+                                  if job.message else ""),
+                  port=job.port,
+                  level="info" if state == FlashJob.COMPLETED else "error")
+        self._record_flash(job.port, failed=state != FlashJob.COMPLETED)
+        all_done = self._jobs.finish(job, state)
+        self._record_metrics(job)
+        jobs = self._jobs.jobs
+        if len(jobs) > 1:
+            self._update_port_status(job)
+        if not all_done:
+            return
+
+        failed = [other for other in jobs if other.state == FlashJob.ERROR]
+        extra = None
+        if len(jobs) > 1:
+            extra = dict(ports=self._jobs.statuses())
+        elif job.flash_stats is not None:
+            extra = self._flash_summary(job)
+
+        if failed:
+            if len(jobs) > 1:
+                message = "; ".join("%s: %s" % (
+                    other.port, other.message or "Update failed")
+                    for other in failed)
+            else:
+                message = job.message
+            self._end_update(UpdateJob.ERROR, message, extra)
+        else:
+            completion_time = max(other.completion_time for other in jobs)
+            self._end_update(UpdateJob.COMPLETED,
+                             round(completion_time, 2), extra)
 
     # Initiation of firmware update which gathers information about current
     # release version and compares to present installation version
     def _update_firmware_init(self, onstartup=False):
         if self.printer_is_printing():
-            self._update_status(False, "error", "Printer is in use.")
+            self._end_update(UpdateJob.ERROR, "Printer is in use.")
         else:
             self._check_directories()
 
@@ -226,58 +1069,62 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
                 self.updating_on_startup = True
                 self._delete_firmware_files()
 
+                # A release downloaded in the background is installed
+                # straight from the cache
+                if self._prefetched_release() is not None:
+                    self.version = None
+                    if self._update_from_cache("Prefetched release is ready"):
+                        return
+                    self._logger.info("Prefetched release could not be "
+                                      "restored, grabbing from GitHub")
+                    if self.isUpdating or self._begin_update():
+                        self._update_from_github()
+                    return
+
                 # Check against current version
                 if not os.path.isfile(self.version_file):
                     self._logger.info(
                         "No version file exists, grabbing latest from GitHub")
-                    self._update_status(True, "inprogress")
-
-                    self._update_from_github()
+                    if self._begin_update():
+                        self._update_from_github()
                 else:
                     with open(self.version_file, 'r') as f:
                         self.version = f.readline()
 
-                    try:
-                        r = requests.get(
-                            "https://api.github.com/repos/Voxel8/"
-                            "Marlin/releases/latest", timeout=27)
-                    except (requests.exceptions.ConnectionError,
-                            requests.exceptions.HTTPError,
-                            requests.exceptions.Timeout) as e:
-                        self.raise_connection_error(e)
+                    release = self._startup_release_lookup()
+                    if release is None:
                         return
 
-                    rjson = r.json()
-                    github_version = rjson['assets'][0]['updated_at']
+                    github_version = release['assets'][0]['updated_at']
 
                     if self.version == github_version:
                         self._logger.info("Skipping update process")
-                        self.isUpdating = False
+                        self._skip_update()
                     else:
                         self._logger.info(
                             "Version in file is different, grabbing from "
                             "GitHub")
-                        self._update_status(True, "inprogress")
-
-                        self._update_from_github()
+                        if self._begin_update():
+                            self._update_from_github(release)
             else:
                 self.updating_on_startup = False
                 self.local_file_name = self._check_for_firmware_file()
                 if self.local_file_name is not None:
                     self._logger.info("Updating using " + self.local_file_name)
-                    self._update_status(True, "inprogress")
+                    self._begin_update()
 
                     self.firmware_file = os.path.join(os.path.expanduser(
                         '~/Marlin/.build/mega2560/'), self.local_file_name)
 
                     # Using something other than GitHub, delete version file
                     self._delete_version_file()
+                    self._cache.clear_prefetched()
 
                     self._update_firmware("local")
                 else:
                     self._logger.info(
                         "No files exist, grabbing latest from GitHub")
-                    self._update_status(True, "inprogress")
+                    self._begin_update()
 
                     self._update_from_github()
 
@@ -289,60 +1136,314 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
         else:
             return None
 
-    # Begin the update process from GitHub
-    def _update_from_github(self):
+    # Take the printer offline and announce the update. Returns False if a
+    # print was started while the startup check was running.
+    def _begin_update(self):
+        if self._update.done:
+            return False
+        if self.printer_is_printing():
+            self._logger.warn("Print started before the update, skipping...")
+            return False
+        if not self._printer_disconnected:
+            self._printer.disconnect()
+            self._printer_disconnected = True
+        self._update_status(True, "inprogress")
+        return True
+
+    # Release lookup of the startup check. The printer is still connected, so
+    # failures are only logged and retried with backoff; once every attempt
+    # failed or the deadline of the whole check passed the cached release is
+    # used. Returns None if there is nothing to compare against.
+    def _startup_release_lookup(self):
+        attempts = max(1, self._settings.get_int(["startup_check_attempts"]))
+        backoff = self._settings.get_float(["startup_check_backoff"])
+        timeout = self._settings.get_float(["startup_check_timeout"])
+        deadline = self._settings.get_float(["startup_check_deadline"])
+        if not self._advance(UpdateJob.LOOKUP):
+            return None
+        start = time()
+        for attempt in range(attempts):
+            delay = backoff * 2 ** (attempt - 1) if attempt > 0 else 0
+            if deadline and time() - start + delay >= deadline:
+                self._logger.info("Release check did not finish within %s "
+                                  "seconds" % deadline)
+                break
+            if delay and self._update.wait(delay):
+                return None
+            attempt_timeout = timeout
+            if deadline:
+                attempt_timeout = min(timeout, deadline - (time() - start))
+            try:
+                release = self._releases.latest(use_cache=True,
+                                                timeout=attempt_timeout)
+                release['assets'][0]['browser_download_url']
+                self._timings['lookup'] = time() - start
+                return release
+            except NoRelease:
+                self._timings['lookup'] = time() - start
+                self._logger.info("No release available yet, skipping "
+                                  "update process")
+                self._skip_update("No release available yet")
+                return None
+            except CONNECTION_ERRORS as e:
+                self._logger.info("Release check attempt %d of %d failed: %s"
+                                  % (attempt + 1, attempts, str(e)))
+                if self._update.cancelled:
+                    return None
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                self._logger.warn("Unexpected release metadata: %s" % str(e))
+                return None
+
+        self._timings['lookup'] = time() - start
+        if not self._update_from_cache():
+            self._logger.info("GitHub unreachable and no cached release, "
+                              "skipping update process")
+            self._skip_update()
+        return None
+
+    # Get the latest release metadata, falling back to the cached firmware if
+    # GitHub can't be reached. Returns None if the lookup failed.
+    def _lookup_release(self):
+        if not self._advance(UpdateJob.LOOKUP):
+            return None
+        start = time()
         try:
-            r = requests.get(
-                'https://api.github.com/repos/Voxel8/Marlin/releases/latest',
-                timeout=27)
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.HTTPError,
-                requests.exceptions.Timeout) as e:
-            self.raise_connection_error(e)
-            return
+            # Startup checks may reuse recently fetched metadata, explicit
+            # updates always revalidate it with GitHub
+            release = self._releases.latest(
+                use_cache=self.updating_on_startup,
+                timeout=self._update.deadline(UpdateJob.LOOKUP))
+            self._timings['lookup'] = time() - start
+            release['assets'][0]['browser_download_url']
+            return release
+        except NoRelease:
+            self._timings['lookup'] = time() - start
+            self._logger.info("No release available yet, skipping update "
+                              "process")
+            self._skip_update("No release available yet")
+        except CONNECTION_ERRORS as e:
+            self._timings['lookup'] = time() - start
+            if not self._update_from_cache():
+                self.raise_connection_error(e)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            self._logger.warn("Unexpected release metadata: %s" % str(e))
+            self._end_update(UpdateJob.ERROR,
+                             "Release information could not be read.")
+        return None
+
+    # Begin the update process from GitHub. The release metadata is looked up
+    # unless the caller already has it.
+    def _update_from_github(self, release=None):
+        if release is None:
+            release = self._lookup_release()
+            if release is None:
+                return
 
-        rjson = r.json()
+        asset = release['assets'][0]
+        key = release_key(asset)
+        # Written to the version file once the release has been flashed
+        self._release_version = asset['updated_at']
         self.firmware_file = os.path.join(
             self.firmware_directory, 'firmware.hex')
-        # Write version to File
-        with open(self.version_file, 'w') as f:
-            f.write(rjson['assets'][0]['updated_at'])
 
-        # Download the hex file from GitHub
-        self._logger.info("Getting URL of latex hex file from GitHub")
-        try:
-            r = requests.get(rjson['assets'][0]['browser_download_url'],
-                             stream=True, timeout=27)
-            r.raise_for_status()
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.HTTPError,
-                requests.exceptions.Timeout) as e:
-            self.raise_connection_error(e)
+        if self._cache.restore(key, self.firmware_file) is not None:
+            self._logger.info("Using cached release firmware")
+            self._cache.set_latest(key, asset['updated_at'])
+            self._update_firmware("github")
             return
 
-        self._logger.info("Saving downloaded firmware to disk")
+        # Download the hex file from GitHub
+        if not self._advance(UpdateJob.DOWNLOAD):
+            return
+        if self._download_delta(release, asset):
+            self._cache_firmware_file(key)
+            self._cache.set_latest(key, asset['updated_at'])
+            self._update_firmware("github")
+            return
+        self._logger.info("Downloading latest hex file from GitHub")
+        start = time()
+        # Remove the file of an earlier update so only a verified download
+        # can be flashed
         try:
-            with open(self.firmware_file, 'wb') as f:
-                for block in r.iter_content(1024):
-                    f.write(block)
-        except IOError as e:
+            os.remove(self.firmware_file)
+        except OSError:
+            pass
+        try:
+            digest = self._downloader.download(
+                asset['browser_download_url'], self.firmware_file,
+                size=asset.get('size'), digest=asset_digest(asset),
+                stop=lambda: (self._update.cancelled or
+                              self._update.expired()),
+                timeout=min(27, self._update.deadline(
+                    UpdateJob.DOWNLOAD) or 27))
+        except DownloadStopped:
+            if not self._update.cancelled:
+                self._end_update(UpdateJob.ERROR,
+                                 "Download did not finish in time.")
+            return
+        except DownloadError as e:
+            self._logger.warn("Invalid release download: %s" % str(e))
+            self._end_update(UpdateJob.ERROR,
+                             "Release firmware download is corrupt.")
+            return
+        except CONNECTION_ERRORS + (IOError,) as e:
             self.raise_connection_error(e)
             return
+        self._timings['download'] = time() - start
 
         if os.path.isfile(self.firmware_file):
             self._logger.info("File downloaded, continuing...")
+            start = time()
+            try:
+                self.firmware_image = parse_hex(self.firmware_file)
+                self._timings['decode'] = time() - start
+            except (IOError, HexError) as e:
+                self._logger.warn("Invalid release firmware: %s" % str(e))
+                self._end_update(UpdateJob.ERROR,
+                                 "Release firmware is invalid.")
+                self._clean_up()
+                return
+            self._cache_firmware_file(key, digest)
+            self._cache.set_latest(key, asset['updated_at'])
             self._update_firmware("github")
         else:
-            self._update_status(
-                False, "error", "Release firmware was not downloaded.")
+            self._end_update(UpdateJob.ERROR,
+                             "Release firmware was not downloaded.")
+
+    # Build the release firmware from the previously installed release and
+    # a patch instead of downloading all of it. The result has to match the
+    # image digest the release advertises. Returns False when the full
+    # firmware has to be downloaded instead.
+    def _download_delta(self, release, asset):
+        if not self._settings.get_boolean(["delta_updates"]):
+            return False
+        expected = asset_image_digest(asset)
+        if expected is None:
+            return False
+        previous = self._cache.get_latest()
+        if previous is None:
+            return False
+        source_path = self._cache.get(previous['key'], touch=True)
+        if source_path is None:
+            return False
+        # Patches are made between parsed images, which stay the same when
+        # a patched release is written out as a new hex file
+        try:
+            source = parse_hex(source_path)
+        except (IOError, HexError):
+            return False
+        url, digest = self._delta_url(release, asset, source.digest)
+        if url is None:
+            return False
+
+        start = time()
+        path = os.path.join(self.firmware_directory, self.DELTA_FILE_NAME)
+        try:
+            # Like the full firmware, the patch is downloaded resumably and
+            # in time; it is only worth it if it is smaller than the firmware
+            # file, and a full flash in Intel HEX is under three times its
+            # size
+            self._downloader.download(
+                url, path, digest=digest,
+                max_size=asset.get('size') or 3 * FLASH_SIZE,
+                stop=lambda: (self._update.cancelled or
+                              self._update.expired()),
+                timeout=min(27, self._update.deadline(
+                    UpdateJob.DOWNLOAD) or 27))
+            with open(path, "rb") as f:
+                patch = f.read()
+            data = bytearray(apply_patch(bytes(source.data), patch))
+            image = FirmwareImage(data, list(range(page_count(data))))
+            if image.digest != expected:
+                raise DeltaError("Patched firmware isn't the release's")
+            write_hex(self.firmware_file, image.data, image.pages)
+        except CONNECTION_ERRORS + (IOError, HexError, DeltaError) as e:
+            # A stopped download is noticed again by the full download
+            self._logger.info("Delta update from %s not possible, "
+                              "downloading the full firmware: %s"
+                              % (previous['version'], str(e)))
+            return False
+        finally:
+            self._remove_file(path)
+        self._timings['download'] = time() - start
+        self.firmware_image = image
+
+        size = asset.get('size') or os.path.getsize(self.firmware_file)
+        self._download_saved = max(0, size - len(patch))
+        message = ("Release firmware patched from %s, %d of %d bytes "
+                   "downloaded" % (previous['version'], len(patch), size))
+        self._logger.info(message)
+        self._log(message)
+        return True
+
+    # URL and, if known, SHA-256 of a patch from the release whose parsed
+    # image has the digest source to the release asset, either from the
+    # fleet coordinator or a release asset named after the first 16 digits
+    # of source. The URL is None if there is no patch.
+    def _delta_url(self, release, asset, source):
+        if asset.get('delta_url'):
+            return asset['delta_url'].replace("{digest}", source), None
+        for other in release['assets'][1:]:
+            if other.get('name', "").endswith("%s.delta" % source[:16]):
+                return other['browser_download_url'], asset_digest(other)
+        return None, None
+
+    # Flash the most recent cached release when GitHub can't be reached.
+    # Returns False if there is no cached release to fall back on.
+    def _update_from_cache(self, reason="GitHub unreachable"):
+        latest = self._cache.get_latest()
+        if latest is None:
+            return False
+
+        if self.version == latest['version']:
+            self._logger.info("%s, cached release is already installed. "
+                              "Skipping update process" % reason)
+            self._skip_update()
+            return True
+
+        self._logger.info("%s, using cached release firmware" % reason)
+        if not self.isUpdating and not self._begin_update():
+            return True
+        self.firmware_file = os.path.join(
+            self.firmware_directory, 'firmware.hex')
+        if self._cache.restore(latest['key'], self.firmware_file) is None:
+            return False
+        self._cache.clear_prefetched()
+        self._release_version = latest['version']
+        self._update_firmware("github")
+        return True
+
+    # The release the prefetcher downloaded if it hasn't been installed, and
+    # no other firmware has been flashed since. Only automatic updates
+    # install it.
+    def _prefetched_release(self):
+        if (not self._settings.get_int(["prefetch_interval"]) or
+                not self._settings.get_boolean(["auto_update"])):
+            return None
+        return self._cache.get_prefetched()
+
+    # Let the front-end know that a new release can be installed without
+    # waiting for a download
+    def _on_release_ready(self, key, version):
+        self._logger.info("Release %s is ready to be installed" % version)
+        self._publish({'status': "ready", 'version': version})
+
+    # Add the current firmware file to the cache, optionally under key
+    def _cache_firmware_file(self, key=None, digest=None):
+        image_digest = None
+        if self.firmware_image is not None:
+            image_digest = self.firmware_image.digest
+        try:
+            return self._cache.put(self.firmware_file, key, digest,
+                                   image_digest)
+        except (IOError, OSError) as e:
+            self._logger.warn("Could not cache firmware file: %s" % str(e))
+            return None
 
     def _update_firmware(self, target):
         if not self.isUpdating:
             self._logger.info("Skipped initiation. Aborting...")
         else:
-            self.completion_time = 0
-            self.write_time = None
-            self.read_time = None
             try:
                 os.remove(os.path.expanduser('~/Marlin/.build_log'))
             except OSError:
@@ -353,8 +1454,8 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
             self._update_firmware_thread.daemon = True
             self._update_firmware_thread.start()
 
-    # Worker process that actually controls the firmware process and writes
-    # to the build log
+    # Worker process that flashes every selected port, each in its own job
+    # with its own build log
     def _update_worker(self, target=None):
         self._logger.info("Updating now using: " + target)
 
@@ -363,71 +1464,469 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
         else:
             filename = self.local_file_name
 
-        try:
-            self.port = glob('/dev/ttyACM*')[0]
-        except IndexError:
-            self._update_status(False, "error", "No ports exist.")
+        if not self._advance(UpdateJob.FLASHING):
+            self._clean_up()
+            return
+
+        ports = self._select_ports()
+        if not ports:
+            self._end_update(UpdateJob.ERROR, "No ports exist.")
             self._clean_up()
             raise RuntimeError('No ports detected')
 
-        self.build_log = open(os.path.expanduser('~/Marlin/.build_log'), "w")
+        # Validate the file before anything touches the board
+        if self.firmware_image is None:
+            start = time()
+            try:
+                self.firmware_image = parse_hex(self.firmware_file)
+                self._timings['decode'] = time() - start
+            except (IOError, HexError) as e:
+                self._logger.warn("Invalid firmware file: %s" % str(e))
+                self._end_update(UpdateJob.ERROR,
+                                 "Invalid firmware file: %s" % str(e))
+                self._clean_up()
+                return
+
+        self.firmware_digest = self._cache_firmware_file()
+        jobs = []
+        for port in ports:
+            job = FlashJob(port, filename, self.firmware_image)
+            if self._settings.get_boolean(["differential_flash"]):
+                self._prepare_differential_flash(job)
+            jobs.append(job)
+
+        manager = FlashJobManager(
+            self._settings.get_int(["max_concurrent_flashes"]),
+            self._settings.get_int(["flash_timeout"]),
+            self._update.deadlines)
+        # A cancel until now only reached the jobs of the previous update
+        with self._update_lock:
+            if self._update.done:
+                self._logger.info("Update ended before flashing")
+                self._clean_up()
+                return
+            self._jobs = manager
+        manager.run(jobs, self._run_job)
+        self._clean_up()
+
+    # Flash a single board
+    def _run_job(self, job):
+        if job.flash_stats is not None and not job.image.pages:
+            self._logger.info("Firmware on %s is unchanged, skipping flash"
+                              % job.port)
+            self._finish_job(job, FlashJob.COMPLETED)
+            return
+
+        if job.cancelled or self._update.done:
+            job.message = "Update cancelled."
+            self._finish_job(job, FlashJob.ERROR)
+            return
+
+        log_path = os.path.expanduser('~/Marlin/.build_log')
+        if len(self._jobs.jobs) > 1:
+            log_path += "-" + os.path.basename(job.port)
+        rates = self._baudrates(job.port)
+        job.retries = max(0, self._settings.get_int(["flash_retries"]))
         try:
-            s = Serial(self.port, 115200)
-        except SerialException as e:
-            self._update_status(False, "error", str(e))
-            self._clean_up()
-            raise RuntimeError(str(e))
-
-        # Pulse connection to ensure avrdude can make a connection
-        s.setDTR(False)
-        sleep(0.1)
-        s.setDTR(True)
-        s.close()
-        self.process = Popen("cd ~/Marlin/; avrdude -p m2560 -P /dev/ttyACM0 "
-                             "-c stk500v2 -b 250000 -D "
-                             "-U flash:w:./.build/mega2560/%s:i" % filename,
-                             stdout=self.build_log,
-                             stderr=self.build_log,
-                             shell=True,
-                             preexec_fn=os.setsid)
-        self.updatePID = self.process.pid
-        self.checkStatus()
-
-    def find_between(self, s, first, last):
+            job.build_log = self._job_log.stream(
+                job.port, lambda: job.stage, raw=open(log_path, "wb"))
+            # Retry failed attempts; when the board couldn't be synchronized
+            # with try again at the next lower baud rate
+            while True:
+                job.baudrate = rates[0]
+                job.retry_result = None
+                job.set_progress(None, None)
+                job.stage_started = time()
+                job.flasher = self._create_flasher(job)
+                # Cancelled while there was no flasher to stop
+                if job.cancelled or self._update.done:
+                    job.flasher.cancel()
+                job.flasher.flash(job.port,
+                                  os.path.join(self.firmware_directory,
+                                               job.filename),
+                                  job.build_log, job.image)
+                if job.retry_result is None:
+                    break
+                if job.cancelled or job.timed_out:
+                    job.retries = 0
+                    self._on_flash_result(job, job.flasher)
+                    break
+                job.retries -= 1
+                if job.retry_result == Flasher.TIMEOUT and len(rates) > 1:
+                    rates = rates[1:]
+                    self._logger.info("Stepping down to %d baud on %s"
+                                      % (rates[0], job.port))
+                    self._log("Stepping down to %d baud" % rates[0],
+                              port=job.port)
+        except (IOError, OSError) as e:
+            job.message = str(e)
+        finally:
+            if job.build_log is not None:
+                job.build_log.close()
+            if not job.done:
+                self._finish_job(job, FlashJob.ERROR)
+
+    # Baud rates to flash port with, fastest first, starting at the rate
+    # that last worked for the board attached there
+    def _baudrates(self, port):
+        preferred = self._settings.get_int(["baudrate"])
+        rates = [preferred]
+        for rate in sorted((int(rate) for rate in
+                            self._settings.get(["baudrate_fallbacks"]) or []),
+                           reverse=True):
+            if rate < preferred and rate not in rates:
+                rates.append(rate)
+        known = self._load_baudrates().get(self._board_key(port))
+        if known in rates:
+            rates = rates[rates.index(known):]
+        return rates
+
+    # Remember that rate worked for the board attached at port
+    def _remember_baudrate(self, port, rate):
+        with self._record_lock:
+            rates = self._load_baudrates()
+            rates[self._board_key(port)] = rate
+            try:
+                with open(self._baudrate_file(), "w") as f:
+                    json.dump(rates, f)
+            except (IOError, OSError) as e:
+                self._logger.warn("Could not save baud rate: %s" % str(e))
+
+    def _load_baudrates(self):
         try:
-            start = s.rindex(first) + len(first)
-            end = s.rindex(last, start)
-            return s[start:end]
-        except ValueError:
-            return ""
+            with open(self._baudrate_file()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _baudrate_file(self):
+        return os.path.join(self.get_plugin_data_folder(), "baudrates.json")
+
+    # Boards are told apart by their USB IDs where possible, by their port
+    # otherwise
+    def _board_key(self, port):
+        return self._ports.board_at(port) or port
+
+    # Ports selected for this update that are actually attached. Without a
+    # selection the board flashed last is used wherever it is attached now,
+    # otherwise the first known Mega 2560 board or serial device.
+    def _select_ports(self):
+        ports = self._ports.ports()
+        available = [port.device for port in ports]
+        boards = [port.device for port in ports if port.known] or available
+        if self.target_ports == "all":
+            return boards
+        if self.target_ports is not None:
+            selected = []
+            for target in self.target_ports:
+                if target not in available:
+                    target = self._ports.device_of(target)
+                if target is not None and target not in selected:
+                    selected.append(target)
+            return selected
+
+        last = self._last_flashed_device()
+        if last is not None:
+            return [last]
+        return boards[:1]
+
+    # Ports of an update command must be "all" or a list of device paths or
+    # board identifiers of attached devices. Returns the reason they can't
+    # be used, or None.
+    def _check_ports(self, ports):
+        if ports is None or ports == "all":
+            return None
+        if (not isinstance(ports, list) or not ports or
+                not all(isinstance(port, str) for port in ports)):
+            return "Expected \"all\" or a list of ports"
+        available = self._ports.ports()
+        for port in ports:
+            if not any(port in (other.device, other.board)
+                       for other in available):
+                return "Unknown port: %s" % port
+        return None
+
+    # Current path of the most recently flashed board that is still attached
+    def _last_flashed_device(self):
+        records = sorted(self._load_flash_record().values(),
+                         key=lambda record: record.get('flashed_at', 0),
+                         reverse=True)
+        for record in records:
+            if record.get('board'):
+                device = self._ports.device_of(record['board'])
+                if device is not None:
+                    return device
+        return None
+
+    # Compare the firmware against the image last flashed to the job's port
+    # and write a hex file containing only the pages that differ. The job is
+    # left flashing the full image if there is nothing to compare against.
+    def _prepare_differential_flash(self, job):
+        record = self._load_flash_record().get(job.port)
+        if record is None or self.firmware_digest is None:
+            return
+        if record.get('board') != self._ports.board_at(job.port):
+            self._logger.info("A different board is attached to %s, "
+                              "flashing the full image" % job.port)
+            return
+        previous = self._cache.get_digest(record['digest'], touch=True)
+        if previous is None:
+            self._logger.info("Previous firmware not cached, flashing the "
+                              "full image")
+            return
+
+        new_image = self.firmware_image.data
+        filename = "%s-%s" % (self.DIFF_FILE_NAME,
+                              os.path.basename(job.port))
+        try:
+            pages = diff_pages(read_hex(previous), new_image)
+            write_hex(os.path.join(self.firmware_directory, filename),
+                      new_image, pages)
+        except (IOError, OSError, HexError) as e:
+            self._logger.warn("Differential flash failed, flashing the full "
+                              "image: %s" % str(e))
+            return
+
+        job.filename = filename
+        job.image = FirmwareImage(new_image, pages)
+        job.flash_stats = dict(written=len(pages) * PAGE_SIZE,
+                               total=page_count(new_image) * PAGE_SIZE)
+        self._logger.info("Flashing %d changed pages of %d to %s" % (
+            len(pages), page_count(new_image), job.port))
+
+    # Bytes written and estimated time saved by a differential flash
+    def _flash_summary(self, job):
+        written = job.flash_stats['written']
+        saved = None
+        if written > 0:
+            saved = round(job.completion_time / written *
+                          (job.flash_stats['total'] - written), 2)
+        return dict(bytesWritten=written, timeSaved=saved)
+
+    # Remember which image is on the board at port and which board that is.
+    # After a failed flash its content is unknown, so the next flash has to
+    # be a full one.
+    def _record_flash(self, port, failed=False):
+        with self._record_lock:
+            record = self._load_flash_record()
+            if failed or self.firmware_digest is None:
+                record.pop(port, None)
+            else:
+                board = self._ports.board_at(port)
+                # A board is only ever attached at one path
+                for other, entry in list(record.items()):
+                    if board is not None and entry.get('board') == board:
+                        del record[other]
+                record[port] = dict(digest=self.firmware_digest,
+                                    board=board, flashed_at=time())
+            try:
+                with open(self._flash_record_file(), "w") as f:
+                    json.dump(record, f)
+            except (IOError, OSError) as e:
+                self._logger.warn("Could not save flash record: %s" % str(e))
+
+    # Add the stage timings and outcome of a board, or of an update that
+    # failed before any board was flashed, to the metrics
+    def _record_metrics(self, job=None, message=None, outcome="error"):
+        if self._update_started is None:
+            return
+        self._metrics_recorded = True
+        timings = dict(self._timings)
+        timings['total'] = time() - self._update_started
+        # Savings are counted once per update, not for every board
+        saved, self._download_saved = self._download_saved, 0
+        if job is None:
+            self._metrics.add(outcome, timings, reason=message, saved=saved)
+            return
+
+        timings.update(job.timings)
+        if job.flash_stats is not None:
+            size = job.flash_stats['written']
+        else:
+            size = len(job.image.pages) * PAGE_SIZE
+        outcome = job.state
+        if job.timed_out:
+            outcome = "timeout"
+        elif job.cancelled:
+            outcome = "cancelled"
+        self._metrics.add(outcome, timings, port=job.port,
+                          engine=self._settings.get(["flash_engine"]),
+                          size=size, reason=job.message, saved=saved)
+
+    def _load_flash_record(self):
+        try:
+            with open(self._flash_record_file()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _flash_record_file(self):
+        return os.path.join(self.get_plugin_data_folder(), "flashed.json")
+
+    # Report the final outcome of the running update, unless it has already
+    # ended, e.g. because it was cancelled while this work was still running
+    def _end_update(self, state, message=None, extra=None):
+        with self._update_lock:
+            if self._update is not None and not self._update.finish(state):
+                return
+            self._update_status(False, state, message, extra)
+
+    # End an update that turned out not to be needed, reconnecting the
+    # printer if it was taken offline for it
+    def _skip_update(self, reason="Firmware is up to date"):
+        with self._update_lock:
+            self.isUpdating = False
+            if self._update is not None:
+                self._update.finish(UpdateJob.COMPLETED)
+            if self._printer_disconnected:
+                self._printer.connect()
+                self._printer_disconnected = False
+            self._log(reason)
+            if self._job_log is not None:
+                self._job_log.close()
+            self._publish_stage()
+
+    # Move the running update on to stage. Returns False if it is already
+    # over or past that stage.
+    def _advance(self, stage):
+        if not self._update.advance(stage):
+            return False
+        self._log("Entering %s stage" % stage)
+        self._publish_stage()
+        return True
+
+    def _publish_stage(self):
+        self._publish({'isUpdating': self.isUpdating, 'status': "stage",
+                       'stage': self._update.state,
+                       'onStartup': self.updating_on_startup})
+
+    # Send payload to the front-end and as a FirmwareUpdate event, numbered
+    # so clients can tell which changes they missed
+    def _publish(self, payload):
+        request = self._request
+        if request is not None:
+            payload['job'] = request.id
+        payload['sequence'] = self._status.publish(payload)
+        if payload.get('status') in ("inprogress",) + FINAL_STATUSES:
+            self._last_status = payload['status']
+        if payload.get('status') == "error":
+            self._last_error = dict(message=payload.get('message'),
+                                    time=round(time(), 3))
+        self._plugin_manager.send_plugin_message(self._identifier,
+                                                 dict(payload))
+        eventManager().fire(Events.FIRMWARE_UPDATE, payload)
+
+    # Everything a client needs to show the state of the running or last
+    # update: the update stage or, while flashing, the stage of the board
+    # being flashed, its progress, the timings so far and the last error
+    def _status_snapshot(self):
+        jobs = self._jobs.statuses()
+        update = stage = None
+        if self._update is not None:
+            update = self._update.as_dict()
+            stage = self._update.state
+        current = None
+        for job in jobs:
+            if job['state'] == FlashJob.FLASHING or current is None:
+                current = job
+        if current is not None and current['stage'] is not None:
+            stage = current['stage']
+        timings = dict((name, round(value, 3))
+                       for name, value in self._timings.items()
+                       if value is not None)
+        if current is not None:
+            timings.update(current['timings'])
+        ready = self._prefetched_release()
+        request = self._request
+        return dict(sequence=self._status.sequence,
+                    job=request.id if request is not None else None,
+                    queue=self._scheduler.as_dict(),
+                    isUpdating=self.isUpdating, status=self._last_status,
+                    stage=stage, update=update,
+                    port=current['port'] if current else None,
+                    progress=current['progress'] if current else None,
+                    phase=current['phase'] if current else None,
+                    timings=timings, lastError=self._last_error,
+                    ports=jobs, onStartup=self.updating_on_startup,
+                    ready=ready['version'] if ready else None)
+
+    # Add an entry to the log of the running update
+    def _log(self, message, port=None, level="info"):
+        if self._job_log is not None:
+            self._job_log.write(self._update.state, message, port, level)
 
     # Function to distribute the state of updating to OctoPrint's front-end
-    # and to printer_ui in the form of an OctoPrint event
-    def _update_status(self, isUpdating, status=None, message=None):
-        self.isUpdating = isUpdating
-        # Reconnect again after no longer updating
-        if not self.isUpdating:
-            self._printer.connect()
-            if status == "error":
-                self._delete_version_file()
+    # and to printer_ui in the form of an OctoPrint event. Additional payload
+    # fields can be passed in extra.
+    def _update_status(self, isUpdating, status=None, message=None,
+                       extra=None):
+        with self._update_lock:
+            self.isUpdating = isUpdating
+            if status in ("error", "cancelled") and not self._metrics_recorded:
+                self._record_metrics(message=message, outcome=status)
+            # Reconnect again after no longer updating
+            if not self.isUpdating:
+                self._printer.connect()
+                self._printer_disconnected = False
+                if status in ("error", "cancelled"):
+                    self._delete_version_file()
+                elif (status == "completed" and
+                      self._release_version is not None):
+                    self._write_version_file(self._release_version)
 
-        self._plugin_manager.send_plugin_message(self._identifier, dict(
-            isUpdating=self.isUpdating, status=status, message=message,
-            onStartup=self.updating_on_startup))
         payload = {'isUpdating': self.isUpdating,
                    'status': status, 'message': message,
                    'onStartup': self.updating_on_startup}
-        eventManager().fire(Events.FIRMWARE_UPDATE, payload)
+        if extra:
+            payload.update(extra)
+        if status is not None:
+            self._log("Status %s%s" % (status, ": %s" % message
+                                       if message is not None else ""),
+                      level="error" if status == "error" else "info")
+        if not self.isUpdating and self._job_log is not None:
+            self._job_log.close()
+        self._publish(payload)
+        # Coordinators roll out releases and learn how installing them went;
+        # a cancel says nothing about the release
+        if not self.isUpdating and status in FINAL_STATUSES:
+            version, self._release_version = self._release_version, None
+            if version is not None and status != "cancelled":
+                self._fleet_report(version, status, message)
+
+    # Distribute the current flash phase and percentage of a board while it
+    # is still being flashed
+    def _update_progress(self, phase, progress, job):
+        if phase != job.phase:
+            self._log("Phase %s" % phase, port=job.port)
+        job.set_progress(phase, progress)
+        payload = {'isUpdating': self.isUpdating,
+                   'status': "progress", 'phase': phase,
+                   'progress': progress, 'port': job.port,
+                   'onStartup': self.updating_on_startup}
+        self._publish(payload)
 
-    # Remove the build log and firmware file, if there is one
+    # Distribute the outcome of a single board while others are still being
+    # flashed
+    def _update_port_status(self, job):
+        payload = {'isUpdating': self.isUpdating,
+                   'status': "port", 'port': job.port,
+                   'portStatus': job.as_dict(),
+                   'onStartup': self.updating_on_startup}
+        self._publish(payload)
+
+    # Remove the firmware file and differential hex files, if there are any
     def _clean_up(self):
-        if self.build_log is not None:
-            if not self.build_log.closed:
-                self.build_log.close()
+        self.firmware_image = None
         try:
             os.remove(self.firmware_file)
         except OSError:
             self._logger.info("Firmware file could not be deleted")
+        for f in glob(os.path.join(self.firmware_directory,
+                                   self.DIFF_FILE_NAME + "-*")):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
 
     # Create firmware directories, if they don't exist
     def _check_directories(self):
@@ -439,6 +1938,7 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
     # Delete all files inside firmware_directory
     def _delete_firmware_files(self):
         self._logger.info("Wiping firmware directory...")
+        self.firmware_image = None
         filelist = glob(os.path.join(self.firmware_directory, "*.hex"))
         for f in filelist:
             try:
@@ -446,6 +1946,13 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
             except OSError:
                 self._logger.info("Firmware file could not be deleted")
 
+    def _write_version_file(self, version):
+        try:
+            with open(self.version_file, 'w') as f:
+                f.write(version)
+        except (IOError, OSError):
+            self._logger.warn("Error writing version file")
+
     def _delete_version_file(self):
         if os.path.isfile(self.version_file):
             self._logger.info("Removing version file")
@@ -456,8 +1963,7 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
 
     def raise_connection_error(self, e):
         self._logger.info(e)
-        self._update_status(
-            False, "error", "Connection error encountered")
+        self._end_update(UpdateJob.ERROR, "Connection error encountered")
 
     def printer_is_printing(self):
         if self._printer.is_printing() or self._printer.is_paused():
@@ -470,10 +1976,26 @@ class FirmwareUpdatePlugin(octoprint.plugin.StartupPlugin,
                  data_bind="visible: loginState.isAdmin()"),
         ]
 
+    # Long-poll route of the update status, a Tornado handler so waiting
+    # clients don't block the server. Like the status OctoPrint pushes to
+    # its clients it needs the status permission.
+    def status_routes(self, server_routes, *args, **kwargs):
+        from octoprint.access.permissions import Permissions
+        from octoprint.server import app
+        from octoprint.server.util.flask import permission_validator
+        from octoprint.server.util.tornado import access_validation_factory
+        from .statuspoll import StatusPollHandler
+        return [(r"/status/wait", StatusPollHandler, dict(
+            feed=self._status, snapshot=self._status_snapshot,
+            access_validation=access_validation_factory(
+                app, permission_validator, Permissions.STATUS)))]
+
     def increase_upload_bodysize(self, current_max_body_sizes, *args,
                                  **kwargs):
-        # set a maximum body size of 100 MB for plugin archive uploads
-        return [("POST", r"/upload", 100 * 1024 * 1024)]
+        # set a maximum body size of 100 MB for plugin archive uploads and
+        # of 8 MB for a single chunk of a resumable upload
+        return [("POST", r"/upload", MAX_UPLOAD_SIZE),
+                ("POST", r"/upload_chunk", 8 * 1024 * 1024)]
 
 __plugin_name__ = "Firmware Update Plugin"
 
@@ -485,5 +2007,7 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.server.http.bodysize":
-            __plugin_implementation__.increase_upload_bodysize
+            __plugin_implementation__.increase_upload_bodysize,
+        "octoprint.server.http.routes":
+            __plugin_implementation__.status_routes
     }
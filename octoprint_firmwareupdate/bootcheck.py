@@ -0,0 +1,83 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import re
+from time import time
+
+from serial import Serial, SerialException
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+# Value of the FIRMWARE_NAME field of an M115 report, which is followed by
+# further KEY:value fields
+FIRMWARE_NAME_PATTERN = re.compile(r"FIRMWARE_NAME:(.*?)(?:\s+[A-Z_]+:|$)")
+
+# Seconds a read waits for a line and between two M115 requests while the
+# firmware doesn't answer
+READ_TIMEOUT = 0.5
+RESEND_INTERVAL = 2
+
+
+class BootError(IOError):
+    pass
+
+
+def firmware_name(report):
+    match = FIRMWARE_NAME_PATTERN.search(report or "")
+    if match is None:
+        return None
+    return match.group(1).strip()
+
+
+# Firmware name compiled into an image as part of Marlin's M115 report, None
+# if the image holds no report
+def image_firmware_name(data):
+    data = bytes(data)
+    start = data.find(b"FIRMWARE_NAME:")
+    if start < 0:
+        return None
+    end = data.find(b"\x00", start)
+    report = data[start:end if end >= 0 else len(data)]
+    return firmware_name(report.decode("ascii", "replace"))
+
+
+# Check that the board at port boots its firmware. Opening the port resets
+# the board; once Marlin's "start" banner arrives, or every few seconds
+# without one, M115 is sent until the firmware reports itself. Raises
+# BootError if there is no report within timeout seconds, if cancelled
+# returns True or if the firmware isn't named expected. Returns the report.
+def check_boot(port, baudrate=250000, expected=None, timeout=30,
+               cancelled=None, serial_class=Serial):
+    deadline = time() + timeout
+    try:
+        s = serial_class(port, baudrate, timeout=READ_TIMEOUT)
+    except SerialException as e:
+        raise BootError("Could not open %s: %s" % (port, str(e)))
+
+    report = None
+    try:
+        sent = time()
+        while report is None:
+            if cancelled is not None and cancelled():
+                raise BootError("Boot check cancelled")
+            if time() > deadline:
+                raise BootError("Firmware did not start on %s" % port)
+            line = s.readline().decode("ascii", "replace").strip()
+            if line.startswith("start") or time() - sent > RESEND_INTERVAL:
+                s.write(b"M115\n")
+                sent = time()
+            elif line.startswith("FIRMWARE_NAME:"):
+                report = line
+    except SerialException as e:
+        raise BootError("Lost connection to %s: %s" % (port, str(e)))
+    finally:
+        s.close()
+
+    name = firmware_name(report)
+    if expected is not None and name != expected:
+        raise BootError("Board runs %s instead of %s" % (name, expected))
+    return report
@@ -0,0 +1,215 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from time import time
+from threading import RLock
+
+from .hexfile import HexError, parse_hex
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+def file_digest(path, block_size=64 * 1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def release_key(asset):
+    return "release:%s:%s" % (asset.get('id'), asset.get('updated_at'))
+
+
+# Content-addressed store for firmware images. Files are saved once per
+# SHA-256 digest; any number of keys (release assets, uploads) can point at
+# the same digest. Files can also be found by the digest of their parsed
+# image, which stays the same when a file is rewritten. The store is bounded
+# by max_size bytes and evicts the least recently used images first.
+class FirmwareCache(object):
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory, max_size, logger=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._logger = logger
+        self._lock = RLock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self._index = self._load_index()
+
+    # Path of the cached image for key, or None if it isn't cached. Only
+    # lookups with touch, made when the image is actually used, count
+    # towards its recent use; others don't write the index.
+    def get(self, key, touch=False):
+        with self._lock:
+            digest = self._index['keys'].get(key)
+            if digest is None:
+                return None
+            return self.get_digest(digest, touch)
+
+    # Digest of the image key points at, or None
+    def digest_of(self, key):
+        with self._lock:
+            return self._index['keys'].get(key)
+
+    def get_digest(self, digest, touch=False):
+        with self._lock:
+            entry = self._index['files'].get(digest)
+            path = self._path(digest)
+            if entry is None or not os.path.isfile(path):
+                self._forget(digest)
+                return None
+            if touch:
+                entry['last_used'] = time()
+                self._save_index()
+            return path
+
+    # Path of the cached file whose parsed image has the SHA-256 digest, or
+    # None. Image digests missing from the index are worked out once.
+    def get_image(self, digest):
+        with self._lock:
+            found = None
+            changed = False
+            for stored, entry in self._index['files'].items():
+                if 'image' not in entry:
+                    try:
+                        entry['image'] = parse_hex(self._path(stored)).digest
+                    except (IOError, OSError, HexError):
+                        entry['image'] = None
+                    changed = True
+                if entry['image'] == digest:
+                    found = stored
+                    break
+            if changed:
+                self._save_index()
+            return self.get_digest(found) if found is not None else None
+
+    # Copy the file at path into the cache and point key at it. The digest of
+    # its parsed image can be passed in image_digest. Returns the digest of
+    # the stored file.
+    def put(self, path, key=None, digest=None, image_digest=None):
+        if digest is None:
+            digest = file_digest(path)
+        with self._lock:
+            target = self._path(digest)
+            if not os.path.isfile(target):
+                handle, tmp = tempfile.mkstemp(dir=self.directory)
+                os.close(handle)
+                try:
+                    shutil.copyfile(path, tmp)
+                    os.rename(tmp, target)
+                except (IOError, OSError):
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+                    raise
+            entry = dict(size=os.path.getsize(target), last_used=time())
+            previous = self._index['files'].get(digest, {})
+            if image_digest is not None or 'image' in previous:
+                entry['image'] = image_digest or previous['image']
+            self._index['files'][digest] = entry
+            if key is not None:
+                self._index['keys'][key] = digest
+            self._evict(keep=digest)
+            self._save_index()
+        return digest
+
+    # Copy the cached image for key to destination, returning its digest
+    def restore(self, key, destination):
+        with self._lock:
+            path = self.get(key, touch=True)
+            if path is None:
+                return None
+            shutil.copyfile(path, destination)
+            return self._index['keys'].get(key)
+
+    # Remember the most recent release seen so it can be flashed offline.
+    # prefetched marks a release that was downloaded ahead of its update and
+    # hasn't been installed yet.
+    def set_latest(self, key, version, prefetched=False):
+        with self._lock:
+            self._index['latest'] = dict(key=key, version=version,
+                                         prefetched=prefetched)
+            self._save_index()
+
+    def get_latest(self):
+        with self._lock:
+            latest = self._index.get('latest')
+            if latest is None or self.get(latest['key']) is None:
+                return None
+            return dict(latest)
+
+    # The latest release if it was prefetched and hasn't been installed
+    def get_prefetched(self):
+        latest = self.get_latest()
+        if latest is None or not latest.get('prefetched'):
+            return None
+        return latest
+
+    # The latest release is being installed, or other firmware is flashed
+    # that it must not replace
+    def clear_prefetched(self):
+        with self._lock:
+            latest = self._index.get('latest')
+            if latest is not None and latest.get('prefetched'):
+                latest['prefetched'] = False
+                self._save_index()
+
+    def _evict(self, keep=None):
+        files = self._index['files']
+        total = sum(entry['size'] for entry in files.values())
+        for digest in sorted(files, key=lambda d: files[d]['last_used']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            total -= files[digest]['size']
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+            self._forget(digest)
+            if self._logger is not None:
+                self._logger.info("Evicted cached firmware %s" % digest)
+
+    def _forget(self, digest):
+        self._index['files'].pop(digest, None)
+        for key, value in list(self._index['keys'].items()):
+            if value == digest:
+                del self._index['keys'][key]
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + ".hex")
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        index.setdefault('files', {})
+        index.setdefault('keys', {})
+        return index
+
+    def _save_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(self._index, f)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            if self._logger is not None:
+                self._logger.warn("Could not save firmware cache index: %s"
+                                  % str(e))
@@ -0,0 +1,121 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import struct
+import hashlib
+import binascii
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+MAGIC = b"FWDELTA1"
+
+# Magic, SHA-256 of the source and target images and size of the target
+HEADER = struct.Struct(">8s32s32sI")
+COPY = struct.Struct(">cII")
+INSERT = struct.Struct(">cI")
+
+# Length of the source blocks matched against the target
+BLOCK_SIZE = 32
+
+
+class DeltaError(ValueError):
+    pass
+
+
+# Patch that turns the firmware image old into new. The patch is a list of
+# copies of ranges of old and literal inserts, found by matching every
+# block_size block of old against each offset of new, so content that only
+# moved is copied as well.
+def make_patch(old, new, block_size=BLOCK_SIZE):
+    blocks = {}
+    for offset in range(0, len(old) - block_size + 1, block_size):
+        blocks.setdefault(old[offset:offset + block_size], offset)
+
+    ops = []
+    literal_start = 0
+    position = 0
+    while position + block_size <= len(new):
+        source = blocks.get(new[position:position + block_size])
+        if source is None:
+            position += 1
+            continue
+        # Extend the match backwards into the pending literal and forwards
+        # as far as both images agree
+        start = position
+        while (start > literal_start and source > 0 and
+               old[source - 1:source] == new[start - 1:start]):
+            start -= 1
+            source -= 1
+        end = position + block_size
+        source_end = source + (end - start)
+        while (end < len(new) and source_end < len(old) and
+               old[source_end:source_end + 1] == new[end:end + 1]):
+            end += 1
+            source_end += 1
+        if start > literal_start:
+            ops.append(INSERT.pack(b"I", start - literal_start) +
+                       bytes(new[literal_start:start]))
+        ops.append(COPY.pack(b"C", source, end - start))
+        literal_start = position = end
+    if literal_start < len(new):
+        ops.append(INSERT.pack(b"I", len(new) - literal_start) +
+                   bytes(new[literal_start:]))
+
+    header = HEADER.pack(MAGIC, hashlib.sha256(old).digest(),
+                         hashlib.sha256(new).digest(), len(new))
+    return header + b"".join(ops)
+
+
+# Hex SHA-256 digests of the image a patch applies to and of its result
+def patch_digests(patch):
+    if len(patch) < HEADER.size:
+        raise DeltaError("Patch is truncated")
+    magic, source, target, _ = HEADER.unpack_from(patch)
+    if magic != MAGIC:
+        raise DeltaError("Not a firmware patch")
+    return _hex(source), _hex(target)
+
+
+# Apply patch to the image old. Raises DeltaError if the patch
+# doesn't belong to old or its result doesn't match the expected digest.
+def apply_patch(old, patch):
+    source, target = patch_digests(patch)
+    if hashlib.sha256(old).hexdigest() != source:
+        raise DeltaError("Patch is for a different firmware")
+    size = HEADER.unpack_from(patch)[3]
+
+    parts = []
+    offset = HEADER.size
+    try:
+        while offset < len(patch):
+            op = patch[offset:offset + 1]
+            if op == b"C":
+                _, start, length = COPY.unpack_from(patch, offset)
+                offset += COPY.size
+                if start + length > len(old):
+                    raise DeltaError("Patch copies beyond the firmware")
+                parts.append(old[start:start + length])
+            elif op == b"I":
+                _, length = INSERT.unpack_from(patch, offset)
+                offset += INSERT.size
+                if offset + length > len(patch):
+                    raise DeltaError("Patch is truncated")
+                parts.append(patch[offset:offset + length])
+                offset += length
+            else:
+                raise DeltaError("Unknown patch operation")
+    except struct.error:
+        raise DeltaError("Patch is truncated")
+
+    new = b"".join(parts)
+    if len(new) != size or hashlib.sha256(new).hexdigest() != target:
+        raise DeltaError("Patched firmware doesn't match its digest")
+    return new
+
+
+def _hex(digest):
+    return binascii.hexlify(digest).decode("ascii")
@@ -0,0 +1,197 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+import hashlib
+from glob import glob
+
+import requests
+
+from .cache import file_digest
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+# Errors that interrupt a transfer and are worth resuming after
+TRANSFER_ERRORS = (requests.exceptions.ConnectionError,
+                   requests.exceptions.ChunkedEncodingError,
+                   requests.exceptions.Timeout)
+
+
+class DownloadError(IOError):
+    pass
+
+
+class DownloadStopped(DownloadError):
+    pass
+
+
+# SHA-256 a release asset announces for its file, or None. The fleet
+# coordinator sends sha256, GitHub a digest of the form "sha256:<hex>".
+def asset_digest(asset):
+    if asset.get('sha256'):
+        return asset['sha256'].lower()
+    digest = asset.get('digest') or ""
+    if digest.startswith("sha256:"):
+        return digest[len("sha256:"):].lower()
+    return None
+
+
+# SHA-256 of the parsed image of a release asset's file, or None. The fleet
+# coordinator sends image_sha256; release builds on GitHub put it in the
+# label of the firmware asset as "image-sha256:<hex>".
+def asset_image_digest(asset):
+    if asset.get('image_sha256'):
+        return asset['image_sha256'].lower()
+    label = asset.get('label') or ""
+    if label.startswith("image-sha256:"):
+        return label[len("image-sha256:"):].lower()
+    return None
+
+
+# Downloads files over one pooled session. Data goes to a .part file next
+# to the destination that survives interruptions: the next attempt, or the
+# next download of the same URL, continues it with a Range request. Once
+# the size and digest are verified the file is renamed into place, so the
+# destination never holds a partial download.
+class Downloader(object):
+
+    def __init__(self, session=None, chunk_size=16 * 1024, retries=3,
+                 timeout=27):
+        self.session = session if session is not None else requests.Session()
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+    # Download url to path and return the SHA-256 of the file. size and
+    # digest are checked if given; a file larger than max_size bytes is
+    # refused with DownloadError. stop is polled before the first request,
+    # after every chunk and before every retry and raises DownloadStopped
+    # when it returns True, keeping the partial file. on_block is called
+    # with the number of bytes received so far, first when a transfer
+    # starts with those a resumed download starts from.
+    def download(self, url, path, size=None, digest=None, stop=None,
+                 on_block=None, timeout=None, max_size=None):
+        part = "%s.%s.part" % (
+            path, hashlib.sha1(url.encode("utf-8")).hexdigest()[:12])
+        self._remove_stale(path, part)
+        if stop is not None and stop():
+            raise DownloadStopped("Download stopped")
+
+        attempt = 0
+        while True:
+            try:
+                total = self._transfer(url, part, stop, on_block,
+                                       timeout or self.timeout, max_size)
+                break
+            except TRANSFER_ERRORS:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                if stop is not None and stop():
+                    raise DownloadStopped("Download stopped")
+
+        received = os.path.getsize(part)
+        if ((total is not None and received != total) or
+                (size is not None and received != size)):
+            self._remove(part)
+            raise DownloadError("Downloaded %d bytes, expected %d"
+                                % (received, size if size is not None
+                                   else total))
+        actual = file_digest(part)
+        if digest is not None and actual != digest:
+            self._remove(part)
+            raise DownloadError("Download doesn't match its digest")
+        os.rename(part, path)
+        return actual
+
+    # Fetch url into part, continuing a previous partial transfer. Returns
+    # the full size announced by the server, if any.
+    def _transfer(self, url, part, stop, on_block, timeout, max_size=None):
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        # Sizes and ranges refer to the file itself, not a compressed form
+        headers = {'Accept-Encoding': "identity"}
+        if offset:
+            headers['Range'] = "bytes=%d-" % offset
+        r = self.session.get(url, headers=headers, stream=True,
+                             timeout=timeout)
+        try:
+            if r.status_code == 416 and offset:
+                # The part is complete already, or stale and has to go
+                total = _content_range_total(r.headers.get('Content-Range'))
+                if total == offset:
+                    return total
+                self._remove(part)
+                return self._transfer(url, part, stop, on_block, timeout,
+                                      max_size)
+            r.raise_for_status()
+
+            if r.status_code == 206:
+                match = CONTENT_RANGE_PATTERN.match(
+                    r.headers.get('Content-Range', ""))
+                if match is None or int(match.group(1)) != offset:
+                    raise DownloadError("Unexpected content range")
+                total = _content_range_total(r.headers['Content-Range'])
+                mode = "ab"
+            else:
+                total = r.headers.get('Content-Length')
+                total = int(total) if total is not None else None
+                offset = 0
+                mode = "wb"
+
+            if max_size is not None and total is not None and \
+                    total > max_size:
+                self._remove(part)
+                raise DownloadError("File of %d bytes is larger than %d"
+                                    % (total, max_size))
+            if on_block is not None:
+                on_block(offset)
+            with open(part, mode) as f:
+                for block in r.iter_content(self.chunk_size):
+                    if stop is not None and stop():
+                        raise DownloadStopped("Download stopped")
+                    f.write(block)
+                    offset += len(block)
+                    if max_size is not None and offset > max_size:
+                        f.close()
+                        self._remove(part)
+                        raise DownloadError("File is larger than %d bytes"
+                                            % max_size)
+                    if on_block is not None:
+                        on_block(offset)
+            return total
+        finally:
+            r.close()
+
+    # Partial files of earlier downloads to path from other URLs
+    def _remove_stale(self, path, part):
+        for other in glob(_glob_escape(path) + ".*.part"):
+            if other != part:
+                self._remove(other)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _glob_escape(path):
+    return re.sub(r"([*?[])", r"[\1]", path)
+
+
+def _content_range_total(header):
+    match = CONTENT_RANGE_PATTERN.match(header or "")
+    if match is None:
+        match = re.match(r"^bytes \*/(\d+)$", header or "")
+        return int(match.group(1)) if match is not None else None
+    if match.group(3) == "*":
+        return None
+    return int(match.group(3))
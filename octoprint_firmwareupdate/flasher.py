@@ -0,0 +1,176 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import signal
+from time import sleep, time
+from subprocess import Popen, PIPE, STDOUT
+from threading import Event, Lock
+
+from serial import Serial, SerialException
+
+from .monitor import AvrdudeMonitor
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+# Base class of the flasher engines. flash() blocks until the board has been
+# programmed with firmware_file, or with its already parsed image if given.
+# The outcome is left in result/message/completion_time and passed to
+# on_result as soon as it is known, together with the seconds spent in the
+# reset, write and verify stages in timings. Without verify the flash is not
+# read back after writing. Progress is reported through
+# on_progress(phase, percent), at most once per progress_interval seconds
+# except for phase changes and completed phases.
+class Flasher(object):
+
+    # Outcomes passed to on_result
+    COMPLETED = AvrdudeMonitor.COMPLETED
+    ERROR = AvrdudeMonitor.ERROR
+    TIMEOUT = AvrdudeMonitor.TIMEOUT
+    CANCELLED = "cancelled"
+
+    # Phases passed to on_progress
+    PHASE_READING = AvrdudeMonitor.PHASE_READING
+    PHASE_WRITING = AvrdudeMonitor.PHASE_WRITING
+    PHASE_VERIFYING = AvrdudeMonitor.PHASE_VERIFYING
+
+    def __init__(self, on_result=None, on_progress=None,
+                 progress_interval=0.2, baudrate=250000, verify=True):
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.baudrate = baudrate
+        self.verify = verify
+        self.result = None
+        self.message = None
+        self.completion_time = 0
+        self.timings = {}
+        self._cancelled = Event()
+        self._resolve_lock = Lock()
+        self._last_progress = None
+        self._phase = None
+
+    def flash(self, port, firmware_file, build_log=None, image=None):
+        raise NotImplementedError()
+
+    # Stop the flash and report it as cancelled. Engines return from this
+    # once they no longer hold the port.
+    def cancel(self):
+        self._cancelled.set()
+        self._resolve(self.CANCELLED, "Update cancelled.")
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    # Report the outcome, unless another one has already been reported
+    def _resolve(self, result, message=None):
+        with self._resolve_lock:
+            if self.result is not None:
+                return
+            self.result = result
+            self.message = message
+        if self.on_result is not None:
+            self.on_result(self)
+
+    def _progress(self, phase, percent):
+        if self.on_progress is None or self.result is not None:
+            return
+        now = time()
+        if (phase != self._phase or percent >= 100 or
+                self._last_progress is None or
+                now - self._last_progress >= self.progress_interval):
+            self._phase = phase
+            self._last_progress = now
+            self.on_progress(phase, percent)
+
+
+# Flashes through an avrdude subprocess and reads the outcome from its output
+class AvrdudeFlasher(Flasher):
+
+    def __init__(self, working_directory, **kwargs):
+        Flasher.__init__(self, **kwargs)
+        self.working_directory = working_directory
+        self.process = None
+
+    def flash(self, port, firmware_file, build_log=None, image=None):
+        if self.cancelled:
+            self._resolve(self.CANCELLED, "Update cancelled.")
+            return self.result
+        try:
+            s = Serial(port, 115200)
+        except SerialException as e:
+            self._resolve(self.ERROR, str(e))
+            return self.result
+
+        # Pulse connection to ensure avrdude can make a connection
+        start = time()
+        try:
+            s.setDTR(False)
+            sleep(0.1)
+            s.setDTR(True)
+        except (IOError, SerialException):
+            # Ports without modem control lines (e.g. a pty) can't be reset
+            pass
+        finally:
+            s.close()
+        self.timings['reset'] = time() - start
+        if self.cancelled:
+            self._resolve(self.CANCELLED, "Update cancelled.")
+            return self.result
+
+        command = ["avrdude", "-p", "m2560", "-P", port,
+                   "-c", "stk500v2", "-b", str(self.baudrate), "-D"]
+        if not self.verify:
+            command.append("-V")
+        command += ["-U", "flash:w:%s:i" % firmware_file]
+        self.process = Popen(command,
+                             cwd=self.working_directory,
+                             stdout=PIPE,
+                             stderr=STDOUT,
+                             preexec_fn=os.setsid)
+        monitor = AvrdudeMonitor(self.process, build_log,
+                                 on_result=self._on_monitor_result,
+                                 on_progress=self._progress,
+                                 progress_interval=0, verify=self.verify)
+        monitor.run()
+        # avrdude exits as soon as it is killed, possibly before cancel()
+        # got to report the outcome
+        if self.cancelled:
+            self._resolve(self.CANCELLED, "Update cancelled.")
+        return self.result
+
+    def cancel(self):
+        self._cancelled.set()
+        self._kill()
+        Flasher.cancel(self)
+
+    def _on_monitor_result(self, monitor):
+        self.completion_time = monitor.completion_time
+        self.timings['write'] = monitor.timings.get(monitor.PHASE_WRITING)
+        self.timings['verify'] = monitor.timings.get(monitor.PHASE_VERIFYING)
+        if monitor.result == AvrdudeMonitor.TIMEOUT:
+            self._kill()
+        if self.cancelled:
+            return
+        self._resolve(monitor.result, monitor.message)
+
+    # avrdude runs in its own session; terminate its whole process group and
+    # kill whatever is left of it after a grace period
+    def _kill(self, grace=1):
+        if self.process is None:
+            return
+        try:
+            pgid = os.getpgid(self.process.pid)
+            os.killpg(pgid, signal.SIGTERM)
+            deadline = time() + grace
+            while self.process.poll() is None and time() < deadline:
+                sleep(0.05)
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError:
+            pass
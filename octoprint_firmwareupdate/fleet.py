@@ -0,0 +1,205 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+import json
+import hashlib
+from time import time
+from threading import Lock
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Statuses of the FirmwareUpdate event that end an update on a peer
+FINAL_STATUSES = ("completed", "error", "cancelled")
+
+
+# Byte range (start, end inclusive) requested by a Range header for a file
+# of size bytes. Returns None to send the whole file and raises ValueError
+# for ranges that can't be satisfied.
+def parse_range(header, size):
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+# Blocks of a file between start and end inclusive
+def read_range(path, start, end, block_size=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+# Rollout of one release to the peers of a fleet in waves. The first
+# canary peers to ask get the release first; after that each wave opens the
+# release to a larger percentage of peers, chosen by a hash of their id.
+# The next wave opens once every peer allowed so far reported success, and
+# the rollout halts as soon as max_failures peers reported a failure.
+class Rollout(object):
+
+    RUNNING = "running"
+    HALTED = "halted"
+    FINISHED = "finished"
+
+    def __init__(self, key, version, digest, size, canary=1,
+                 waves=(10, 50, 100), max_failures=1, state=None,
+                 image_digest=None):
+        self.key = key
+        self.version = version
+        self.digest = digest
+        self.size = size
+        # Digest of the parsed image, which peers check patched releases
+        # against
+        self.image_digest = image_digest
+        self.canary = canary
+        self.waves = sorted(waves)
+        self.max_failures = max_failures
+        self.state = self.RUNNING
+        self.wave = 0
+        self.started = time()
+        # Peers by id with their wave, whether they were allowed to update
+        # and what they reported
+        self.peers = {}
+        if state is not None:
+            self.__dict__.update(state)
+
+    # Whether peer may install the release now; registers unknown peers
+    def allow(self, peer):
+        entry = self.peers.get(peer)
+        if entry is None:
+            entry = self.peers[peer] = dict(wave=self._wave_of(peer),
+                                            allowed=False, status=None,
+                                            message=None, seen=time())
+        entry['seen'] = time()
+        if self.state == self.HALTED:
+            return False
+        if entry['wave'] > self.wave and self._wave_done():
+            # Waves no peer has asked for are skipped, up to the first one
+            # with a peer waiting
+            self.wave = min(other['wave'] for other in self.peers.values()
+                            if other['wave'] > self.wave)
+        if entry['wave'] > self.wave:
+            return False
+        entry['allowed'] = True
+        return True
+
+    # Take the outcome of an update on peer into account
+    def report(self, peer, version, status, message=None):
+        entry = self.peers.get(peer)
+        if entry is None or not entry['allowed'] or version != self.version:
+            return
+        entry['status'] = status
+        entry['message'] = message
+        entry['seen'] = time()
+        failures = sum(1 for other in self.peers.values()
+                       if other['status'] in ("error", "cancelled"))
+        if failures >= self.max_failures:
+            self.state = self.HALTED
+            return
+        if self._wave_done():
+            if self.wave < len(self.waves):
+                self.wave += 1
+            elif self.state == self.RUNNING:
+                self.state = self.FINISHED
+
+    # Whether every peer allowed so far installed the release
+    def _wave_done(self):
+        return all(entry['status'] == "completed"
+                   for entry in self.peers.values() if entry['allowed'])
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    # Wave 0 holds the canaries, wave i the peers whose hash falls below the
+    # i-th percentage
+    def _wave_of(self, peer):
+        canaries = sum(1 for entry in self.peers.values()
+                       if entry['wave'] == 0)
+        if canaries < self.canary:
+            return 0
+        bucket = int(hashlib.sha1(peer.encode("utf-8")).hexdigest(), 16) % 100
+        for index, percentage in enumerate(self.waves):
+            if bucket < percentage:
+                return index + 1
+        return len(self.waves)
+
+
+# The rollout of a coordinator, kept in a JSON file across restarts
+class RolloutStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self.rollout = self._load()
+
+    def start(self, rollout):
+        with self._lock:
+            self.rollout = rollout
+            self._save()
+
+    def halt(self):
+        with self._lock:
+            if self.rollout is not None:
+                self.rollout.state = Rollout.HALTED
+                self._save()
+
+    def allow(self, peer):
+        with self._lock:
+            if self.rollout is None:
+                return False
+            allowed = self.rollout.allow(peer)
+            self._save()
+            return allowed
+
+    def report(self, peer, version, status, message=None):
+        with self._lock:
+            if self.rollout is not None:
+                self.rollout.report(peer, version, status, message)
+                self._save()
+
+    def status(self):
+        with self._lock:
+            if self.rollout is None:
+                return None
+            return self.rollout.as_dict()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            return Rollout(state['key'], state['version'], state['digest'],
+                           state['size'], state=state)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save(self):
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.rollout.as_dict(), f)
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError):
+            pass
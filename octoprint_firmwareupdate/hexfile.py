@@ -0,0 +1,153 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import binascii
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+# Flash page size of the ATmega2560
+PAGE_SIZE = 256
+
+
+# Flash size of the ATmega2560, including the bootloader section
+FLASH_SIZE = 256 * 1024
+
+
+class HexError(ValueError):
+    pass
+
+
+# Parsed form of a firmware file, shared by the flash, cache and verify
+# steps: the flat binary image (unprogrammed bytes are 0xFF, like erased
+# flash), the pages that hold data from the file and the SHA-256 of the image
+class FirmwareImage(object):
+
+    def __init__(self, data, pages, page_size=PAGE_SIZE):
+        self.data = data
+        self.pages = pages
+        self.page_size = page_size
+        self.digest = hashlib.sha256(bytes(data)).hexdigest()
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+# Validate an Intel HEX file line by line and build its image. Raises
+# HexError on malformed or truncated files, on data outside the flash and
+# on files that aren't text at all.
+def parse_hex(path, flash_size=FLASH_SIZE, page_size=PAGE_SIZE):
+    image = bytearray(b"\xff") * flash_size
+    used = bytearray(flash_size // page_size)
+    end = 0
+    base = 0
+    eof = False
+    # Read as bytes, so stray binary content is reported as invalid hex
+    # digits instead of failing to decode
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(b":"):
+                raise HexError("Line %d: missing start code" % number)
+            try:
+                record = bytearray(binascii.unhexlify(line[1:]))
+            except (TypeError, ValueError):
+                raise HexError("Line %d: invalid hex digits" % number)
+            if len(record) < 5 or record[0] != len(record) - 5:
+                raise HexError("Line %d: record length mismatch" % number)
+            if sum(record) & 0xFF:
+                raise HexError("Line %d: checksum mismatch" % number)
+
+            length = record[0]
+            record_type = record[3]
+            if record_type == 0x00:
+                start = base + ((record[1] << 8) | record[2])
+                if start + length > flash_size:
+                    raise HexError("Line %d: address 0x%05X is outside the "
+                                   "flash" % (number, start + length - 1))
+                image[start:start + length] = record[4:4 + length]
+                if length:
+                    used[start // page_size:
+                         (start + length - 1) // page_size + 1] = \
+                        b"\x01" * ((start + length - 1) // page_size -
+                                   start // page_size + 1)
+                    end = max(end, start + length)
+            elif record_type == 0x01:
+                eof = True
+                break
+            elif record_type in (0x02, 0x04):
+                if length != 2:
+                    raise HexError("Line %d: invalid address record" % number)
+                segment = (record[4] << 8) | record[5]
+                base = segment << 4 if record_type == 0x02 else segment << 16
+            elif record_type not in (0x03, 0x05):
+                raise HexError("Line %d: unknown record type %02X"
+                               % (number, record_type))
+
+    if not eof:
+        raise HexError("File is truncated, end of file record missing")
+    if end == 0:
+        raise HexError("File contains no data")
+    pages = [page for page, flag in enumerate(used) if flag]
+    return FirmwareImage(image[:end], pages, page_size)
+
+
+# Read an Intel HEX file into a flat image
+def read_hex(path):
+    return parse_hex(path).data
+
+
+# Write the given pages of image to path as Intel HEX. Pages that are left
+# out are not touched by avrdude when flashing without a chip erase.
+def write_hex(path, image, pages, page_size=PAGE_SIZE):
+    with open(path, "w") as f:
+        segment = None
+        for page in sorted(pages):
+            start = page * page_size
+            data = image[start:start + page_size]
+            data = data + bytearray(b"\xff" * (page_size - len(data)))
+            for offset in range(0, page_size, 16):
+                address = start + offset
+                if address >> 16 != segment:
+                    segment = address >> 16
+                    f.write(_record(0, 0x04, bytearray(
+                        [(segment >> 8) & 0xFF, segment & 0xFF])))
+                f.write(_record(address & 0xFFFF, 0x00,
+                                data[offset:offset + 16]))
+        f.write(_record(0, 0x01, bytearray()))
+
+
+# Page numbers whose content differs between the two images
+def diff_pages(old, new, page_size=PAGE_SIZE):
+    length = max(len(old), len(new))
+    changed = []
+    for page in range((length + page_size - 1) // page_size):
+        start = page * page_size
+        if (_page(old, start, page_size) !=
+                _page(new, start, page_size)):
+            changed.append(page)
+    return changed
+
+
+def page_count(image, page_size=PAGE_SIZE):
+    return (len(image) + page_size - 1) // page_size
+
+
+def _page(image, start, page_size):
+    data = image[start:start + page_size]
+    return bytes(data + bytearray(b"\xff" * (page_size - len(data))))
+
+
+def _record(address, record_type, data):
+    record = bytearray([len(data), (address >> 8) & 0xFF, address & 0xFF,
+                        record_type]) + data
+    checksum = (-sum(record)) & 0xFF
+    return ":%s%02X\n" % (
+        binascii.hexlify(bytes(record)).decode("ascii").upper(), checksum)
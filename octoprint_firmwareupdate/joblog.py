@@ -0,0 +1,211 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+import json
+from time import time, strftime
+from threading import Lock
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+LOG_ID_PATTERN = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9]+$")
+
+# Bytes read from the end of a log to find its last entry
+TAIL_SIZE = 4096
+
+
+# Log of one update as JSON lines, each with a timestamp, the stage the
+# update was in and optionally the port it concerns. Entries beyond max_size
+# bytes are dropped.
+class JobLog(object):
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.id = os.path.basename(path)[:-len(".jsonl")]
+        self.max_size = max_size
+        self.size = 0
+        self._lock = Lock()
+        self.closed = False
+
+    def write(self, stage, message, port=None, level="info"):
+        entry = dict(time=round(time(), 3), stage=stage, level=level,
+                     message=message)
+        if port is not None:
+            entry['port'] = port
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self.closed:
+                return
+            if self.max_size and self.size + len(line) > self.max_size:
+                if self.size <= self.max_size:
+                    line = json.dumps(dict(time=entry['time'], stage=stage,
+                                           level="warning",
+                                           message="Log truncated")) + "\n"
+                    self.size = self.max_size + 1
+                else:
+                    return
+            else:
+                self.size += len(line)
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(line.encode("utf-8"))
+            except (IOError, OSError):
+                pass
+
+    # File-like object that turns flasher output into entries of port
+    def stream(self, port, stage, raw=None):
+        return LogStream(self, port, stage, raw)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+
+
+# Collects flasher output written in arbitrary chunks and logs every
+# complete line. avrdude redraws progress bars with carriage returns, only
+# the final redraw of a line is logged. The output is also copied to raw.
+class LogStream(object):
+
+    def __init__(self, log, port, stage, raw=None):
+        self.log = log
+        self.port = port
+        # Called for the stage of each line
+        self.stage = stage
+        self.raw = raw
+        self._pending = b""
+
+    def write(self, data):
+        if self.raw is not None:
+            self.raw.write(data)
+        self._pending += data
+        lines = self._pending.split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self._log_line(line)
+
+    def flush(self):
+        if self.raw is not None:
+            self.raw.flush()
+
+    def close(self):
+        if self._pending:
+            self._log_line(self._pending)
+            self._pending = b""
+        if self.raw is not None:
+            self.raw.close()
+
+    def _log_line(self, line):
+        text = line.rstrip(b"\r").split(b"\r")[-1].decode("utf-8", "replace")
+        if text.strip():
+            self.log.write(self.stage(), text.rstrip(), port=self.port,
+                           level="output")
+
+
+# Size capped store of update logs. Once the logs take up more than max_size
+# bytes the oldest ones are removed, never the one still being written.
+class JobLogStore(object):
+
+    def __init__(self, directory, max_size=2 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = Lock()
+        self._current = None
+        self._counter = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def create(self):
+        with self._lock:
+            self._rotate()
+            self._counter += 1
+            log_id = "%s-%d" % (strftime("%Y%m%d-%H%M%S"), self._counter)
+            self._current = JobLog(self._path(log_id), self.max_size // 2)
+            return self._current
+
+    # Complete entries after byte offset of log log_id and the offset to ask
+    # for next. A partially written last line is left for the next call.
+    def tail(self, log_id, offset=0, limit=64 * 1024):
+        path = self._path(log_id)
+        entries = []
+        with open(path, "rb") as f:
+            f.seek(max(0, offset))
+            data = f.read(limit)
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entries.append(json.loads(line.decode("utf-8")))
+            except ValueError:
+                pass
+        return entries, max(0, offset) + end
+
+    # The stored logs, newest first, with their first and last entries
+    def history(self):
+        logs = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            log_id = name[:-len(".jsonl")]
+            if not name.endswith(".jsonl") or not LOG_ID_PATTERN.match(
+                    log_id):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                first, last = self._ends(path)
+                size = os.path.getsize(path)
+            except (IOError, OSError):
+                continue
+            logs.append(dict(
+                id=log_id, size=size,
+                started=first.get('time') if first else None,
+                last=last,
+                running=(self._current is not None and
+                         self._current.id == log_id and
+                         not self._current.closed)))
+        return logs
+
+    def is_valid(self, log_id):
+        return bool(LOG_ID_PATTERN.match(log_id or "")) and \
+            os.path.isfile(self._path(log_id))
+
+    def _ends(self, path):
+        with open(path, "rb") as f:
+            first = f.readline()
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - TAIL_SIZE))
+            lines = f.read().splitlines()
+        return self._parse(first), self._parse(lines[-1] if lines else b"")
+
+    @staticmethod
+    def _parse(line):
+        try:
+            return json.loads(line.decode("utf-8"))
+        except ValueError:
+            return None
+
+    def _rotate(self):
+        paths = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".jsonl"):
+                path = os.path.join(self.directory, name)
+                try:
+                    paths.append((os.path.getmtime(path),
+                                  os.path.getsize(path), path))
+                except OSError:
+                    pass
+        total = sum(size for _, size, _ in paths)
+        for _, size, path in sorted(paths):
+            if total <= self.max_size:
+                break
+            if self._current is not None and path == self._current.path:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def _path(self, log_id):
+        return os.path.join(self.directory, log_id + ".jsonl")
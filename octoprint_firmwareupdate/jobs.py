@@ -0,0 +1,255 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from time import time
+from threading import Thread, Event, Lock, BoundedSemaphore
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+# One run of the update pipeline. The state only moves forward through the
+# stages and ends in exactly one of the final states; cancel() ends it from
+# any stage. Workers check the return value of advance() and stop once the
+# update is over.
+class UpdateJob(object):
+
+    PENDING = "pending"
+    LOOKUP = "lookup"
+    DOWNLOAD = "download"
+    FLASHING = "flashing"
+    COMPLETED = "completed"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+    STAGES = (PENDING, LOOKUP, DOWNLOAD, FLASHING)
+    FINAL = (COMPLETED, ERROR, CANCELLED)
+
+    def __init__(self, deadlines=None):
+        # Seconds each stage may take, by stage name
+        self.deadlines = dict(deadlines or {})
+        self.state = self.PENDING
+        self.started = time()
+        self.stage_started = self.started
+        self._cancelled = Event()
+        self._lock = Lock()
+
+    @property
+    def done(self):
+        return self.state in self.FINAL
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    # Move on to stage. Returns False if the update is already over or past
+    # that stage.
+    def advance(self, stage):
+        with self._lock:
+            if (self.done or self.STAGES.index(stage) <=
+                    self.STAGES.index(self.state)):
+                return False
+            self.state = stage
+            self.stage_started = time()
+            return True
+
+    # End the update in state. Returns False if it had already ended.
+    def finish(self, state):
+        with self._lock:
+            if self.done:
+                return False
+            self.state = state
+            return True
+
+    def cancel(self):
+        self._cancelled.set()
+        return self.finish(self.CANCELLED)
+
+    # Sleep for seconds or until the update is cancelled. Returns True if it
+    # was cancelled.
+    def wait(self, seconds):
+        return self._cancelled.wait(seconds)
+
+    def deadline(self, stage):
+        return self.deadlines.get(stage)
+
+    # Whether the current stage has run longer than its deadline
+    def expired(self):
+        deadline = self.deadlines.get(self.state)
+        return bool(deadline) and time() - self.stage_started > deadline
+
+    def as_dict(self):
+        return dict(state=self.state,
+                    elapsed=round(time() - self.started, 2))
+
+
+# Flash of one board: its port, what to write to it and how it went. Each
+# job has its own flasher, build log and timeouts.
+class FlashJob(object):
+
+    QUEUED = "queued"
+    FLASHING = "flashing"
+    COMPLETED = "completed"
+    ERROR = "error"
+
+    # Stage of the flash during each flasher phase; before the first phase
+    # is reported the board is being reset and synchronized with. Booting
+    # is the check that the flashed firmware starts.
+    RESET = "reset"
+    PROGRAM = "program"
+    VERIFY = "verify"
+    BOOT = "boot"
+    STAGES = {None: RESET, "reading": RESET, "writing": PROGRAM,
+              "verifying": VERIFY, "booting": BOOT}
+
+    def __init__(self, port, filename, image, flash_stats=None):
+        self.port = port
+        # Hex file and parsed image to write; for differential flashes these
+        # only hold the changed pages
+        self.filename = filename
+        self.image = image
+        # Bytes written and in the full image for differential flashes
+        self.flash_stats = flash_stats
+        self.state = self.QUEUED
+        self.phase = None
+        self.progress = None
+        self.message = None
+        self.completion_time = 0
+        # Seconds the flashed firmware took to report itself
+        self.boot_time = None
+        # Baud rate of the current attempt, the attempts left after it and
+        # the failed outcome that asks for another attempt
+        self.baudrate = None
+        self.retries = 0
+        self.retry_result = None
+        self.flasher = None
+        self.build_log = None
+        self.cancelled = False
+        self.timed_out = False
+        # Stage that ran out of time, None if the whole flash did
+        self.timeout_stage = None
+        self.started = None
+        self.stage_started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.state in (self.COMPLETED, self.ERROR)
+
+    @property
+    def stage(self):
+        return self.STAGES.get(self.phase, self.RESET)
+
+    def set_progress(self, phase, progress):
+        if phase != self.phase:
+            self.stage_started = time()
+        self.phase = phase
+        self.progress = progress
+
+    def cancel(self):
+        self.cancelled = True
+        if self.flasher is not None:
+            self.flasher.cancel()
+
+    # Seconds spent in each flash stage so far
+    @property
+    def timings(self):
+        timings = {}
+        if self.flasher is not None:
+            timings.update(self.flasher.timings)
+        if self.boot_time is not None:
+            timings['boot'] = self.boot_time
+        return dict((stage, round(value, 3))
+                    for stage, value in timings.items() if value is not None)
+
+    def as_dict(self):
+        return dict(port=self.port, state=self.state, phase=self.phase,
+                    stage=self.stage if self.state == self.FLASHING else None,
+                    progress=self.progress, message=self.message,
+                    completionTime=round(self.completion_time, 2),
+                    timings=self.timings)
+
+
+# Runs flash jobs in parallel, at most max_concurrent at a time. A job that
+# takes longer than timeout seconds, or whose reset, program or verify stage
+# takes longer than given in stage_timeouts, is cancelled.
+class FlashJobManager(object):
+
+    # Seconds between two deadline checks
+    WATCH_INTERVAL = 0.25
+
+    def __init__(self, max_concurrent=1, timeout=None, stage_timeouts=None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.timeout = timeout
+        self.stage_timeouts = dict(stage_timeouts or {})
+        self.jobs = []
+        self._lock = Lock()
+        self._finished = Event()
+
+    # Run target(job) for every job and block until all of them returned
+    def run(self, jobs, target):
+        with self._lock:
+            self.jobs = list(jobs)
+        slots = BoundedSemaphore(self.max_concurrent)
+        threads = []
+        for job in jobs:
+            thread = Thread(target=self._run_job, args=(job, target, slots))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        self._finished.clear()
+        watchdog = Thread(target=self._watch)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self._finished.set()
+
+    # Cancel every job that has not finished yet
+    def cancel_all(self):
+        with self._lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            if not job.done:
+                job.cancel()
+
+    # Mark job as done. Returns True once every job of the run is done.
+    def finish(self, job, state):
+        with self._lock:
+            if job.done:
+                return False
+            job.state = state
+            job.finished = time()
+            return all(other.done for other in self.jobs)
+
+    def statuses(self):
+        with self._lock:
+            return [job.as_dict() for job in self.jobs]
+
+    def _run_job(self, job, target, slots):
+        with slots:
+            job.started = job.stage_started = time()
+            job.state = FlashJob.FLASHING
+            target(job)
+
+    def _watch(self):
+        while not self._finished.wait(self.WATCH_INTERVAL):
+            now = time()
+            for job in list(self.jobs):
+                if job.state != FlashJob.FLASHING or job.timed_out:
+                    continue
+                stage_timeout = self.stage_timeouts.get(job.stage)
+                if stage_timeout and now - job.stage_started > stage_timeout:
+                    self._expire(job, job.stage)
+                elif self.timeout and now - job.started > self.timeout:
+                    self._expire(job)
+
+    def _expire(self, job, stage=None):
+        job.timed_out = True
+        job.timeout_stage = stage
+        job.cancel()
@@ -0,0 +1,184 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import json
+from time import time
+from collections import deque
+from threading import Lock
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+# Stages timed for every update, in pipeline order
+STAGES = ("lookup", "download", "decode", "reset", "write", "verify", "boot",
+          "total")
+
+# Upper bounds in seconds of the stage duration histogram buckets
+BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+
+# Persistent flash metrics: the last capacity update records in a ring
+# buffer plus cumulative counters and histograms that survive the buffer
+# wrapping around, all kept in one small JSON file.
+class FlashMetrics(object):
+
+    def __init__(self, path, capacity=200):
+        self.path = path
+        self._lock = Lock()
+        self.records = deque(maxlen=capacity)
+        self.outcomes = {}
+        self.bytes = 0
+        # Download bytes saved by delta updates
+        self.saved = 0
+        self.histograms = dict((stage, dict(buckets=[0] * len(BUCKETS),
+                                            sum=0.0, count=0))
+                               for stage in STAGES)
+        self._load()
+
+    # Add the record of one update. timings maps stage names to seconds,
+    # saved is the number of download bytes a delta update saved.
+    def add(self, outcome, timings, port=None, engine=None, size=0,
+            reason=None, saved=0):
+        record = dict(time=round(time(), 3), port=port, engine=engine,
+                      outcome=outcome, reason=reason, bytes=size,
+                      saved=saved,
+                      timings=dict((stage, round(value, 3))
+                                   for stage, value in timings.items()
+                                   if stage in STAGES and value is not None))
+        with self._lock:
+            self.records.append(record)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.bytes += size or 0
+            self.saved += saved or 0
+            for stage, value in record['timings'].items():
+                histogram = self.histograms[stage]
+                for index, bound in enumerate(BUCKETS):
+                    if value <= bound:
+                        histogram['buckets'][index] += 1
+                histogram['sum'] += value
+                histogram['count'] += 1
+            self._save()
+        return record
+
+    # Counters and histograms in the Prometheus text exposition format
+    def prometheus(self):
+        with self._lock:
+            lines = ["# HELP firmwareupdate_updates_total Firmware updates "
+                     "by outcome.",
+                     "# TYPE firmwareupdate_updates_total counter"]
+            for outcome, count in sorted(self.outcomes.items()):
+                lines.append('firmwareupdate_updates_total{outcome="%s"} %d'
+                             % (_escape(outcome), count))
+
+            lines += ["# HELP firmwareupdate_flashed_bytes_total Bytes "
+                      "written to boards.",
+                      "# TYPE firmwareupdate_flashed_bytes_total counter",
+                      "firmwareupdate_flashed_bytes_total %d" % self.bytes]
+
+            lines += ["# HELP firmwareupdate_download_saved_bytes_total "
+                      "Download bytes saved by delta updates.",
+                      "# TYPE firmwareupdate_download_saved_bytes_total "
+                      "counter",
+                      "firmwareupdate_download_saved_bytes_total %d"
+                      % self.saved]
+
+            lines += ["# HELP firmwareupdate_stage_seconds Duration of the "
+                      "update stages.",
+                      "# TYPE firmwareupdate_stage_seconds histogram"]
+            for stage in STAGES:
+                histogram = self.histograms[stage]
+                for bound, count in zip(BUCKETS, histogram['buckets']):
+                    lines.append('firmwareupdate_stage_seconds_bucket'
+                                 '{stage="%s",le="%s"} %d'
+                                 % (stage, bound, count))
+                lines.append('firmwareupdate_stage_seconds_bucket'
+                             '{stage="%s",le="+Inf"} %d'
+                             % (stage, histogram['count']))
+                lines.append('firmwareupdate_stage_seconds_sum{stage="%s"} %s'
+                             % (stage, round(histogram['sum'], 3)))
+                lines.append('firmwareupdate_stage_seconds_count'
+                             '{stage="%s"} %d' % (stage, histogram['count']))
+
+            lines += ["# HELP firmwareupdate_last_total_seconds Duration of "
+                      "the last update of each port.",
+                      "# TYPE firmwareupdate_last_total_seconds gauge"]
+            for port, record in sorted(self._last_by_port().items()):
+                if 'total' in record['timings']:
+                    lines.append('firmwareupdate_last_total_seconds'
+                                 '{port="%s"} %s'
+                                 % (_escape(port), record['timings']['total']))
+        return "\n".join(lines) + "\n"
+
+    # Overview for the settings page
+    def summary(self, recent=20):
+        with self._lock:
+            averages = {}
+            for stage in STAGES:
+                histogram = self.histograms[stage]
+                if histogram['count']:
+                    averages[stage] = round(
+                        histogram['sum'] / histogram['count'], 2)
+            ports = {}
+            for record in self.records:
+                if record['port'] is None:
+                    continue
+                port = ports.setdefault(record['port'],
+                                        dict(updates=0, failures=0))
+                port['updates'] += 1
+                if record['outcome'] != "completed":
+                    port['failures'] += 1
+                port['last'] = record
+            return dict(outcomes=dict(self.outcomes), bytes=self.bytes,
+                        saved=self.saved, averages=averages, ports=ports,
+                        recent=list(self.records)[-recent:][::-1])
+
+    # Everything recorded, for comparing runs between plugin versions
+    def export(self, version=None):
+        with self._lock:
+            return dict(version=version, exported_at=round(time(), 3),
+                        stages=list(STAGES), buckets=list(BUCKETS),
+                        outcomes=dict(self.outcomes), bytes=self.bytes,
+                        saved=self.saved, histograms=self.histograms,
+                        records=list(self.records))
+
+    def _last_by_port(self):
+        last = {}
+        for record in self.records:
+            if record['port'] is not None:
+                last[record['port']] = record
+        return last
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.records.extend(data['records'])
+            self.outcomes = data['outcomes']
+            self.bytes = data['bytes']
+            self.saved = data.get('saved', 0)
+            for stage, histogram in data['histograms'].items():
+                if (stage in self.histograms and
+                        len(histogram['buckets']) == len(BUCKETS)):
+                    self.histograms[stage] = histogram
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _save(self):
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(dict(records=list(self.records),
+                               outcomes=self.outcomes, bytes=self.bytes,
+                               saved=self.saved,
+                               histograms=self.histograms), f,
+                          separators=(",", ":"))
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError):
+            pass
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
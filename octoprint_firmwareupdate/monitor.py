@@ -0,0 +1,196 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+from time import time
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+def find_between(s, first, last):
+    try:
+        start = s.rindex(first) + len(first)
+        end = s.rindex(last, start)
+        return s[start:end]
+    except ValueError:
+        return ""
+
+
+# Matches a (possibly still growing) avrdude progress bar such as
+# "Writing | #########                        | 18% 0.42s"
+PROGRESS_PATTERN = re.compile(r"(Reading|Writing) \| [# ]*\| (\d+)%")
+
+
+# Streams the output of an avrdude process and decides the outcome of the
+# flash as soon as the deciding line arrives, instead of re-reading the whole
+# build log on a timer. Everything read is also copied to the build log.
+class AvrdudeMonitor(object):
+
+    # Outcomes passed to on_result
+    COMPLETED = "completed"
+    ERROR = "error"
+    TIMEOUT = "timeout"
+
+    # Phases passed to on_progress
+    PHASE_READING = "reading"
+    PHASE_WRITING = "writing"
+    PHASE_VERIFYING = "verifying"
+
+    def __init__(self, process, build_log=None, on_result=None,
+                 on_progress=None, progress_interval=0.2, chunk_size=4096,
+                 verify=True):
+        self.process = process
+        # Whether avrdude reads the flash back; without verification a
+        # completed write is enough for success
+        self.verify = verify
+        self.build_log = build_log
+        self.on_result = on_result
+        # Called with (phase, percent), at most once per progress_interval
+        # seconds except for phase changes and completed phases
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.chunk_size = chunk_size
+        self.phase = None
+        self.percent = None
+        self._written = False
+        self._last_progress = None
+        # Outcome of the flash, None while still undecided
+        self.result = None
+        self.message = None
+        # Sum of the "Reading" and "Writing" times reported by avrdude, in
+        # total and per phase
+        self.completion_time = 0
+        self.timings = {}
+        self._verified = False
+        self._write_done = False
+
+    # Blocks until avrdude closes its output. The result callback fires as
+    # soon as the outcome is known; the remaining output is still drained
+    # into the build log afterwards.
+    def run(self):
+        fd = self.process.stdout.fileno()
+        pending = b""
+        while True:
+            try:
+                chunk = os.read(fd, self.chunk_size)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                break
+            if self.build_log is not None:
+                self.build_log.write(chunk)
+                self.build_log.flush()
+
+            pending += chunk
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                self.feed_line(self._final_segment(line))
+            if pending:
+                self.feed_progress(self._final_segment(pending))
+
+        if pending:
+            self.feed_line(self._final_segment(pending))
+
+        # Output is closed, so the process is exiting; no need to wait for a
+        # polling interval before reporting
+        returncode = self.process.wait()
+        if self.result is None:
+            if returncode == 0 and self._done_writing():
+                self._resolve(self.COMPLETED)
+            else:
+                self._resolve(self.ERROR,
+                              "An unknown error occurred. Please consult "
+                              "the update log in the plugin settings for "
+                              "more information.")
+        return self.result
+
+    # Apply the success/failure rules to a single line of output
+    def feed_line(self, line):
+        if self.result is not None:
+            return
+
+        if 'No device matching following was found' in line:
+            self._resolve(self.ERROR, "A connected device was not found.")
+        elif 'FAILED' in line:
+            self._resolve(self.ERROR)
+        elif 'ReceiveMessage(): timeout' in line:
+            self._resolve(self.TIMEOUT,
+                          "Device timed out. Please check that the port is "
+                          "not in use!")
+        elif 'bytes of flash verified' in line:
+            self._verified = True
+        elif 'bytes of flash written' in line:
+            self._write_done = True
+        elif 'avrdude done' in line and self._done_writing():
+            self._resolve(self.COMPLETED)
+        elif line.startswith("Reading") or line.startswith("Writing"):
+            self.feed_progress(line)
+            if line.startswith("Writing"):
+                phase = self.PHASE_WRITING
+                self._written = True
+            elif self._written:
+                phase = self.PHASE_VERIFYING
+            else:
+                phase = self.PHASE_READING
+            try:
+                elapsed = float(find_between(line, " ", "s"))
+            except ValueError:
+                return
+            self.completion_time += elapsed
+            self.timings[phase] = self.timings.get(phase, 0) + elapsed
+
+    # Track the progress bar currently being drawn by avrdude
+    def feed_progress(self, text):
+        match = PROGRESS_PATTERN.search(text)
+        if match is None or self.result is not None:
+            return
+
+        if match.group(1) == "Writing":
+            phase = self.PHASE_WRITING
+            self._written = True
+        elif self._written:
+            phase = self.PHASE_VERIFYING
+        else:
+            phase = self.PHASE_READING
+        percent = min(int(match.group(2)), 100)
+        if phase == self.phase and percent == self.percent:
+            return
+
+        phase_changed = phase != self.phase
+        self.phase = phase
+        self.percent = percent
+        if self.on_progress is None:
+            return
+
+        # Coalesce redraws so listeners are not flooded, but never drop the
+        # start or the end of a phase
+        now = time()
+        if (phase_changed or percent == 100 or
+                self._last_progress is None or
+                now - self._last_progress >= self.progress_interval):
+            self._last_progress = now
+            self.on_progress(phase, percent)
+
+    def _done_writing(self):
+        if self.verify:
+            return self._verified
+        return self._write_done
+
+    def _resolve(self, result, message=None):
+        self.result = result
+        self.message = message
+        if self.on_result is not None:
+            self.on_result(self)
+
+    # avrdude redraws its progress bars with carriage returns; only the last
+    # redraw of a line is its final text
+    @staticmethod
+    def _final_segment(line):
+        segment = line.rstrip(b"\r").split(b"\r")[-1]
+        return segment.decode("utf-8", "replace")
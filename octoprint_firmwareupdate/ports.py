@@ -0,0 +1,127 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+from threading import Lock
+
+from serial.tools import list_ports
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+# USB vendor/product IDs of ATmega2560 boards and their USB serial chips,
+# preferred over other serial devices when no port is given
+BOARD_IDS = frozenset([
+    (0x2341, 0x0010),  # Arduino Mega 2560
+    (0x2341, 0x0042),  # Arduino Mega 2560 R3
+    (0x2A03, 0x0042),  # Arduino.org Mega 2560 R3
+    (0x1A86, 0x7523),  # CH340
+    (0x0403, 0x6001),  # FTDI FT232R
+])
+
+# USB IDs in the hardware ID strings of pyserial versions whose port info
+# has no vid/pid attributes
+HWID_PATTERN = re.compile(
+    r"VID:PID=([0-9A-Fa-f]{4}):([0-9A-Fa-f]{4})(?: SNR=(\S+))?")
+
+# Directories whose modification time changes when serial devices are
+# plugged in or removed
+WATCHED_DIRECTORIES = ("/dev", "/dev/serial/by-id")
+
+
+# An attached USB serial device. board is a stable identifier of the
+# physical board built from its VID, PID and serial number, so a board can
+# be found again after it came back under a different device path.
+class SerialPort(object):
+
+    def __init__(self, device, vid, pid, serial_number=None,
+                 description=None):
+        self.device = device
+        self.vid = vid
+        self.pid = pid
+        self.serial_number = serial_number
+        self.description = description
+
+    @property
+    def board(self):
+        return "%04x:%04x:%s" % (self.vid, self.pid,
+                                 self.serial_number or "")
+
+    @property
+    def known(self):
+        return (self.vid, self.pid) in BOARD_IDS
+
+    def as_dict(self):
+        return dict(device=self.device, board=self.board,
+                    description=self.description, known=self.known)
+
+
+# Index of the attached USB serial devices. The devices are only listed
+# again when the device directories changed since the last listing.
+class PortIndex(object):
+
+    def __init__(self, lister=list_ports.comports,
+                 watched=WATCHED_DIRECTORIES):
+        self.lister = lister
+        self.watched = watched
+        self._lock = Lock()
+        self._signature = None
+        self._ports = []
+
+    # Attached devices sorted by path
+    def ports(self):
+        with self._lock:
+            signature = self._current_signature()
+            if signature != self._signature or signature is None:
+                self._ports = self._scan()
+                self._signature = signature
+            return list(self._ports)
+
+    # Current path of board, None if it isn't attached
+    def device_of(self, board):
+        for port in self.ports():
+            if port.board == board:
+                return port.device
+        return None
+
+    # Identifier of the board attached at device, None if there is none
+    def board_at(self, device):
+        for port in self.ports():
+            if port.device == device:
+                return port.board
+        return None
+
+    def _scan(self):
+        ports = []
+        for info in self.lister():
+            device, description, hwid = info[0], info[1], info[2]
+            vid = getattr(info, "vid", None)
+            pid = getattr(info, "pid", None)
+            serial_number = getattr(info, "serial_number", None)
+            if vid is None or pid is None:
+                match = HWID_PATTERN.search(hwid or "")
+                if match is None:
+                    continue
+                vid = int(match.group(1), 16)
+                pid = int(match.group(2), 16)
+                serial_number = match.group(3)
+            ports.append(SerialPort(device, vid, pid, serial_number,
+                                    description))
+        return sorted(ports, key=lambda port: port.device)
+
+    # Modification times of the watched directories, or None if none of
+    # them exist and the devices have to be listed every time
+    def _current_signature(self):
+        signature = []
+        for directory in self.watched:
+            try:
+                signature.append(os.stat(directory).st_mtime)
+            except OSError:
+                signature.append(None)
+        if not any(mtime is not None for mtime in signature):
+            return None
+        return tuple(signature)
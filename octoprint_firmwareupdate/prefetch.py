@@ -0,0 +1,121 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+from time import time
+from threading import Thread, Event
+
+import requests
+
+from .cache import release_key
+from .downloader import Downloader, DownloadStopped, asset_digest
+from .hexfile import HexError, parse_hex
+from .releases import NoRelease
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+# Polls for new releases every interval seconds in a background thread and
+# downloads them into the firmware cache at no more than rate_limit bytes
+# per second, so the update itself doesn't have to wait for the network.
+# Downloads are validated before they are cached and on_ready is called with
+# the cache key and version of every newly cached release. Polls are skipped
+# while enabled returns False.
+class ReleasePrefetcher(object):
+
+    def __init__(self, releases, cache, interval=3600, rate_limit=None,
+                 timeout=27, on_ready=None, logger=None, downloader=None,
+                 enabled=None):
+        self.releases = releases
+        self.cache = cache
+        self.downloader = (downloader if downloader is not None
+                           else Downloader(timeout=timeout))
+        self.interval = interval
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.enabled = enabled
+        self._logger = logger
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    # Look up the latest release and cache it if it isn't cached yet.
+    # Returns the cache key and version of the release.
+    def check(self):
+        release = self.releases.latest(use_cache=True)
+        asset = release['assets'][0]
+        key = release_key(asset)
+        if self.cache.get(key) is None:
+            self._download(asset, key)
+            self.cache.set_latest(key, asset['updated_at'], prefetched=True)
+            if self.on_ready is not None:
+                self.on_ready(key, asset['updated_at'])
+        return key, asset['updated_at']
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self.enabled is not None and not self.enabled():
+                continue
+            try:
+                self.check()
+            except NoRelease:
+                pass
+            except (requests.exceptions.RequestException, IOError, OSError,
+                    HexError, ValueError, KeyError, IndexError,
+                    TypeError) as e:
+                self._log("Release prefetch failed: %s" % str(e))
+
+    # Download the file of asset next to the cache, validate it and add it
+    # to the cache under key. Interrupted downloads are continued on the
+    # next check.
+    def _download(self, asset, key):
+        path = os.path.join(self.cache.directory, "prefetch.hex")
+        start = time()
+        resumed = []
+        try:
+            digest = self.downloader.download(
+                asset['browser_download_url'], path, size=asset.get('size'),
+                digest=asset_digest(asset), stop=self._stopped.is_set,
+                on_block=lambda received: self._throttle(start, resumed,
+                                                         received),
+                timeout=self.timeout)
+            image = parse_hex(path)
+            self.cache.put(path, key, digest, image.digest)
+            self._log("Prefetched release firmware %s" % key)
+        except DownloadStopped:
+            raise IOError("Prefetch stopped")
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # Sleep as needed to stay below the rate limit. Only bytes received by
+    # this check count; the first call tells how much an interrupted earlier
+    # check had received already.
+    def _throttle(self, start, resumed, received):
+        if not resumed:
+            resumed.append(received)
+        if self.rate_limit:
+            ahead = ((received - resumed[0]) / float(self.rate_limit) -
+                     (time() - start))
+            if ahead > 0:
+                self._stopped.wait(ahead)
+
+    def _log(self, message):
+        if self._logger is not None:
+            self._logger.info(message)
@@ -0,0 +1,101 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import json
+from time import time
+from threading import Lock
+
+import requests
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+LATEST_RELEASE_URL = \
+    "https://api.github.com/repos/Voxel8/Marlin/releases/latest"
+
+
+# There is no release to install, e.g. a fleet coordinator hasn't opened
+# its rollout to this peer yet
+class NoRelease(Exception):
+    pass
+
+
+# Looks up the latest Marlin release on GitHub. Responses are kept on disk
+# together with their ETag/Last-Modified headers: within ttl seconds the
+# stored copy is returned without a request, after that a conditional request
+# is sent and a 304 just renews the stored copy.
+class ReleaseClient(object):
+
+    def __init__(self, cache_file, ttl=600, url=LATEST_RELEASE_URL,
+                 timeout=27, session=None):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.url = url
+        self.timeout = timeout
+        self.session = session if session is not None else requests.Session()
+        self._lock = Lock()
+        self._cached = self._load()
+
+    # Returns the release JSON. Raises NoRelease if there is none and the
+    # requests exceptions on connection or other HTTP errors. timeout
+    # overrides the default request timeout.
+    def latest(self, use_cache=True, timeout=None):
+        with self._lock:
+            cached = self._cached
+            if (use_cache and cached is not None and
+                    time() - cached['fetched_at'] < self.ttl):
+                return cached['release']
+
+            headers = {}
+            if cached is not None:
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+            r = self.session.get(self.url, headers=headers,
+                                 timeout=timeout or self.timeout)
+            if r.status_code == 304 and cached is not None:
+                cached['fetched_at'] = time()
+                self._save()
+                return cached['release']
+            if r.status_code == 404:
+                raise NoRelease("No release available")
+
+            r.raise_for_status()
+            release = r.json()
+            self._cached = dict(release=release,
+                                etag=r.headers.get('ETag'),
+                                last_modified=r.headers.get('Last-Modified'),
+                                fetched_at=time())
+            self._save()
+            return release
+
+    # The last release seen, regardless of its age
+    def cached(self):
+        with self._lock:
+            if self._cached is None:
+                return None
+            return self._cached['release']
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+            cached['release']['assets'][0]
+            return cached
+        except (IOError, OSError, ValueError, KeyError, IndexError,
+                TypeError):
+            return None
+
+    def _save(self):
+        try:
+            with open(self.cache_file + ".tmp", "w") as f:
+                json.dump(self._cached, f)
+            os.rename(self.cache_file + ".tmp", self.cache_file)
+        except (IOError, OSError):
+            pass
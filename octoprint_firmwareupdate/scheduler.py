@@ -0,0 +1,162 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import uuid
+from time import time
+from collections import deque
+from threading import Thread, Condition
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+class QueueFull(Exception):
+    pass
+
+
+# A request for an update: an uploaded image, the update_firmware command
+# or an automatic release check, with the ports it is meant for
+class UpdateRequest(object):
+
+    UPLOAD = "upload"
+    MANUAL = "manual"
+    AUTO = "auto"
+    # Lower runs first
+    PRIORITIES = {UPLOAD: 0, MANUAL: 1, AUTO: 2}
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    DROPPED = "dropped"
+
+    def __init__(self, kind, ports=None, digest=None, image=None,
+                 timings=None, onstartup=False, path=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.ports = ports
+        # Digest and parsed image of an upload
+        self.digest = digest
+        self.image = image
+        # Where an upload waits until its update runs
+        self.path = path
+        self.timings = timings
+        self.onstartup = onstartup
+        self.state = self.QUEUED
+        # Final state of the update that carried out the request
+        self.outcome = None
+        # Number of duplicate requests folded into this one
+        self.coalesced = 0
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def priority(self):
+        return self.PRIORITIES[self.kind]
+
+    # Requests with the same key would carry out the same update
+    @property
+    def key(self):
+        ports = self.ports
+        if isinstance(ports, (list, tuple)):
+            ports = tuple(sorted(ports))
+        return (self.kind, self.digest, ports)
+
+    def as_dict(self):
+        return dict(id=self.id, kind=self.kind, state=self.state,
+                    outcome=self.outcome, ports=self.ports,
+                    coalesced=self.coalesced, submitted=self.submitted,
+                    started=self.started, finished=self.finished)
+
+
+# Carries out update requests one at a time in a background thread, so two
+# updates never flash the same board at once. Duplicates of a queued or
+# running request are folded into it, automatic checks into any pending
+# update, and uploads run before update commands and automatic checks. At
+# most max_queued requests wait behind the running one.
+class UpdateScheduler(object):
+
+    def __init__(self, execute, max_queued=4, history=20, logger=None):
+        # Called with each request, returns once its update is over
+        self.execute = execute
+        self.max_queued = max_queued
+        self.current = None
+        self._queue = []
+        self._recent = deque(maxlen=history)
+        self._condition = Condition()
+        self._thread = None
+        self._logger = logger
+
+    # Queue request and return it, or return the queued or running request
+    # it duplicates. Raises QueueFull if too many requests are waiting.
+    def submit(self, request):
+        with self._condition:
+            for other in [self.current] + self._queue:
+                if other is not None and self._covers(other, request):
+                    other.coalesced += 1
+                    return other
+            if len(self._queue) >= self.max_queued:
+                raise QueueFull("Too many updates are waiting")
+            self._queue.append(request)
+            self._queue.sort(key=lambda queued: (queued.priority,
+                                                 queued.submitted))
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return request
+
+    # Drop every request that hasn't started yet and return them
+    def clear(self):
+        with self._condition:
+            dropped = self._queue
+            for request in dropped:
+                request.state = UpdateRequest.DROPPED
+                request.finished = time()
+                self._recent.append(request)
+            self._queue = []
+        return dropped
+
+    def get(self, request_id):
+        with self._condition:
+            for request in [self.current] + self._queue + list(self._recent):
+                if request is not None and request.id == request_id:
+                    return request
+        return None
+
+    def as_dict(self):
+        with self._condition:
+            return dict(current=(self.current.as_dict()
+                                 if self.current is not None else None),
+                        queued=[request.as_dict() for request in self._queue])
+
+    @staticmethod
+    def _covers(other, request):
+        if request.kind == UpdateRequest.AUTO:
+            return True
+        return other.key == request.key
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                request = self._queue.pop(0)
+                request.state = UpdateRequest.RUNNING
+                request.started = time()
+                self.current = request
+            try:
+                self.execute(request)
+            except Exception:
+                # Keep serving the queue whatever went wrong with one update
+                if self._logger is not None:
+                    self._logger.exception("Update %s failed" % request.id)
+            with self._condition:
+                request.state = UpdateRequest.DONE
+                request.finished = time()
+                self.current = None
+                self._recent.append(request)
@@ -8,32 +8,160 @@ $(function() {
     self.global_settings = parameters[3];
     self.popup = undefined;
     self.isUpdating = ko.observable(undefined);
+    // Sequence number of the last status change seen
+    self.sequence = undefined;
     self.connection.isUpdating = self.isUpdating;
+    // Only the File object is kept; it is uploaded in chunks straight from
+    // disk instead of being read into a base64 string
     self.fileData = ko.observable({
-      base64String: ko.observable()
+      file: ko.observable()
     });
+    self.uploadChunkSize = 256 * 1024;
+    self.uploadRetries = 5;
     self.enableUpdating = ko.computed(function() {
       return self.isUpdating() == false ? true : false;
     });
     self.enableUploading = ko.computed(function() {
-      if (self.fileData().base64String() == null) {
+      if (self.fileData().file() == null) {
         return false;
       } else {
         return self.enableUpdating();
       }
     });
 
+    self.flashHistory = ko.observableArray([]);
+    self.flashTotals = ko.observable("");
+
+    self.jobLogs = ko.observableArray([]);
+    self.selectedLog = ko.observable(undefined);
+    self.logText = ko.observable("");
+    self._logOffset = 0;
+    self._logTimer = undefined;
+
+    self.rollout = ko.observable(undefined);
+    self.rolloutText = ko.computed(function() {
+      var rollout = self.rollout();
+      if (!rollout) {
+        return gettext("No rollout");
+      }
+      var peers = _.values(rollout.peers);
+      var completed = _.filter(peers, function(peer) {
+        return peer.status == "completed";
+      }).length;
+      return rollout.version + ": " + rollout.state + ", " +
+        gettext("wave") + " " + rollout.wave + "/" + rollout.waves.length + ", " +
+        completed + "/" + peers.length + " " + gettext("peers updated");
+    });
+
+    self.onSettingsShown = function() {
+      self.loadMetrics();
+      self.loadLogs();
+      self.loadRollout();
+    };
+
+    self.onSettingsHidden = function() {
+      self._stopTail();
+    };
+
+    self.loadLogs = function() {
+      $.getJSON("/plugin/firmwareupdate/logs", function(data) {
+        self.jobLogs(_.map(data.logs, function(log) {
+          return {
+            id: log.id,
+            time: log.started ? new Date(log.started * 1000).toLocaleString() : log.id,
+            summary: log.running ? gettext("Running") : (log.last ? log.last.message : ""),
+            running: log.running
+          };
+        }));
+      });
+    };
+
+    // Show a log and, while its update is running, keep fetching the
+    // entries added after the last offset
+    self.showLog = function(log) {
+      self._stopTail();
+      self.selectedLog(log.id);
+      self.logText("");
+      self._logOffset = 0;
+      self._tailLog(log.id);
+    };
+
+    self._tailLog = function(logId) {
+      $.getJSON("/plugin/firmwareupdate/logs/" + logId, {offset: self._logOffset}, function(data) {
+        if (self.selectedLog() != logId) {
+          return;
+        }
+        self._logOffset = data.offset;
+        var lines = _.map(data.entries, function(entry) {
+          return new Date(entry.time * 1000).toLocaleTimeString() + " [" + entry.stage + "]" +
+            (entry.port ? " " + entry.port : "") + " " + entry.message;
+        });
+        if (lines.length) {
+          self.logText(self.logText() + lines.join("\n") + "\n");
+        }
+        if (data.running) {
+          self._logTimer = setTimeout(function() {
+            self._tailLog(logId);
+          }, 1000);
+        }
+      });
+    };
+
+    self._stopTail = function() {
+      if (self._logTimer !== undefined) {
+        clearTimeout(self._logTimer);
+        self._logTimer = undefined;
+      }
+    };
+
+    self.loadRollout = function() {
+      $.getJSON("/plugin/firmwareupdate/fleet/status", function(data) {
+        self.rollout(data.rollout);
+      });
+    };
+
+    self.loadMetrics = function() {
+      $.getJSON("/plugin/firmwareupdate/metrics/summary", function(data) {
+        var completed = data.outcomes.completed || 0;
+        var failed = _.reduce(data.outcomes, function(sum, count, outcome) {
+          return outcome == "completed" ? sum : sum + count;
+        }, 0);
+        var text = completed + " " + gettext("completed") + ", " + failed + " " + gettext("failed");
+        if (data.averages.total !== undefined) {
+          text += ", " + gettext("average") + " " + data.averages.total + "s";
+        }
+        if (data.saved) {
+          text += ", " + Math.round(data.saved / 1024) + " KiB " + gettext("download saved");
+        }
+        self.flashTotals(text);
+        self.flashHistory(_.map(data.recent, function(record) {
+          return {
+            time: new Date(record.time * 1000).toLocaleString(),
+            port: record.port || "-",
+            outcome: record.outcome,
+            total: record.timings.total !== undefined ? record.timings.total + "s" : "-",
+            reason: record.reason || ""
+          };
+        }));
+      });
+    };
+
     self.onClear = function(fileData) {
       fileData.clear && fileData.clear();
     };
 
     self.serverUpload = function() {
+      var file = self.fileData().file();
+      var uploadId = Date.now().toString(36) + Math.random().toString(36).substr(2);
       $("#update_firmware_from_file").html("<div class='loading'></div>");
-      $.post("/plugin/firmwareupdate/upload", { base64String: self.fileData().base64String() })
+      self._fileDigest(file)
+        .then(function(digest) {
+          return self._uploadChunks(file, uploadId, 0, digest, self.uploadRetries);
+        })
         .fail(function(data) {
           self._showPopup({
             title: gettext("Uploading failed."),
-            text: gettext("Uploading your firmware to the printer failed.<br>" + pnotifyAdditionalInfo(data.responseText)),
+            text: gettext("Uploading your firmware to the printer failed.<br>" + pnotifyAdditionalInfo(data && data.responseText)),
             type: "error",
             hide: false,
             buttons: {
@@ -46,6 +174,70 @@ $(function() {
         });
     };
 
+    // SHA-256 of the file as hex, or undefined where the browser can't
+    // compute it (WebCrypto is only available in secure contexts)
+    self._fileDigest = function(file) {
+      var deferred = $.Deferred();
+      if (!window.crypto || !window.crypto.subtle || !window.FileReader) {
+        return deferred.resolve(undefined).promise();
+      }
+      var reader = new FileReader();
+      reader.onload = function() {
+        window.crypto.subtle.digest("SHA-256", reader.result).then(function(hash) {
+          deferred.resolve(_.map(new Uint8Array(hash), function(byte) {
+            return ("0" + byte.toString(16)).slice(-2);
+          }).join(""));
+        }, function() {
+          deferred.resolve(undefined);
+        });
+      };
+      reader.onerror = function() {
+        deferred.resolve(undefined);
+      };
+      reader.readAsArrayBuffer(file);
+      return deferred.promise();
+    };
+
+    // Send the file chunk by chunk, resuming from the offset the server
+    // reports after a dropped connection
+    self._uploadChunks = function(file, uploadId, offset, digest, retries) {
+      var form = new FormData();
+      form.append("upload_id", uploadId);
+      form.append("offset", offset);
+      form.append("total", file.size);
+      if (digest) {
+        form.append("sha256", digest);
+      }
+      form.append("chunk", file.slice(offset, offset + self.uploadChunkSize), file.name);
+
+      return $.ajax({
+        type: "POST",
+        url: "/plugin/firmwareupdate/upload_chunk",
+        data: form,
+        processData: false,
+        contentType: false,
+        dataType: "json"
+      }).then(function(data) {
+        if (data.complete) {
+          return data;
+        }
+        return self._uploadChunks(file, uploadId, data.offset, digest, self.uploadRetries);
+      }, function(jqXHR) {
+        if (retries <= 0 || jqXHR.status == 400 || jqXHR.status == 403) {
+          return $.Deferred().reject(jqXHR).promise();
+        }
+        return $.getJSON("/plugin/firmwareupdate/upload_chunk/" + uploadId)
+          .then(function(data) {
+            if (data.complete) {
+              return data;
+            }
+            return self._uploadChunks(file, uploadId, data.offset, digest, retries - 1);
+          }, function() {
+            return self._uploadChunks(file, uploadId, offset, digest, retries - 1);
+          });
+      });
+    };
+
     self.connection.onBeforeBinding = function () {
       $("#printer_connect").attr("data-bind", function() {
         return $(this).attr("data-bind").replace(/enable: loginState.isUser()/g, "enable: loginState.isUser() && !isUpdating");
@@ -82,8 +274,35 @@ $(function() {
       }
     };
 
+    self._progressText = function(phase, progress, port) {
+      var phases = {
+        reading: gettext("Reading device"),
+        writing: gettext("Writing firmware"),
+        verifying: gettext("Verifying firmware"),
+        booting: gettext("Waiting for the firmware to start")
+      };
+      var label = phases[phase] || gettext("Now updating, please wait.");
+      if (port) {
+        label += " " + gettext("on") + " " + _.escape(port);
+      }
+      return label + " (" + progress + "%)" +
+        "<div class='progress progress-striped active firmwareupdate-progress'>" +
+        "<div class='bar' style='width: " + progress + "%'></div></div>";
+    };
+
     self.onDataUpdaterReconnect = function() {
-      self.checkUpdating();
+      if (self.sequence === undefined) {
+        self.checkUpdating();
+        return;
+      }
+      // Replay the changes missed while the socket was down
+      $.getJSON("/plugin/firmwareupdate/status/wait", {since: self.sequence, timeout: 0}, function(data) {
+        _.each(data.changes, function(change) {
+          self.onDataUpdaterPluginMessage("firmwareupdate", change);
+        });
+        self.sequence = data.snapshot.sequence;
+        self.isUpdating(data.snapshot.isUpdating);
+      }).fail(self.checkUpdating);
     }
 
     self.onStartupComplete = function() {
@@ -94,6 +313,21 @@ $(function() {
       if (plugin != "firmwareupdate") {
         return;
       }
+      if (data.sequence !== undefined) {
+        if (self.sequence !== undefined && data.sequence <= self.sequence) {
+          return;
+        }
+        self.sequence = data.sequence;
+      }
+      if (data.status == "ready") {
+        self._showPopup({
+          title: gettext("Firmware update ready."),
+          text: gettext("A new printer firmware has been downloaded. It will be installed once the printer is idle."),
+          type: "info",
+          hide: true
+        });
+        return;
+      }
       if (data.hasOwnProperty("isUpdating")) {
         self.isUpdating(data.isUpdating);
         if (data.status == "error") {
@@ -118,16 +352,41 @@ $(function() {
               }
             });
           }
+        } else if (data.status == "cancelled") {
+          self._showPopup({
+            title: gettext("Update cancelled."),
+            text: gettext("The firmware update was cancelled. Please update again before printing."),
+            type: "notice",
+            hide: false,
+            buttons: {
+              sticker: false
+            }
+          });
         } else if (data.status == "completed") {
+          var text = gettext("The firmware on your printer has been successfully updated after " + data.message + " seconds.");
+          if (data.bytesWritten != null) {
+            text += "<br>" + gettext("Only changed pages were written (" + data.bytesWritten + " bytes).");
+          }
           self._showPopup({
             title: gettext("Update complete."),
-            text: gettext("The firmware on your printer has been successfully updated after " + data.message + " seconds."),
+            text: text,
             type: "success",
             hide: false,
             buttons: {
               sticker: false
             }
           });
+        } else if (data.status == "progress") {
+          self._updatePopup({
+            title: gettext("Updating..."),
+            text: self._progressText(data.phase, data.progress, data.port),
+            icon: "icon-cog icon-spin",
+            hide: false,
+            buttons: {
+              closer: false,
+              sticker: false
+            }
+          });
         } else if (data.status == "inprogress") {
           self._showPopup({
             title: gettext("Updating..."),
@@ -161,6 +420,38 @@ $(function() {
       });
     };
 
+    self.cancel_update = function() {
+      $.ajax({
+        type: "POST",
+        url: "/api/plugin/firmwareupdate",
+        data: JSON.stringify({
+          command: 'cancel_update'
+        }),
+        contentType: "application/json; charset=utf-8",
+        dataType: "json"
+      });
+    };
+
+    self.start_rollout = function() {
+      self._rolloutCommand("start_rollout");
+    };
+
+    self.halt_rollout = function() {
+      self._rolloutCommand("halt_rollout");
+    };
+
+    self._rolloutCommand = function(command) {
+      $.ajax({
+        type: "POST",
+        url: "/api/plugin/firmwareupdate",
+        data: JSON.stringify({
+          command: command
+        }),
+        contentType: "application/json; charset=utf-8",
+        dataType: "json"
+      }).always(self.loadRollout);
+    };
+
     self.checkUpdating = function() {
       $.ajax({
         type: "GET",
@@ -171,6 +462,7 @@ $(function() {
           console.log('error');
         },
         success: function(data) {
+          self.sequence = data.sequence;
           self.isUpdating(data.isUpdating);
           if (data.isUpdating) {
             self._showPopup({
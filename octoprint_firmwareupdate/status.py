@@ -0,0 +1,53 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from time import time
+from collections import deque
+from threading import Lock
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+
+# Numbered record of the status changes sent to clients. The sequence
+# starts at the current time in milliseconds so it keeps increasing across
+# restarts; the last capacity changes are kept for clients to catch up on.
+class StatusFeed(object):
+
+    def __init__(self, capacity=100):
+        self.sequence = int(time() * 1000)
+        self._changes = deque(maxlen=capacity)
+        self._listeners = []
+        self._lock = Lock()
+
+    # Add change and notify the listeners. Returns its sequence number.
+    def publish(self, change):
+        with self._lock:
+            self.sequence += 1
+            entry = dict(change)
+            entry['sequence'] = self.sequence
+            self._changes.append(entry)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+        return entry['sequence']
+
+    # Changes after sequence number since that are still kept, oldest first
+    def changes(self, since):
+        with self._lock:
+            return [change for change in self._changes
+                    if change['sequence'] > since]
+
+    # Call listener without arguments after every change, from the thread
+    # that published it
+    def subscribe(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
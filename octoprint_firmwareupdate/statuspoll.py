@@ -0,0 +1,72 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+from datetime import timedelta
+
+import tornado.gen
+import tornado.web
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+# Longest a client may wait for a change, in seconds
+MAX_TIMEOUT = 60
+
+
+# Long-poll of the update status. GET ?since=<sequence>&timeout=<seconds>
+# answers as soon as a change after since is published, or after timeout,
+# with the current snapshot and the changes the client hasn't seen yet.
+# This is a Tornado handler rather than a blueprint route so waiting
+# clients don't hold up the server.
+class StatusPollHandler(tornado.web.RequestHandler):
+
+    def initialize(self, feed, snapshot, access_validation=None):
+        self.feed = feed
+        # Called for the current status snapshot
+        self.snapshot = snapshot
+        self.access_validation = access_validation
+
+    @tornado.gen.coroutine
+    def get(self):
+        if self.access_validation is not None:
+            self.access_validation(self.request)
+        try:
+            since = int(self.get_argument("since", "0"))
+            timeout = min(float(self.get_argument("timeout",
+                                                  str(MAX_TIMEOUT))),
+                          MAX_TIMEOUT)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        if timeout > 0 and self.feed.sequence <= since:
+            changed = Future()
+            loop = IOLoop.current()
+
+            def resolve():
+                if not changed.done():
+                    changed.set_result(None)
+
+            def listener():
+                loop.add_callback(resolve)
+            self.feed.subscribe(listener)
+            try:
+                # The change may have come in before subscribing
+                if self.feed.sequence > since:
+                    resolve()
+                yield tornado.gen.with_timeout(timedelta(seconds=timeout),
+                                               changed)
+            except tornado.gen.TimeoutError:
+                pass
+            finally:
+                self.feed.unsubscribe(listener)
+
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(json.dumps(dict(snapshot=self.snapshot(),
+                                    changes=self.feed.changes(since))))
@@ -0,0 +1,284 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import struct
+from time import sleep, time
+from threading import Event
+
+from serial import Serial, SerialException
+
+from .flasher import Flasher
+from .hexfile import PAGE_SIZE, parse_hex
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+MESSAGE_START = 0x1B
+TOKEN = 0x0E
+
+CMD_SIGN_ON = 0x01
+CMD_LOAD_ADDRESS = 0x06
+CMD_ENTER_PROGMODE_ISP = 0x10
+CMD_LEAVE_PROGMODE_ISP = 0x11
+CMD_PROGRAM_FLASH_ISP = 0x13
+CMD_READ_FLASH_ISP = 0x14
+CMD_READ_SIGNATURE_ISP = 0x1B
+
+STATUS_CMD_OK = 0x00
+
+# Device signature of the ATmega2560
+SIGNATURE_M2560 = bytearray([0x1E, 0x98, 0x01])
+
+
+class Stk500v2Error(Exception):
+    pass
+
+
+class Stk500v2Timeout(Stk500v2Error):
+    pass
+
+
+class Stk500v2Cancelled(Stk500v2Error):
+    pass
+
+
+# Message layer of the STK500v2 protocol as spoken by the ATmega2560
+# bootloader
+class Stk500v2(object):
+
+    def __init__(self, serial):
+        self.serial = serial
+        self._sequence = 0
+
+    def command(self, body):
+        self._sequence = (self._sequence + 1) & 0xFF
+        body = bytearray(body)
+        message = bytearray([MESSAGE_START, self._sequence,
+                             (len(body) >> 8) & 0xFF, len(body) & 0xFF,
+                             TOKEN]) + body
+        message.append(self._checksum(message))
+        # Each message goes out in a single write
+        self.serial.write(bytes(message))
+
+        answer = self._read_message()
+        if len(answer) < 2 or answer[0] != body[0]:
+            raise Stk500v2Error("Unexpected answer to command 0x%02X"
+                                % body[0])
+        if answer[1] != STATUS_CMD_OK:
+            raise Stk500v2Error("Command 0x%02X failed with status 0x%02X"
+                                % (body[0], answer[1]))
+        return answer
+
+    def sign_on(self):
+        return self.command([CMD_SIGN_ON])[3:].decode("ascii", "replace")
+
+    def read_signature(self):
+        signature = bytearray()
+        for index in range(3):
+            answer = self.command([CMD_READ_SIGNATURE_ISP, 0x04, 0x30, 0x00,
+                                   index, 0x00])
+            signature.append(answer[2])
+        return signature
+
+    def enter_progmode(self):
+        self.command([CMD_ENTER_PROGMODE_ISP, 200, 100, 25, 32, 0, 0x53, 3,
+                      0xAC, 0x53, 0x00, 0x00])
+
+    def leave_progmode(self):
+        self.command([CMD_LEAVE_PROGMODE_ISP, 1, 1])
+
+    # Set the byte address of the next flash read or write. The bootloader
+    # advances it by itself after every page.
+    def load_address(self, address):
+        # Bit 31 selects the extended address byte on devices with more than
+        # 128 KB of flash
+        self.command(bytearray([CMD_LOAD_ADDRESS]) +
+                     bytearray(struct.pack(">I", (address >> 1) | 0x80000000)))
+
+    def program_page(self, data):
+        self.command(bytearray([CMD_PROGRAM_FLASH_ISP,
+                                (len(data) >> 8) & 0xFF, len(data) & 0xFF,
+                                0xC1, 0x0A, 0x40, 0x4C, 0x20, 0x00, 0x00]) +
+                     bytearray(data))
+
+    def read_page(self, length):
+        answer = self.command([CMD_READ_FLASH_ISP, (length >> 8) & 0xFF,
+                               length & 0xFF, 0x20])
+        return answer[2:2 + length]
+
+    def _read_message(self):
+        while True:
+            start = self._read(1)
+            if start[0] == MESSAGE_START:
+                break
+        header = self._read(4)
+        if header[0] != self._sequence or header[3] != TOKEN:
+            raise Stk500v2Error("Malformed message header")
+        length = (header[1] << 8) | header[2]
+        body = self._read(length)
+        checksum = self._read(1)[0]
+        if checksum != self._checksum(bytearray([MESSAGE_START]) + header +
+                                      body):
+            raise Stk500v2Error("Message checksum mismatch")
+        return body
+
+    def _read(self, length):
+        data = bytearray(self.serial.read(length))
+        if len(data) < length:
+            raise Stk500v2Timeout("Device timed out. Please check that the "
+                                  "port is not in use!")
+        return data
+
+    @staticmethod
+    def _checksum(data):
+        checksum = 0
+        for byte in data:
+            checksum ^= byte
+        return checksum
+
+
+# Flashes in-process through the STK500v2 bootloader, without avrdude. The
+# port stays open from the reset pulse until the bootloader is left.
+class Stk500v2Flasher(Flasher):
+
+    def __init__(self, sync_attempts=10, timeout=1, **kwargs):
+        Flasher.__init__(self, **kwargs)
+        self.sync_attempts = sync_attempts
+        self.timeout = timeout
+        self._log = None
+        # Cleared while flash() has the port open
+        self._released = Event()
+        self._released.set()
+
+    def flash(self, port, firmware_file, build_log=None, image=None):
+        self._log = build_log
+        self._released.clear()
+        start = time()
+        serial = None
+        # The outcome is only reported once the port is closed, so whoever
+        # acts on it can use the port right away
+        result = message = None
+        try:
+            self._check_cancelled()
+            if image is None:
+                image = parse_hex(firmware_file)
+            pages = image.pages
+            image = image.data
+            serial = Serial(port, self.baudrate, timeout=self.timeout)
+            programmer = Stk500v2(serial)
+            stage = time()
+            self._reset(serial, programmer)
+            self.timings['reset'] = time() - stage
+            self._check_signature(programmer)
+            programmer.enter_progmode()
+
+            stage = time()
+            self._write(programmer, image, pages)
+            self.timings['write'] = time() - stage
+            if self.verify:
+                stage = time()
+                self._verify(programmer, image, pages)
+                self.timings['verify'] = time() - stage
+            programmer.leave_progmode()
+            self.completion_time = time() - start
+            if self.verify:
+                self._note("%d bytes of flash verified"
+                           % (len(pages) * PAGE_SIZE))
+            result = self.COMPLETED
+        except Stk500v2Cancelled:
+            result, message = self.CANCELLED, "Update cancelled."
+        except Stk500v2Timeout as e:
+            self._note(str(e))
+            result, message = self.TIMEOUT, str(e)
+        except (Stk500v2Error, SerialException, IOError, ValueError,
+                TypeError) as e:
+            self._note("FAILED: %s" % str(e))
+            result, message = self.ERROR, str(e)
+        finally:
+            if serial is not None:
+                serial.close()
+            self._released.set()
+        self._resolve(result, message)
+        return self.result
+
+    # The engine notices between two messages to the board, which takes at
+    # most the serial timeout
+    def cancel(self):
+        self._cancelled.set()
+        self._released.wait(self.timeout + 1)
+        Flasher.cancel(self)
+
+    # Pulse DTR on the port that is then used for flashing and sync with the
+    # bootloader before it times out and starts the firmware
+    def _reset(self, serial, programmer):
+        try:
+            serial.setDTR(False)
+            sleep(0.1)
+            serial.setDTR(True)
+        except (IOError, SerialException):
+            # Ports without modem control lines (e.g. a pty) can't be reset
+            self._note("Reset pulse not supported on this port")
+        serial.flushInput()
+
+        for attempt in range(self.sync_attempts):
+            self._check_cancelled()
+            try:
+                self._note("Signed on to %s" % programmer.sign_on())
+                return
+            except Stk500v2Error:
+                serial.flushInput()
+        raise Stk500v2Timeout("Device timed out. Please check that the port "
+                              "is not in use!")
+
+    def _check_signature(self, programmer):
+        signature = programmer.read_signature()
+        self._note("Device signature = 0x%s" % "".join(
+            "%02x" % byte for byte in signature))
+        if signature != SIGNATURE_M2560:
+            raise Stk500v2Error("Unexpected device signature")
+
+    def _write(self, programmer, image, pages):
+        self._progress(self.PHASE_WRITING, 0)
+        address = None
+        for index, page in enumerate(pages):
+            self._check_cancelled()
+            start = page * PAGE_SIZE
+            if address != start:
+                programmer.load_address(start)
+            programmer.program_page(self._page(image, start))
+            address = start + PAGE_SIZE
+            self._progress(self.PHASE_WRITING,
+                           (index + 1) * 100 // len(pages))
+        self._note("%d bytes of flash written" % (len(pages) * PAGE_SIZE))
+
+    def _verify(self, programmer, image, pages):
+        self._progress(self.PHASE_VERIFYING, 0)
+        address = None
+        for index, page in enumerate(pages):
+            self._check_cancelled()
+            start = page * PAGE_SIZE
+            if address != start:
+                programmer.load_address(start)
+            if programmer.read_page(PAGE_SIZE) != self._page(image, start):
+                raise Stk500v2Error("Verification error at address 0x%05x"
+                                    % start)
+            address = start + PAGE_SIZE
+            self._progress(self.PHASE_VERIFYING,
+                           (index + 1) * 100 // len(pages))
+
+    def _check_cancelled(self):
+        if self.cancelled:
+            raise Stk500v2Cancelled()
+
+    def _note(self, line):
+        if self._log is not None:
+            self._log.write(("stk500v2: %s\n" % line).encode("utf-8"))
+            self._log.flush()
+
+    @staticmethod
+    def _page(image, start):
+        data = image[start:start + PAGE_SIZE]
+        return data + bytearray(b"\xff" * (PAGE_SIZE - len(data)))
@@ -0,0 +1,131 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+import shutil
+import hashlib
+from time import time
+from threading import Lock
+
+__author__ = "Kevin Murphy <kevin@voxel8.co>"
+__license__ = ("GNU Affero General Public License "
+               "http://www.gnu.org/licenses/agpl.html")
+__copyright__ = ("Copyright (C) 2016 Voxel8, Inc. - "
+                 "Released under terms of the AGPLv3 License")
+
+BLOCK_SIZE = 64 * 1024
+
+UPLOAD_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UploadError(Exception):
+    pass
+
+
+# Copy a file in blocks while computing its SHA-256, returns the hex digest
+def copy_with_digest(source, destination, mode="wb"):
+    sha = hashlib.sha256()
+    with open(source, "rb") as src:
+        with open(destination, mode) as dst:
+            for block in iter(lambda: src.read(BLOCK_SIZE), b""):
+                sha.update(block)
+                dst.write(block)
+    return sha.hexdigest()
+
+
+def check_digest(digest, expected):
+    if expected and expected.strip().lower() != digest:
+        raise UploadError("Firmware checksum mismatch")
+
+
+# Collects the chunks of resumable uploads in .part files until they are
+# complete. A client that lost its connection asks for the current offset
+# and continues from there. Completed uploads are remembered for max_age
+# seconds, so a client that lost the answer to its last chunk learns that
+# the upload is complete instead of starting over.
+class ChunkedUploads(object):
+
+    def __init__(self, directory, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+        self._lock = Lock()
+        self._completed = {}
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    # Number of bytes received so far for upload_id
+    def offset(self, upload_id):
+        try:
+            return os.path.getsize(self._path(upload_id))
+        except OSError:
+            return 0
+
+    # Append the chunk stored at source if it starts at the current end of
+    # the upload. Returns the new offset, which the client resumes from.
+    def append(self, upload_id, offset, source):
+        with self._lock:
+            current = self.offset(upload_id)
+            if offset != current:
+                return current
+            if offset == 0:
+                self._remove_stale()
+            copy_with_digest(source, self._path(upload_id), "ab")
+            return self.offset(upload_id)
+
+    # Move the completed upload to destination after checking its digest
+    # against the optional client supplied one. Returns the digest.
+    def finish(self, upload_id, destination, expected=None):
+        with self._lock:
+            path = self._path(upload_id)
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            try:
+                check_digest(digest, expected)
+            except UploadError:
+                os.remove(path)
+                raise
+            shutil.move(path, destination)
+            return digest
+
+    # Remember that upload_id is complete at offset and handled by the
+    # update job with id job
+    def complete(self, upload_id, offset, job):
+        with self._lock:
+            now = time()
+            for other, entry in list(self._completed.items()):
+                if now - entry['time'] > self.max_age:
+                    del self._completed[other]
+            self._completed[upload_id] = dict(offset=offset, job=job,
+                                              time=now)
+
+    # Offset and job id of a completed upload, None if it isn't complete
+    def completed(self, upload_id):
+        with self._lock:
+            entry = self._completed.get(upload_id)
+            if entry is None or time() - entry['time'] > self.max_age:
+                return None
+            return dict(offset=entry['offset'], job=entry['job'])
+
+    def discard(self, upload_id):
+        try:
+            os.remove(self._path(upload_id))
+        except OSError:
+            pass
+
+    def _remove_stale(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if time() - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _path(self, upload_id):
+        if not UPLOAD_ID_PATTERN.match(upload_id or ""):
+            raise UploadError("Invalid upload id")
+        return os.path.join(self.directory, upload_id + ".part")
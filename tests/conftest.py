@@ -0,0 +1,46 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The helper modules of the plugin don't need OctoPrint. Without it, the
+# package is registered without running its __init__ so they can still be
+# imported; tests of the plugin itself are skipped then.
+try:
+    import octoprint  # noqa: F401
+except ImportError:
+    package = types.ModuleType("octoprint_firmwareupdate")
+    package.__path__ = [os.path.join(ROOT, "octoprint_firmwareupdate")]
+    sys.modules["octoprint_firmwareupdate"] = package
+
+
+@pytest.fixture
+def make_plugin(tmpdir, monkeypatch):
+    pytest.importorskip("octoprint")
+    from .fakes import DIRECTORY
+    from .fakes.plugin import create_plugin, wait_idle
+
+    monkeypatch.setenv("HOME", str(tmpdir.mkdir("home")))
+    monkeypatch.setenv("PATH", DIRECTORY + os.pathsep + os.environ["PATH"])
+    plugins = []
+
+    # folder names the data folder, for several plugins in one test
+    def make(*args, **kwargs):
+        folder = kwargs.pop("folder", "data")
+        plugin = create_plugin(str(tmpdir.join(folder)), *args, **kwargs)
+        plugins.append(plugin)
+        return plugin
+
+    yield make
+    for plugin in plugins:
+        plugin._prefetcher.stop()
+        plugin._scheduler.clear()
+        plugin._cancel_update()
+        wait_idle(plugin)
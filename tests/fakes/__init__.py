@@ -0,0 +1,54 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import random
+
+from octoprint_firmwareupdate.hexfile import (_record, page_count,
+                                              write_hex)
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Fake avrdude script, see its header for the behaviours it can be set to
+AVRDUDE = os.path.join(DIRECTORY, "avrdude")
+
+
+# Random firmware image of size bytes, the same for the same seed
+def make_image(size=8192, seed=1):
+    generator = random.Random(seed)
+    return bytearray(generator.getrandbits(8) for _ in range(size))
+
+
+# Write image to path as a complete Intel HEX file
+def write_firmware(path, image):
+    write_hex(path, image, range(page_count(image)))
+    return path
+
+
+# Write image to path as Intel HEX with record_size data bytes per record.
+# Small records make multi-megabyte files out of an image that fits the
+# flash.
+def write_records(path, image, record_size=1):
+    with open(path, "w") as f:
+        for start in range(0, len(image), record_size):
+            if start % 0x10000 == 0:
+                f.write(_record(0, 0x04, bytearray(
+                    [(start >> 24) & 0xFF, (start >> 16) & 0xFF])))
+            f.write(_record(start & 0xFFFF, 0x00,
+                            bytearray(image[start:start + record_size])))
+        f.write(_record(0, 0x01, bytearray()))
+    return path
+
+
+# Serial port for the reset pulse of the avrdude engine, which the fake
+# avrdude doesn't need
+class NoResetSerial(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def setDTR(self, value):
+        pass
+
+    def close(self):
+        pass
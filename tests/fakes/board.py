@@ -0,0 +1,200 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import pty
+import tty
+import select
+import struct
+import threading
+from time import sleep
+
+from octoprint_firmwareupdate.hexfile import FLASH_SIZE
+
+MESSAGE_START = 0x1B
+TOKEN = 0x0E
+STATUS_CMD_OK = 0x00
+STATUS_CMD_UNKNOWN = 0xC9
+
+SIGNATURE = bytearray([0x1E, 0x98, 0x01])
+
+# Values of the STK500v2 parameters avrdude asks for
+PARAMETERS = {0x90: 0x02, 0x91: 0x02, 0x92: 0x0A, 0x94: 50, 0x95: 0,
+              0x96: 0, 0x97: 1, 0x98: 1, 0x9A: 0}
+
+FIRMWARE_REPORT = ("FIRMWARE_NAME:%s SOURCE_CODE_URL:https://github.com/"
+                   "Voxel8/Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:Voxel8 "
+                   "EXTRUDER_COUNT:1\n")
+
+
+# ATmega2560 board on the far side of a pty pair. It answers as the
+# STK500v2 bootloader until the programmer leaves programming mode, then as
+# Marlin, which answers M115 with firmware_name. Trouble can be injected:
+#
+#   page_delay     seconds each page takes to program
+#   silent         never answer, like a board that doesn't reset
+#   stall_after    stop answering after this many programmed pages
+#   stall_reads    stop answering after this many read pages
+#   corrupt        program every page with its first byte flipped
+class FakeBoard(object):
+
+    def __init__(self, firmware_name="Marlin", page_delay=0, silent=False,
+                 stall_after=None, stall_reads=None, corrupt=False):
+        self.firmware_name = firmware_name
+        self.page_delay = page_delay
+        self.silent = silent
+        self.stall_after = stall_after
+        self.stall_reads = stall_reads
+        self.corrupt = corrupt
+        self.flash = bytearray(b"\xff") * FLASH_SIZE
+        # Commands received, by command byte
+        self.commands = []
+        self.pages_written = 0
+        self.pages_read = 0
+        self.bootloader = True
+        self._address = 0
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        pending = bytearray()
+        while not self._stopped.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                pending += bytearray(os.read(self._master, 4096))
+            except OSError:
+                continue
+            if self.silent:
+                pending = bytearray()
+            elif self.bootloader:
+                pending = self._bootloader(pending)
+            else:
+                pending = self._firmware(pending)
+
+    def _bootloader(self, pending):
+        while True:
+            start = pending.find(bytearray([MESSAGE_START]))
+            if start < 0:
+                return bytearray()
+            pending = pending[start:]
+            if len(pending) < 5:
+                return pending
+            if pending[4] != TOKEN:
+                pending = pending[1:]
+                continue
+            length = (pending[2] << 8) | pending[3]
+            if len(pending) < 6 + length:
+                return pending
+            message = pending[:6 + length]
+            pending = pending[6 + length:]
+            if _checksum(message[:-1]) != message[-1]:
+                continue
+            answer = self._command(message[5:-1])
+            if answer is None:
+                # Stalled; the programmer times out
+                return bytearray()
+            self._send(message[1], answer)
+
+    def _firmware(self, pending):
+        # A programmer talking to the board means it was reset into the
+        # bootloader
+        if MESSAGE_START in pending:
+            self.bootloader = True
+            return self._bootloader(pending)
+        while b"\n" in pending:
+            line, pending = pending.split(b"\n", 1)
+            if line.strip().startswith(b"M115"):
+                self._write(FIRMWARE_REPORT % self.firmware_name)
+                self._write("ok\n")
+        return pending
+
+    def _command(self, body):
+        command = body[0]
+        self.commands.append(command)
+        if command == 0x01:
+            return bytearray([command, STATUS_CMD_OK, 8]) + b"AVRISP_2"
+        if command == 0x03:
+            return bytearray([command, STATUS_CMD_OK,
+                              PARAMETERS.get(body[1], 0)])
+        if command == 0x06:
+            address = struct.unpack(">I", bytes(body[1:5]))[0]
+            self._address = (address & 0x7FFFFFFF) << 1
+            return bytearray([command, STATUS_CMD_OK])
+        if command == 0x11:
+            self.bootloader = False
+            self._write("start\n")
+            return bytearray([command, STATUS_CMD_OK])
+        if command == 0x12:
+            self.flash[:] = bytearray(b"\xff") * FLASH_SIZE
+            return bytearray([command, STATUS_CMD_OK])
+        if command == 0x13:
+            if (self.stall_after is not None and
+                    self.pages_written >= self.stall_after):
+                return None
+            length = (body[1] << 8) | body[2]
+            data = bytearray(body[10:10 + length])
+            if self.corrupt and data:
+                data[0] ^= 0xFF
+            if self.page_delay:
+                sleep(self.page_delay)
+            self.flash[self._address:self._address + length] = data
+            self._address += length
+            self.pages_written += 1
+            return bytearray([command, STATUS_CMD_OK])
+        if command == 0x14:
+            if (self.stall_reads is not None and
+                    self.pages_read >= self.stall_reads):
+                return None
+            length = (body[1] << 8) | body[2]
+            data = self.flash[self._address:self._address + length]
+            self._address += length
+            self.pages_read += 1
+            return (bytearray([command, STATUS_CMD_OK]) + data +
+                    bytearray([STATUS_CMD_OK]))
+        if command in (0x18, 0x1A):
+            return bytearray([command, STATUS_CMD_OK, 0xFF, STATUS_CMD_OK])
+        if command == 0x1B:
+            return bytearray([command, STATUS_CMD_OK, SIGNATURE[body[4] % 3],
+                              STATUS_CMD_OK])
+        if command == 0x1D:
+            return (bytearray([command, STATUS_CMD_OK]) +
+                    bytearray(body[2]) + bytearray([STATUS_CMD_OK]))
+        if command in (0x02, 0x10):
+            return bytearray([command, STATUS_CMD_OK])
+        return bytearray([command, STATUS_CMD_UNKNOWN])
+
+    def _send(self, sequence, body):
+        message = bytearray([MESSAGE_START, sequence, (len(body) >> 8) & 0xFF,
+                             len(body) & 0xFF, TOKEN]) + body
+        message.append(_checksum(message))
+        os.write(self._master, bytes(message))
+
+    def _write(self, text):
+        os.write(self._master, text.encode("ascii"))
+
+
+def _checksum(data):
+    checksum = 0
+    for byte in data:
+        checksum ^= byte
+    return checksum
@@ -0,0 +1,181 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import copy
+import inspect
+import logging
+import threading
+from time import sleep, time
+
+import flask
+from werkzeug.serving import make_server
+
+import octoprint_firmwareupdate
+from octoprint_firmwareupdate.ports import PortIndex
+
+# Hardware ID of the Arduino Mega 2560 R3 the fake ports pretend to be
+HWID = "USB VID:PID=2341:0042 SNR=FAKE%d"
+
+
+# Plugin settings backed by a dict of the defaults and the given overrides
+class FakeSettings(object):
+
+    def __init__(self, defaults, overrides):
+        self.values = copy.deepcopy(defaults)
+        for name, value in overrides.items():
+            if isinstance(value, dict) and isinstance(
+                    self.values.get(name), dict):
+                self.values[name].update(value)
+            else:
+                self.values[name] = value
+
+    def get(self, path):
+        value = self.values
+        for name in path:
+            value = value[name]
+        return value
+
+    get_int = get_float = get_boolean = get
+
+    def set(self, path, value):
+        target = self.values
+        for name in path[:-1]:
+            target = target[name]
+        target[path[-1]] = value
+
+    set_int = set_float = set_boolean = set
+
+    def save(self):
+        pass
+
+    def global_get(self, path):
+        if path == ["server", "uploads", "pathSuffix"]:
+            return "path"
+        return None
+
+
+# Printer connection that records connects and disconnects
+class FakePrinter(object):
+
+    def __init__(self):
+        self.printing = False
+        self.calls = []
+
+    def is_printing(self):
+        return self.printing
+
+    def is_paused(self):
+        return False
+
+    def is_operational(self):
+        return False
+
+    def connect(self, *args, **kwargs):
+        self.calls.append(("connect", time()))
+
+    def disconnect(self):
+        self.calls.append(("disconnect", time()))
+
+    def get_current_connection(self):
+        return ("Closed", None, None, None)
+
+    def last(self, call):
+        times = [moment for name, moment in self.calls if name == call]
+        return times[-1] if times else None
+
+
+# Keeps the plugin messages sent to the front-end with the time they were
+# sent
+class FakePluginManager(object):
+
+    def __init__(self):
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def send_plugin_message(self, identifier, data):
+        with self._lock:
+            self.messages.append((time(), data))
+
+    # Messages with the given status, oldest first
+    def statuses(self, status=None):
+        with self._lock:
+            return [(moment, data) for moment, data in self.messages
+                    if status is None or data.get('status') == status]
+
+
+# Plugin set up the way OctoPrint sets it up, with its data in
+# data_folder, the given devices attached as Mega 2560 boards and settings
+# overriding the defaults. HOME has to point at a scratch directory first,
+# as the firmware and version files live below it.
+def create_plugin(data_folder, devices=(), release_url=None, **settings):
+    plugin = octoprint_firmwareupdate.FirmwareUpdatePlugin()
+    plugin._identifier = "firmwareupdate"
+    plugin._plugin_version = "test"
+    plugin._logger = logging.getLogger("octoprint.plugins.firmwareupdate")
+    plugin._settings = FakeSettings(plugin.get_settings_defaults(), settings)
+    plugin._printer = FakePrinter()
+    plugin._plugin_manager = FakePluginManager()
+    plugin._data_folder = data_folder
+    plugin.get_plugin_data_folder = lambda: data_folder
+    plugin.initialize()
+    devices = list(devices)
+    plugin._ports = PortIndex(
+        lister=lambda: [(device, "Arduino Mega 2560", HWID % index)
+                        for index, device in enumerate(devices)],
+        watched=())
+    if release_url is not None:
+        plugin._releases.url = release_url
+    return plugin
+
+
+# Blueprint routes of plugin served over HTTP on a local port, mounted
+# where OctoPrint mounts them. Only routes without OctoPrint's access checks
+# can be used, like those of the fleet.
+class BlueprintServer(object):
+
+    def __init__(self, plugin):
+        plugin._basefolder = os.path.dirname(
+            os.path.abspath(octoprint_firmwareupdate.__file__))
+        app = flask.Flask(__name__)
+        app.register_blueprint(plugin.get_blueprint(),
+                               url_prefix="/plugin/" + plugin._identifier)
+        self._server = make_server("127.0.0.1", 0, app, threaded=True)
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_port
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Call the blueprint route name of plugin without OctoPrint's access checks
+# around it, which need a logged in user
+def call_route(plugin, name, *args):
+    route = inspect.unwrap(getattr(type(plugin), name))
+    return route(plugin, *args)
+
+
+# Wait until predicate returns True, for at most timeout seconds
+def wait_for(predicate, timeout=10):
+    deadline = time() + timeout
+    while not predicate():
+        if time() > deadline:
+            raise AssertionError("Condition not met within %s seconds"
+                                 % timeout)
+        sleep(0.02)
+
+
+# Wait until every update request of plugin has been carried out
+def wait_idle(plugin, timeout=30):
+    wait_for(lambda: plugin._scheduler.as_dict() ==
+             dict(current=None, queued=[]), timeout)
@@ -0,0 +1,219 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import hashlib
+import threading
+from time import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+RELEASE_PATH = "/repos/Voxel8/Marlin/releases/latest"
+# Routes of a fleet coordinator, which hands out the release and takes the
+# reports of its peers
+FLEET_RELEASE_PATH = "/plugin/firmwareupdate/fleet/release"
+FLEET_REPORT_PATH = "/plugin/firmwareupdate/fleet/report"
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Local stand-in for the GitHub releases API and the downloads of release
+# assets, which also answers as a fleet coordinator and keeps the reports
+# peers send in reports. Every request is counted, and the answers can be
+# slowed down, held back or cut off to inject network trouble:
+#
+#   release_delay  seconds before a release lookup is answered
+#   rate           download speed in bytes per second, None for no limit
+#   drop_after     bytes after which a download connection is closed
+#   drops          number of downloads still to cut off at drop_after
+#   hang           hold downloads after their headers until stopped
+class ReleaseServer(object):
+
+    def __init__(self):
+        self.release = None
+        self.etag = None
+        self.files = {}
+        self.requests = []
+        self.reports = []
+        self.release_delay = 0
+        self.rate = None
+        self.drop_after = None
+        self.drops = 0
+        self.hang = False
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    @property
+    def release_url(self):
+        return self.url + RELEASE_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Make content the firmware of the latest release, published as
+    # version. Further assets, like patches, are given as name: content.
+    # image_digest is put in the label of the firmware asset.
+    def publish(self, version, content, digest=True, extra_assets=None,
+                image_digest=None):
+        assets = []
+        for index, (name, data) in enumerate(
+                [("firmware.hex", content)] +
+                sorted((extra_assets or {}).items())):
+            self.files[name] = bytes(data)
+            asset = dict(id=index + 1, name=name, updated_at=version,
+                         size=len(data),
+                         browser_download_url="%s/files/%s" % (self.url,
+                                                               name))
+            if digest:
+                asset['digest'] = "sha256:" + hashlib.sha256(
+                    bytes(data)).hexdigest()
+            if image_digest is not None and name == "firmware.hex":
+                asset['label'] = "image-sha256:" + image_digest
+            assets.append(asset)
+        self.release = dict(tag_name=version, assets=assets)
+        self.etag = '"%s"' % hashlib.sha1(
+            json.dumps(self.release, sort_keys=True).encode(
+                "utf-8")).hexdigest()
+
+    # Number of requests made for path, or all requests
+    def count(self, path=None):
+        with self._lock:
+            return len([request for request in self.requests
+                        if path is None or request['path'] == path])
+
+    def _record(self, handler):
+        with self._lock:
+            self.requests.append(dict(path=handler.path.split("?")[0],
+                                      headers=dict(handler.headers.items()),
+                                      time=time()))
+
+
+def _handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            server._record(self)
+            path = self.path.split("?")[0]
+            if path in (RELEASE_PATH, FLEET_RELEASE_PATH):
+                self._release()
+            elif (path.startswith("/files/") and
+                  path[len("/files/"):] in server.files):
+                self._download(server.files[path[len("/files/"):]])
+            else:
+                self._send(404, b"Not Found")
+
+        def do_POST(self):
+            server._record(self)
+            body = self.rfile.read(int(self.headers.get("Content-Length",
+                                                        0)))
+            if self.path.split("?")[0] == FLEET_REPORT_PATH:
+                with server._lock:
+                    server.reports.append(json.loads(body.decode("utf-8")))
+                self._send(200, b"{}")
+            else:
+                self._send(404, b"Not Found")
+
+        def _release(self):
+            if server.release_delay:
+                server._stopped.wait(server.release_delay)
+            if server.release is None:
+                self._send(404, b"Not Found")
+            elif self.headers.get("If-None-Match") == server.etag:
+                self.send_response(304)
+                self.send_header("ETag", server.etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self._send(200, json.dumps(server.release).encode("utf-8"),
+                           [("ETag", server.etag),
+                            ("Content-Type", "application/json")])
+
+        def _download(self, content):
+            start = 0
+            status = 200
+            headers = [("Accept-Ranges", "bytes")]
+            requested = self.headers.get("Range")
+            if requested:
+                start = int(requested.split("=")[1].split("-")[0])
+                if start >= len(content):
+                    self._send(416, b"", [("Content-Range",
+                                           "bytes */%d" % len(content))])
+                    return
+                status = 206
+                headers.append(("Content-Range", "bytes %d-%d/%d" % (
+                    start, len(content) - 1, len(content))))
+            body = content[start:]
+
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if server.hang:
+                server._stopped.wait()
+                self.close_connection = True
+                return
+
+            limit = len(body)
+            with server._lock:
+                if server.drops > 0 and server.drop_after is not None:
+                    server.drops -= 1
+                    limit = min(limit, server.drop_after)
+            sent = 0
+            began = time()
+            while sent < limit and not server._stopped.is_set():
+                block = body[sent:min(limit, sent + 4096)]
+                self.wfile.write(block)
+                self.wfile.flush()
+                sent += len(block)
+                if server.rate:
+                    ahead = sent / float(server.rate) - (time() - began)
+                    if ahead > 0:
+                        server._stopped.wait(ahead)
+            if sent < len(body):
+                # Cut off mid-stream
+                self.close_connection = True
+
+        def _send(self, status, body, headers=()):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
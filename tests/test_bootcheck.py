@@ -0,0 +1,104 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import pytest
+
+from octoprint_firmwareupdate import bootcheck
+from octoprint_firmwareupdate.bootcheck import (BootError, check_boot,
+                                                firmware_name,
+                                                image_firmware_name)
+
+from .fakes import make_image, write_firmware
+from .fakes.board import FIRMWARE_REPORT, FakeBoard
+
+
+# Ask again quickly while the firmware doesn't answer
+@pytest.fixture(autouse=True)
+def resend_interval(monkeypatch):
+    monkeypatch.setattr(bootcheck, "RESEND_INTERVAL", 0.2)
+
+
+# Release image with Marlin's M115 report compiled in
+def marlin_image(name="Marlin"):
+    image = make_image()
+    report = (FIRMWARE_REPORT % name).strip().encode("ascii") + b"\x00"
+    image[4096:4096 + len(report)] = report
+    return image
+
+
+# Board that runs its firmware already, like one that was just flashed
+def running(board):
+    board.bootloader = False
+    return board
+
+
+def test_firmware_name():
+    assert firmware_name(FIRMWARE_REPORT % "Marlin 1.1") == "Marlin 1.1"
+    assert firmware_name("ok") is None
+    assert image_firmware_name(marlin_image()) == "Marlin"
+    assert image_firmware_name(make_image()) is None
+
+
+def test_boot_check():
+    with running(FakeBoard()) as board:
+        report = check_boot(board.port, expected="Marlin", timeout=5)
+    assert report.startswith("FIRMWARE_NAME:Marlin ")
+
+
+def test_other_firmware_fails_the_boot_check():
+    with running(FakeBoard(firmware_name="Repetier")) as board:
+        with pytest.raises(BootError) as e:
+            check_boot(board.port, expected="Marlin", timeout=5)
+    assert "Repetier instead of Marlin" in str(e.value)
+
+
+def test_board_that_never_answers_times_out():
+    with FakeBoard(silent=True) as board:
+        with pytest.raises(BootError) as e:
+            check_boot(board.port, timeout=1)
+    assert "did not start" in str(e.value)
+
+
+def flash(tmpdir, make_plugin, board, **settings):
+    import flask
+    from .fakes.plugin import call_route, wait_idle
+
+    plugin = make_plugin([board.port], flash_engine="stk500v2",
+                         verify_mode="boot", flash_retries=0, **settings)
+    path = write_firmware(str(tmpdir.join("marlin.hex")), marlin_image())
+    with flask.Flask(__name__).test_request_context(
+            method="POST", data={"file.path": path}):
+        assert call_route(plugin, "upload_file").status_code == 200
+    wait_idle(plugin)
+    return plugin
+
+
+def test_update_checks_the_boot(tmpdir, make_plugin):
+    with FakeBoard() as board:
+        plugin = flash(tmpdir, make_plugin, board)
+    assert plugin._update.state == "completed"
+    # No readback, the firmware reporting itself is the check
+    assert board.pages_written and not board.pages_read
+    job = plugin._jobs.jobs[0]
+    assert job.boot_time is not None
+    assert "boot" in job.as_dict()['timings']
+
+
+def test_update_fails_on_other_firmware(tmpdir, make_plugin):
+    with FakeBoard(firmware_name="Repetier") as board:
+        plugin = flash(tmpdir, make_plugin, board)
+    assert plugin._update.state == "error"
+    _, error = plugin._plugin_manager.statuses("error")[-1]
+    assert "Repetier instead of Marlin" in error['message']
+
+
+def test_update_fails_when_the_firmware_never_starts(tmpdir, make_plugin,
+                                                     monkeypatch):
+    with FakeBoard() as board:
+        # The board takes the flash but the firmware never answers M115
+        monkeypatch.setattr(board, "_firmware", lambda pending: bytearray())
+        plugin = flash(tmpdir, make_plugin, board,
+                       stage_timeouts={"boot": 1})
+    assert plugin._update.state == "error"
+    _, error = plugin._plugin_manager.statuses("error")[-1]
+    assert error['message'] == "Firmware did not start on %s" % board.port
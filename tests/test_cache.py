@@ -0,0 +1,53 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+
+from octoprint_firmwareupdate.cache import FirmwareCache, file_digest
+
+
+def write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def index_mtime(cache):
+    return os.stat(os.path.join(cache.directory,
+                                FirmwareCache.INDEX_FILE)).st_mtime_ns
+
+
+def test_put_and_restore(tmpdir):
+    cache = FirmwareCache(str(tmpdir.join("cache")), 1024)
+    source = write(str(tmpdir.join("a.hex")), b"a" * 100)
+    digest = cache.put(source, "release:1")
+    assert digest == file_digest(source)
+    destination = str(tmpdir.join("restored.hex"))
+    assert cache.restore("release:1", destination) == digest
+    assert open(destination, "rb").read() == b"a" * 100
+
+
+def test_lookups_do_not_write_the_index(tmpdir):
+    cache = FirmwareCache(str(tmpdir.join("cache")), 1024)
+    digest = cache.put(write(str(tmpdir.join("a.hex")), b"a" * 100),
+                       "release:1")
+    cache.set_latest("release:1", "v1")
+    before = index_mtime(cache)
+    for _ in range(20):
+        assert cache.get_latest()['version'] == "v1"
+        assert cache.get("release:1") is not None
+        assert cache.get_digest(digest) is not None
+    assert index_mtime(cache) == before
+
+
+def test_least_recently_used_image_is_evicted(tmpdir):
+    cache = FirmwareCache(str(tmpdir.join("cache")), 250)
+    cache.put(write(str(tmpdir.join("a.hex")), b"a" * 100), "a")
+    cache.put(write(str(tmpdir.join("b.hex")), b"b" * 100), "b")
+    # Only use counts, not looking the image up
+    cache.restore("a", str(tmpdir.join("restored.hex")))
+    cache.get("b")
+    cache.put(write(str(tmpdir.join("c.hex")), b"c" * 100), "c")
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
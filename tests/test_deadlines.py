@@ -0,0 +1,149 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from time import time
+
+import pytest
+
+from serial import Serial
+
+from octoprint_firmwareupdate import stk500v2
+from octoprint_firmwareupdate.flasher import Flasher
+from octoprint_firmwareupdate.stk500v2 import Stk500v2Flasher
+
+from .fakes import NoResetSerial, make_image, write_firmware
+from .fakes.board import FakeBoard
+from .fakes.server import ReleaseServer
+
+
+# Serial port that records when it was first closed; the garbage
+# collector closes it once more
+class RecordingSerial(Serial):
+
+    closed_at = None
+
+    def close(self):
+        Serial.close(self)
+        if RecordingSerial.closed_at is None:
+            RecordingSerial.closed_at = time()
+
+
+def test_cancel_returns_once_the_port_is_released(tmpdir, monkeypatch):
+    monkeypatch.setattr(stk500v2, "Serial", RecordingSerial)
+    monkeypatch.setattr(RecordingSerial, "closed_at", None)
+    results = []
+    writing = threading.Event()
+    flasher = Stk500v2Flasher(
+        on_result=lambda flasher: results.append((flasher.result, time())),
+        on_progress=lambda phase, progress: writing.set(),
+        progress_interval=0)
+    image = make_image(16384)
+    path = write_firmware(str(tmpdir.join("firmware.hex")), image)
+
+    with FakeBoard(page_delay=0.05) as board:
+        thread = threading.Thread(target=flasher.flash,
+                                  args=(board.port, path))
+        thread.start()
+        assert writing.wait(5)
+        flasher.cancel()
+        cancelled = time()
+        thread.join(5)
+        assert board.pages_written < len(image) // 256
+
+    assert [result for result, _ in results] == [Flasher.CANCELLED]
+    assert RecordingSerial.closed_at <= results[0][1] <= cancelled
+
+
+def test_cancel_before_flashing_leaves_the_port_alone(tmpdir, monkeypatch):
+    monkeypatch.setattr(stk500v2, "Serial", RecordingSerial)
+    monkeypatch.setattr(RecordingSerial, "closed_at", None)
+    flasher = Stk500v2Flasher()
+    flasher.cancel()
+    path = write_firmware(str(tmpdir.join("firmware.hex")), make_image())
+    with FakeBoard() as board:
+        assert flasher.flash(board.port, path) == Flasher.CANCELLED
+        assert board.commands == []
+    assert RecordingSerial.closed_at is None
+
+
+@pytest.fixture
+def release(tmpdir):
+    content = open(write_firmware(str(tmpdir.join("release.hex")),
+                                  make_image()), "rb").read()
+    with ReleaseServer() as server:
+        server.publish("v2", content)
+        yield server
+
+
+# Stage that hangs, how it is made to hang and further settings
+HANGS = [
+    ("lookup", dict(release_delay=10), {}, {}),
+    ("download", dict(hang=True), {}, {}),
+    ("reset", {}, dict(FAKE_AVRDUDE_MODE="hang-reset"), {}),
+    ("program", {}, dict(FAKE_AVRDUDE_MODE="hang-program"), {}),
+    ("verify", {}, dict(FAKE_AVRDUDE_MODE="hang-verify"), {}),
+]
+
+
+@pytest.mark.parametrize("stage, server_options, environment, settings",
+                         HANGS, ids=[hang[0] for hang in HANGS])
+def test_hung_stage_is_aborted(release, make_plugin, monkeypatch, stage,
+                               server_options, environment, settings):
+    from octoprint_firmwareupdate import flasher
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    for name, value in server_options.items():
+        setattr(release, name, value)
+    deadline = 1
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=release.release_url,
+                         flash_retries=0, stage_timeouts={stage: deadline},
+                         **settings)
+
+    started = time()
+    plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+    wait_idle(plugin, timeout=10)
+    elapsed = time() - started
+
+    assert plugin._update.state == "error"
+    assert elapsed < deadline + 3
+    # The printer is given back once the update is over
+    assert plugin._printer.last("connect") > plugin._printer.last(
+        "disconnect")
+    for job in plugin._jobs.jobs:
+        assert job.flasher.process.poll() is not None
+    if stage in ("reset", "program", "verify"):
+        _, error = plugin._plugin_manager.statuses("error")[-1]
+        assert error['message'] == ("The %s stage did not finish in time."
+                                    % stage)
+
+
+def test_cancel_before_the_flash_jobs_exist(release, make_plugin,
+                                            monkeypatch):
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    with FakeBoard() as board:
+        plugin = make_plugin([board.port], release_url=release.release_url,
+                             flash_engine="stk500v2")
+        select_ports = plugin._select_ports
+
+        # The cancel arrives while the worker picks the ports to flash
+        def cancel_and_select():
+            plugin._cancel_update()
+            return select_ports()
+
+        monkeypatch.setattr(plugin, "_select_ports", cancel_and_select)
+        plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+        wait_idle(plugin)
+        plugin._update_firmware_thread.join(5)
+
+        assert plugin._update.state == "cancelled"
+        assert board.commands == []
+    assert plugin._printer.last("connect") > plugin._printer.last(
+        "disconnect")
+    assert len(plugin._plugin_manager.statuses("cancelled")) == 1
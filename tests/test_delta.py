@@ -0,0 +1,185 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+
+import pytest
+
+from octoprint_firmwareupdate.cache import FirmwareCache
+from octoprint_firmwareupdate.delta import (DeltaError, apply_patch,
+                                            make_patch, patch_digests)
+from octoprint_firmwareupdate.hexfile import parse_hex
+
+from .fakes import NoResetSerial, make_image, write_records
+from .fakes.server import ReleaseServer
+
+
+# Release images that differ in a few places, like successive builds
+def releases(count, size=16384):
+    image = make_image(size)
+    images = []
+    for release in range(count):
+        image = bytearray(image)
+        image[release * 1000:release * 1000 + 40] = make_image(40, release)
+        images.append(bytes(image))
+    return images
+
+
+def test_patch_round_trip():
+    old, new = releases(2)
+    patch = make_patch(old, new)
+    assert len(patch) < len(new) // 10
+    assert apply_patch(old, patch) == new
+    assert patch_digests(patch) == (hashlib.sha256(old).hexdigest(),
+                                    hashlib.sha256(new).hexdigest())
+
+
+def test_patch_for_other_firmware():
+    old, new, other = releases(3)
+    with pytest.raises(DeltaError):
+        apply_patch(other, make_patch(old, new))
+    with pytest.raises(DeltaError):
+        apply_patch(old, make_patch(old, new)[:-1])
+
+
+def test_files_are_found_by_their_image(tmpdir):
+    cache = FirmwareCache(str(tmpdir.join("cache")), 1024 * 1024)
+    image = releases(1)[0]
+    image_digest = hashlib.sha256(image).hexdigest()
+    # Cached without its image digest, which is worked out when needed
+    stored = cache.put(write_records(str(tmpdir.join("a.hex")), image, 16))
+    assert cache.get_image(image_digest) == cache.get_digest(stored)
+    assert cache.get_image("0" * 64) is None
+
+    # The same image written out another way
+    other = cache.put(write_records(str(tmpdir.join("b.hex")), image, 32),
+                      image_digest=image_digest)
+    assert other != stored
+    assert cache.get_image(image_digest) in (cache.get_digest(stored),
+                                             cache.get_digest(other))
+
+
+# Publish the images as releases v1, v2, ... Every release after the first
+# comes with a patch from the previous image, named after its digest the
+# way release builds name them, or with the given patch.
+def publish(tmpdir, server, images, index, patch=None):
+    content = open(write_records(str(tmpdir.join("release.hex")),
+                                 images[index], 32), "rb").read()
+    extra = {}
+    if index:
+        source = hashlib.sha256(images[index - 1]).hexdigest()
+        extra["firmware-%s.delta" % source[:16]] = patch or make_patch(
+            images[index - 1], images[index])
+    server.publish("v%d" % (index + 1), content, extra_assets=extra,
+                   image_digest=hashlib.sha256(images[index]).hexdigest())
+
+
+def test_chain_of_delta_updates(tmpdir, make_plugin, monkeypatch):
+    from octoprint_firmwareupdate import flasher
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    images = releases(4)
+    with ReleaseServer() as server:
+        plugin = make_plugin(["/dev/ttyFAKE0"],
+                             release_url=server.release_url)
+        for index in range(len(images)):
+            publish(tmpdir, server, images, index)
+            plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+            wait_idle(plugin)
+            assert plugin._update.state == "completed"
+            assert plugin._metrics.records[-1]['saved'] == (
+                0 if index == 0 else len(server.files["firmware.hex"]) -
+                len(server.files[server.release['assets'][1]['name']]))
+
+        # Only the first release was downloaded in full
+        assert server.count("/files/firmware.hex") == 1
+        assert len([request for request in server.requests
+                    if request['path'].endswith(".delta")]) == 3
+
+
+# A patch that is consistent in itself but builds another firmware than
+# the release advertises is not installed
+def test_mismatched_patch_is_not_installed(tmpdir, make_plugin,
+                                           monkeypatch):
+    from octoprint_firmwareupdate import flasher
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    images = releases(3)
+    with ReleaseServer() as server:
+        plugin = make_plugin(["/dev/ttyFAKE0"],
+                             release_url=server.release_url)
+        publish(tmpdir, server, images, 0)
+        plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+        wait_idle(plugin)
+
+        # A stale patch from v1 to an older build of v2
+        stale = make_patch(images[0], images[2])
+        publish(tmpdir, server, images, 1, patch=stale)
+        plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+        wait_idle(plugin)
+        assert plugin._update.state == "completed"
+
+        assert server.count("/files/firmware.hex") == 2
+        latest = plugin._cache.get_latest()
+        assert latest['version'] == "v2"
+        assert (parse_hex(plugin._cache.get(latest['key'])).digest ==
+                hashlib.sha256(images[1]).hexdigest())
+
+
+# Cancelling while a patch comes in slowly ends the update without waiting
+# for the patch or starting the full download
+def test_cancel_during_delta_download(tmpdir, make_plugin, monkeypatch):
+    from time import time
+    from octoprint_firmwareupdate import flasher
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_for, wait_idle
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    # Unrelated images make a patch as large as the image
+    images = [bytes(make_image(16384, 1)), bytes(make_image(16384, 2))]
+    with ReleaseServer() as server:
+        plugin = make_plugin(["/dev/ttyFAKE0"],
+                             release_url=server.release_url,
+                             download_chunk_size=1)
+        publish(tmpdir, server, images, 0)
+        plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+        wait_idle(plugin)
+
+        publish(tmpdir, server, images, 1)
+        server.rate = 2048
+        plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+        wait_for(lambda: any(request['path'].endswith(".delta")
+                             for request in server.requests))
+        assert plugin._cancel_update()
+        cancelled = time()
+        wait_idle(plugin)
+        assert time() - cancelled < 3
+        assert plugin._update.state == "cancelled"
+        assert server.count("/files/firmware.hex") == 1
+
+
+def test_coordinator_patches_from_image_digests(tmpdir, make_plugin):
+    import flask
+    from .fakes.plugin import call_route
+
+    old, new = releases(2)
+    plugin = make_plugin(fleet_mode="coordinator", fleet_token="secret")
+    # The peer installed old from a patch and wrote it out anew
+    plugin._cache.put(write_records(str(tmpdir.join("old.hex")), old, 32),
+                      "release:1:v1")
+    target = plugin._cache.put(
+        write_records(str(tmpdir.join("new.hex")), new, 32), "release:2:v2")
+    source = hashlib.sha256(old).hexdigest()
+
+    with flask.Flask(__name__).test_request_context(
+            headers={"X-Fleet-Token": "secret"}):
+        response = call_route(plugin, "fleet_delta", source, target)
+        response.direct_passthrough = False
+        assert response.status_code == 200
+        assert apply_patch(old, response.get_data()) == new
+        missing = call_route(plugin, "fleet_delta", "0" * 64, target)
+        assert missing.status_code == 404
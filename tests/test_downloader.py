@@ -0,0 +1,102 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import hashlib
+import threading
+from time import time
+
+import pytest
+
+from octoprint_firmwareupdate.downloader import (DownloadError,
+                                                 DownloadStopped, Downloader)
+
+from .fakes import make_image
+from .fakes.server import ReleaseServer
+
+FILE_PATH = "/files/firmware.hex"
+
+
+@pytest.fixture
+def server():
+    with ReleaseServer() as server:
+        server.publish("v1", make_image(64 * 1024))
+        yield server
+
+
+def download(tmpdir, server, downloader=None, **kwargs):
+    downloader = downloader or Downloader(chunk_size=4096, timeout=1)
+    content = server.files["firmware.hex"]
+    kwargs.setdefault("size", len(content))
+    kwargs.setdefault("digest", hashlib.sha256(content).hexdigest())
+    path = str(tmpdir.join("firmware.hex"))
+    return downloader.download(server.url + FILE_PATH, path, **kwargs), path
+
+
+# Connections are dropped at a chunk boundary, as the chunk being read when
+# the connection breaks is lost
+def test_dropped_connections_are_resumed(tmpdir, server):
+    server.drop_after = 8192
+    server.drops = 3
+    digest, path = download(tmpdir, server)
+    assert open(path, "rb").read() == server.files["firmware.hex"]
+    assert server.count(FILE_PATH) == 4
+    ranges = [request['headers'].get("Range")
+              for request in server.requests]
+    assert ranges == [None, "bytes=8192-", "bytes=16384-", "bytes=24576-"]
+
+
+def test_too_many_drops(tmpdir, server):
+    server.drop_after = 8192
+    server.drops = 10
+    downloader = Downloader(chunk_size=4096, retries=2, timeout=1)
+    with pytest.raises(IOError):
+        download(tmpdir, server, downloader)
+    assert server.count(FILE_PATH) == 3
+    assert not os.path.exists(str(tmpdir.join("firmware.hex")))
+
+    # The next download continues where the last one stopped
+    server.drops = 0
+    download(tmpdir, server, downloader)
+    assert server.requests[-1]['headers'].get("Range") == "bytes=24576-"
+
+
+def test_corrupt_download_is_discarded(tmpdir, server):
+    with pytest.raises(DownloadError):
+        download(tmpdir, server, digest="0" * 64)
+    with pytest.raises(DownloadError):
+        download(tmpdir, server, size=10)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_stop_is_checked_before_every_retry(tmpdir, server):
+    server.drop_after = 8192
+    server.drops = 10
+    stopped = threading.Event()
+
+    def on_block(received):
+        if received >= 8192:
+            stopped.set()
+
+    with pytest.raises(DownloadStopped):
+        download(tmpdir, server, stop=stopped.is_set, on_block=on_block)
+    assert server.count(FILE_PATH) == 1
+
+
+def test_stalled_server_is_not_retried_once_stopped(tmpdir, server):
+    server.hang = True
+    deadline = time() + 1.5
+    started = time()
+    with pytest.raises(DownloadStopped):
+        download(tmpdir, server, Downloader(retries=5, timeout=0.5),
+                 stop=lambda: time() > deadline)
+    assert time() - started < 2.5
+
+
+
+def test_size_cap(tmpdir, server):
+    with pytest.raises(DownloadError):
+        download(tmpdir, server, size=None, max_size=1000)
+    assert os.listdir(str(tmpdir)) == []
+    digest, _ = download(tmpdir, server, max_size=64 * 1024)
+    assert digest == hashlib.sha256(server.files["firmware.hex"]).hexdigest()
@@ -0,0 +1,339 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+from time import sleep
+
+import pytest
+
+from octoprint_firmwareupdate.fleet import Rollout, RolloutStore, parse_range
+
+from .fakes import NoResetSerial, make_image, write_firmware
+from .fakes.server import FLEET_REPORT_PATH, ReleaseServer
+
+# Peer ids by the wave they fall into with waves of 50% and 100%, once the
+# canary has been picked
+WAVE_1 = ("peer-1", "peer-7")
+WAVE_2 = ("peer-2", "peer-4")
+# Fleet token with characters that have a meaning in URLs
+TOKEN = "s&cr+t#1 ?"
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("items=0-1", None),
+    ("bytes=-", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+def test_unsatisfiable_range():
+    with pytest.raises(ValueError):
+        parse_range("bytes=1000-", 1000)
+
+
+def test_rollout_opens_wave_after_wave():
+    rollout = Rollout("release:1:v2", "v2", "0" * 64, 100, canary=1,
+                      waves=[50, 100])
+    # The first peer to ask is the canary
+    assert rollout.allow("peer-0")
+    assert not rollout.allow(WAVE_1[0])
+    assert not rollout.allow(WAVE_2[0])
+
+    rollout.report("peer-0", "v2", "completed")
+    assert rollout.wave == 1
+    assert rollout.allow(WAVE_1[0]) and rollout.allow(WAVE_1[1])
+    assert not rollout.allow(WAVE_2[0])
+
+    # A wave opens only once every peer allowed so far succeeded
+    rollout.report(WAVE_1[0], "v2", "completed")
+    assert rollout.wave == 1
+    rollout.report(WAVE_1[1], "v2", "completed")
+    assert rollout.wave == 2
+    assert rollout.allow(WAVE_2[0]) and rollout.allow(WAVE_2[1])
+
+    for peer in WAVE_2:
+        rollout.report(peer, "v2", "completed")
+    assert rollout.state == Rollout.FINISHED
+
+
+def test_waves_without_peers_are_skipped():
+    rollout = Rollout("release:1:v2", "v2", "0" * 64, 100, canary=1,
+                      waves=[10, 50, 100])
+    assert rollout.allow("peer-0")
+    rollout.report("peer-0", "v2", "completed")
+    assert rollout.wave == 1
+
+    # No peer falls below 10%; the first one asking opens its own wave
+    assert rollout.allow(WAVE_1[0])
+    assert rollout.wave == 2
+    # A later wave waits until the peers allowed so far succeeded
+    assert not rollout.allow(WAVE_2[0])
+    rollout.report(WAVE_1[0], "v2", "completed")
+    assert rollout.wave == 3
+    assert rollout.allow(WAVE_2[0])
+    # A peer of a skipped wave asking late still gets the release
+    assert rollout.allow(WAVE_1[1])
+    rollout.report(WAVE_2[0], "v2", "completed")
+    rollout.report(WAVE_1[1], "v2", "completed")
+    assert rollout.state == Rollout.FINISHED
+
+
+def test_failures_halt_the_rollout():
+    rollout = Rollout("release:1:v2", "v2", "0" * 64, 100, canary=1,
+                      waves=[50, 100], max_failures=2)
+    assert rollout.allow("peer-0")
+    # Reports of other releases and unknown peers don't count
+    rollout.report("peer-0", "v1", "error")
+    rollout.report("peer-9", "v2", "error")
+    assert rollout.state == Rollout.RUNNING
+
+    rollout.report("peer-0", "v2", "completed")
+    assert rollout.allow(WAVE_1[0]) and rollout.allow(WAVE_1[1])
+    rollout.report(WAVE_1[0], "v2", "error")
+    assert rollout.state == Rollout.RUNNING
+    rollout.report(WAVE_1[1], "v2", "cancelled")
+    assert rollout.state == Rollout.HALTED
+    assert not rollout.allow("peer-0")
+
+
+def test_rollout_survives_restarts(tmpdir):
+    path = str(tmpdir.join("rollout.json"))
+    store = RolloutStore(path)
+    assert store.rollout is None
+    store.start(Rollout("release:1:v2", "v2", "0" * 64, 100, canary=1,
+                        waves=[50, 100]))
+    store.allow("peer-0")
+    store.report("peer-0", "v2", "completed")
+
+    restarted = RolloutStore(path)
+    assert restarted.status() == store.status()
+    assert restarted.rollout.wave == 1
+    assert restarted.allow(WAVE_1[0])
+    restarted.halt()
+    assert RolloutStore(path).status()['state'] == Rollout.HALTED
+
+
+@pytest.fixture
+def coordinator(tmpdir):
+    content = open(write_firmware(str(tmpdir.join("release.hex")),
+                                  make_image()), "rb").read()
+    with ReleaseServer() as server:
+        server.publish("v2", content)
+        yield server
+
+
+@pytest.fixture
+def peer(coordinator, make_plugin, monkeypatch):
+    from octoprint_firmwareupdate import flasher
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    return make_plugin(["/dev/ttyFAKE0"], fleet_mode="peer",
+                       fleet_coordinator=coordinator.url, flash_retries=0)
+
+
+def update(plugin, kind="manual"):
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    plugin._schedule(UpdateRequest(kind))
+    wait_idle(plugin)
+
+
+def reports(coordinator, count):
+    from .fakes.plugin import wait_for
+
+    wait_for(lambda: coordinator.count(FLEET_REPORT_PATH) >= count)
+    # Reports are sent in the background; give stray ones time to arrive
+    sleep(0.3)
+    return [(report['version'], report['status'])
+            for report in coordinator.reports]
+
+
+def test_release_outcomes_are_reported(coordinator, peer, monkeypatch):
+    update(peer)
+    monkeypatch.setenv("FAKE_AVRDUDE_MODE", "fail")
+    coordinator.publish("v3", coordinator.files["firmware.hex"])
+    update(peer)
+    assert reports(coordinator, 2) == [("v2", "completed"),
+                                       ("v3", "error")]
+    assert coordinator.reports[0]['peer'] == peer._fleet_peer_id()
+
+
+def test_other_outcomes_are_not_reported(tmpdir, coordinator, peer,
+                                         monkeypatch):
+    import flask
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import call_route, wait_for, wait_idle
+
+    # Custom firmware, a failed upload and a busy printer
+    path = write_firmware(str(tmpdir.join("custom.hex")), make_image(seed=2))
+    with flask.Flask(__name__).test_request_context(
+            method="POST", data={"file.path": path}):
+        assert call_route(peer, "upload_file").status_code == 200
+    wait_idle(peer)
+    tmpdir.join("broken.hex").write(":00000001FF\n")
+    with flask.Flask(__name__).test_request_context(
+            method="POST", data={"file.path": str(tmpdir.join("broken.hex"))}):
+        assert call_route(peer, "upload_file").status_code == 400
+    peer._printer.printing = True
+    update(peer)
+    peer._printer.printing = False
+
+    # A cancelled release update
+    monkeypatch.setenv("FAKE_AVRDUDE_MODE", "hang-program")
+    flashes = len(peer._plugin_manager.statuses("progress"))
+    peer._schedule(UpdateRequest(UpdateRequest.MANUAL))
+    wait_for(lambda: len(peer._plugin_manager.statuses("progress")) >
+             flashes)
+    assert peer._cancel_update()
+    wait_idle(peer)
+    assert peer._plugin_manager.statuses("cancelled")
+
+    monkeypatch.setenv("FAKE_AVRDUDE_MODE", "ok")
+    update(peer)
+    assert reports(coordinator, 1) == [("v2", "completed")]
+
+
+@pytest.mark.parametrize("token, supplied, status", [
+    ("", None, 403),
+    ("", "", 403),
+    ("secret", None, 403),
+    ("secret", "wrong", 403),
+    ("secret", "secret", 200),
+])
+def test_fleet_token_is_required(make_plugin, token, supplied, status):
+    import flask
+    from .fakes.plugin import call_route
+
+    plugin = make_plugin(fleet_mode="coordinator", fleet_token=token)
+    # Peers only have the token, not an OctoPrint login
+    assert not plugin.is_blueprint_protected()
+    headers = {}
+    if supplied is not None:
+        headers["X-Fleet-Token"] = supplied
+    with flask.Flask(__name__).test_request_context(
+            method="POST", headers=headers,
+            json=dict(peer="peer-0", status="completed")):
+        assert call_route(plugin, "fleet_report").status_code == status
+
+
+# A coordinator plugin serving its fleet routes over HTTP, rolling out
+# release v2 in a canary and waves of 50% and 100% of the peers
+@pytest.fixture
+def fleet(tmpdir, make_plugin, monkeypatch):
+    import flask
+    from octoprint_firmwareupdate import flasher
+    from .fakes.plugin import BlueprintServer
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    coordinator = make_plugin(folder="coordinator", fleet_mode="coordinator",
+                              fleet_token=TOKEN, fleet_canary=1,
+                              fleet_waves=[50, 100], fleet_max_failures=1)
+    image = make_image()
+    coordinator._cache.put(write_firmware(str(tmpdir.join("release.hex")),
+                                          image), "release:1:v2")
+    coordinator._cache.set_latest("release:1:v2", "v2")
+    with flask.Flask(__name__).app_context():
+        assert coordinator._start_rollout().status_code == 200
+
+    with BlueprintServer(coordinator) as server:
+        def make_peer(peer):
+            plugin = make_plugin(["/dev/ttyFAKE0"], folder=peer,
+                                 fleet_mode="peer",
+                                 fleet_coordinator=server.url,
+                                 fleet_token=TOKEN, fleet_peer_id=peer,
+                                 flash_retries=0)
+            plugin.version_file = os.path.join(
+                plugin.get_plugin_data_folder(), "version")
+            return plugin
+        yield coordinator, make_peer
+
+
+def peer_status(coordinator, peer):
+    from .fakes.plugin import wait_for
+
+    wait_for(lambda: (coordinator._rollouts.status()['peers'].get(peer) or
+                      {}).get('status') is not None)
+    return coordinator._rollouts.status()['peers'][peer]['status']
+
+
+def installed(peer):
+    return [data for _, data in peer._plugin_manager.statuses("completed")]
+
+
+def test_rollout_to_peers_in_waves(fleet):
+    coordinator, make_peer = fleet
+    canary, first, second = (make_peer("peer-0"), make_peer(WAVE_1[0]),
+                             make_peer(WAVE_2[0]))
+
+    update(canary)
+    assert installed(canary)
+    assert open(canary.version_file).read() == "v2"
+    # The token travels in a header only, never in URLs that end up in
+    # logs and the stored release metadata
+    with open(os.path.join(canary.get_plugin_data_folder(),
+                           "fleet_release.json")) as f:
+        release = f.read()
+    assert "token" not in release and TOKEN not in release
+    assert peer_status(coordinator, "peer-0") == "completed"
+    assert coordinator._rollouts.rollout.wave == 1
+
+    # Once a peer of the first wave has asked for the release, the second
+    # wave isn't opened before it succeeded; its peer waits without an
+    # error and gets its printer back
+    assert coordinator._rollouts.allow(WAVE_1[0])
+    update(second)
+    assert not installed(second)
+    assert second._update.state == "completed"
+    assert not second._plugin_manager.statuses("error")
+    assert second._printer.calls[-1][0] == "connect"
+
+    update(first)
+    assert installed(first)
+    assert peer_status(coordinator, WAVE_1[0]) == "completed"
+    assert coordinator._rollouts.rollout.wave == 2
+
+    update(second)
+    assert installed(second)
+    assert peer_status(coordinator, WAVE_2[0]) == "completed"
+    assert coordinator._rollouts.rollout.state == Rollout.FINISHED
+
+
+def test_failing_canary_halts_the_rollout(fleet, monkeypatch):
+    coordinator, make_peer = fleet
+    canary, other = make_peer("peer-0"), make_peer(WAVE_1[0])
+
+    monkeypatch.setenv("FAKE_AVRDUDE_MODE", "fail")
+    update(canary)
+    assert canary._update.state == "error"
+    assert peer_status(coordinator, "peer-0") == "error"
+    assert coordinator._rollouts.rollout.state == Rollout.HALTED
+
+    monkeypatch.setenv("FAKE_AVRDUDE_MODE", "ok")
+    update(other)
+    assert not installed(other)
+    assert other._update.state == "completed"
+    # The halt is kept across a restart of the coordinator
+    restarted = RolloutStore(coordinator._rollouts.path)
+    assert restarted.status()['state'] == Rollout.HALTED
+
+
+def test_prefetched_release_is_reported(fleet):
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    coordinator, make_peer = fleet
+    canary = make_peer("peer-0")
+    canary._prefetcher.check()
+    assert canary._prefetched_release()['version'] == "v2"
+
+    canary._schedule(UpdateRequest(UpdateRequest.AUTO, onstartup=True))
+    wait_idle(canary)
+    assert installed(canary)
+    assert peer_status(coordinator, "peer-0") == "completed"
+    assert coordinator._rollouts.rollout.wave == 1
@@ -0,0 +1,96 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import tracemalloc
+
+import pytest
+
+from octoprint_firmwareupdate.hexfile import (FLASH_SIZE, HexError,
+                                              diff_pages, parse_hex)
+
+from .fakes import make_image, write_firmware, write_records
+
+
+def write(tmpdir, lines):
+    path = tmpdir.join("firmware.hex")
+    path.write("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+def test_image_pages_and_digest(tmpdir):
+    image = make_image(1000)
+    parsed = parse_hex(write_firmware(str(tmpdir.join("a.hex")), image))
+    # write_firmware pads the last page with erased bytes
+    assert parsed.data[:1000] == image
+    assert parsed.pages == [0, 1, 2, 3]
+    assert parsed.digest == hashlib.sha256(bytes(parsed.data)).hexdigest()
+
+
+def test_extended_addresses(tmpdir):
+    parsed = parse_hex(write(tmpdir, [
+        ":020000040001F9",      # extended linear address 0x10000
+        ":01000000AA55",
+        ":020000021000EC",      # extended segment address 0x10000
+        ":01001000BB34",
+        ":00000001FF"]))
+    assert parsed.size == 0x10011
+    assert parsed.data[0x10000] == 0xAA
+    assert parsed.data[0x10010] == 0xBB
+    assert parsed.data[0] == 0xFF
+    assert parsed.pages == [0x100]
+
+
+@pytest.mark.parametrize("lines, message", [
+    (["00000001FF"], "missing start code"),
+    ([":0100000G00", ":00000001FF"], "invalid hex digits"),
+    ([":0200000000FE", ":00000001FF"], "record length mismatch"),
+    ([":0100000000FE", ":00000001FF"], "checksum mismatch"),
+    ([":0100000600F9", ":00000001FF"], "unknown record type"),
+    ([":0100000400FB", ":00000001FF"], "invalid address record"),
+    ([":020000040004F6", ":0100000000FF", ":00000001FF"],
+     "outside the flash"),
+    ([":0100000000FF"], "truncated"),
+    ([":00000001FF"], "no data"),
+])
+def test_malformed_files(tmpdir, lines, message):
+    with pytest.raises(HexError) as error:
+        parse_hex(write(tmpdir, lines))
+    assert message in str(error.value)
+
+
+@pytest.mark.parametrize("content", [
+    b":10000000\xff\xfe\x00\x80\n:00000001FF\n",
+    b"\x7fELF\x02\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00",
+])
+def test_binary_files(tmpdir, content):
+    path = tmpdir.join("firmware.hex")
+    path.write_binary(content)
+    with pytest.raises(HexError):
+        parse_hex(str(path))
+
+
+def test_diff_pages():
+    old = make_image(1024)
+    new = bytearray(old)
+    new[300] ^= 0xFF
+    assert diff_pages(old, new) == [1]
+    assert diff_pages(old, new + b"\x00") == [1, 4]
+
+
+def test_large_files_are_streamed(tmpdir):
+    image = make_image(FLASH_SIZE // 4)
+    path = write_records(str(tmpdir.join("large.hex")), image)
+    size = tmpdir.join("large.hex").size()
+    assert size > 800 * 1024
+
+    tracemalloc.start()
+    try:
+        parsed = parse_hex(path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert parsed.data == image
+    # The flash sized image and its copy for the digest, not the file
+    assert peak < 3 * FLASH_SIZE
+    assert peak < size
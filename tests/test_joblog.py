@@ -0,0 +1,103 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+
+from octoprint_firmwareupdate.joblog import JobLog, JobLogStore
+
+
+def messages(entries):
+    return [entry['message'] for entry in entries]
+
+
+def test_tail_continues_at_the_returned_offset(tmpdir):
+    store = JobLogStore(str(tmpdir.join("logs")))
+    log = store.create()
+    log.write("lookup", "one")
+    log.write("download", "two", port="/dev/ttyFAKE0")
+    entries, offset = store.tail(log.id)
+    assert messages(entries) == ["one", "two"]
+    assert entries[1]['port'] == "/dev/ttyFAKE0"
+
+    assert store.tail(log.id, offset) == ([], offset)
+    log.write("flashing", "three")
+    entries, offset = store.tail(log.id, offset)
+    assert messages(entries) == ["three"]
+    assert offset == os.path.getsize(log.path)
+
+
+def test_partial_last_line_is_left_for_the_next_tail(tmpdir):
+    store = JobLogStore(str(tmpdir.join("logs")))
+    log = store.create()
+    log.write("lookup", "complete")
+    with open(log.path, "ab") as f:
+        f.write(b'{"time":1,"stage":"lookup","message":"hal')
+    entries, offset = store.tail(log.id)
+    assert messages(entries) == ["complete"]
+
+    with open(log.path, "ab") as f:
+        f.write(b'f"}\n')
+    entries, offset = store.tail(log.id, offset)
+    assert messages(entries) == ["half"]
+    # Limits that end mid-line only return the complete lines
+    entries, _ = store.tail(log.id, 0, limit=offset - 5)
+    assert messages(entries) == ["complete"]
+
+
+def test_log_is_truncated_at_its_size(tmpdir):
+    log = JobLog(str(tmpdir.join("capped.jsonl")), max_size=200)
+    for index in range(10):
+        log.write("flashing", "line %d" % index)
+    store = JobLogStore(str(tmpdir))
+    entries, _ = store.tail("capped")
+    assert messages(entries)[-1] == "Log truncated"
+    assert entries[-1]['level'] == "warning"
+    assert len(entries) < 10
+    size = os.path.getsize(log.path)
+    log.write("flashing", "dropped")
+    assert os.path.getsize(log.path) == size
+
+
+def test_output_lines_keep_the_last_redraw(tmpdir):
+    log = JobLog(str(tmpdir.join("output.jsonl")))
+    stream = log.stream("/dev/ttyFAKE0", lambda: "program")
+    stream.write(b"Writing | ### | 10%\rWriting | ######")
+    stream.write(b" | 100%\navrdude done")
+    stream.close()
+    entries, _ = JobLogStore(str(tmpdir)).tail("output")
+    assert messages(entries) == ["Writing | ###### | 100%", "avrdude done"]
+    assert set(entry['level'] for entry in entries) == set(["output"])
+    assert set(entry['stage'] for entry in entries) == set(["program"])
+
+
+def test_oldest_logs_are_rotated_out(tmpdir):
+    store = JobLogStore(str(tmpdir.join("logs")), max_size=1000)
+    logs = []
+    for index in range(4):
+        log = store.create()
+        for line in range(4):
+            log.write("flashing", "%d" % line + "x" * 80)
+        log.close()
+        os.utime(log.path, (index, index))
+        logs.append(log)
+
+    # Past the limit, creating a log removes the oldest ones
+    current = store.create()
+    assert not os.path.exists(logs[0].path)
+    assert os.path.exists(logs[-1].path)
+    current.write("lookup", "started")
+    assert store.history()[0]['id'] == current.id
+    assert sum(os.path.getsize(log.path) for log in logs
+               if os.path.exists(log.path)) <= 1000
+
+
+def test_running_log_is_never_rotated_out(tmpdir):
+    store = JobLogStore(str(tmpdir.join("logs")), max_size=100)
+    running = store.create()
+    # Grown past the size of the whole store, and older than any other log
+    with open(running.path, "ab") as f:
+        f.write(b"x" * 500 + b"\n")
+    os.utime(running.path, (0, 0))
+    store._rotate()
+    assert os.path.exists(running.path)
+    assert store.history()[0]['running']
@@ -0,0 +1,223 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from time import sleep
+
+import pytest
+
+from octoprint_firmwareupdate.jobs import FlashJob, FlashJobManager
+
+from .fakes import NoResetSerial, make_image, write_firmware
+from .fakes.board import FakeBoard
+from .fakes.server import ReleaseServer
+
+
+def test_concurrency_limit():
+    manager = FlashJobManager(max_concurrent=2)
+    jobs = [FlashJob("/dev/ttyFAKE%d" % index, "firmware.hex", None)
+            for index in range(5)]
+    lock = threading.Lock()
+    running = []
+    most = []
+
+    def target(job):
+        with lock:
+            running.append(job)
+            most.append(len(running))
+        sleep(0.1)
+        with lock:
+            running.remove(job)
+        manager.finish(job, FlashJob.COMPLETED)
+
+    manager.run(jobs, target)
+    assert max(most) == 2
+    assert all(job.state == FlashJob.COMPLETED for job in jobs)
+    assert [status['port'] for status in manager.statuses()] == [
+        job.port for job in jobs]
+
+
+def test_stage_timeout_cancels_the_job():
+    manager = FlashJobManager(stage_timeouts=dict(reset=0.2))
+    manager.WATCH_INTERVAL = 0.05
+    stuck = FlashJob("/dev/ttyFAKE0", "firmware.hex", None)
+    fine = FlashJob("/dev/ttyFAKE1", "firmware.hex", None)
+
+    def target(job):
+        if job is fine:
+            job.set_progress("writing", 0)
+        while job is stuck and not job.cancelled:
+            sleep(0.01)
+        sleep(0.3)
+        manager.finish(job, FlashJob.COMPLETED)
+
+    manager.run([stuck, fine], target)
+    assert stuck.timed_out and stuck.timeout_stage == FlashJob.RESET
+    assert not fine.timed_out
+
+
+@pytest.fixture
+def release(tmpdir):
+    image = make_image()
+    content = open(write_firmware(str(tmpdir.join("release.hex")), image),
+                   "rb").read()
+    with ReleaseServer() as server:
+        server.publish("v2", content)
+        server.image = image
+        yield server
+
+
+def update(plugin, ports):
+    import flask
+    from .fakes.plugin import wait_idle
+
+    app = flask.Flask(__name__)
+    with app.test_request_context():
+        plugin.on_api_command("update_firmware", dict(ports=ports))
+    wait_idle(plugin)
+    with app.test_request_context():
+        return plugin.on_api_get(None).get_json()
+
+
+def test_all_boards_are_flashed(release, make_plugin):
+    with FakeBoard() as first, FakeBoard() as second, \
+            FakeBoard(page_delay=0.01) as third:
+        boards = [first, second, third]
+        plugin = make_plugin([board.port for board in boards],
+                             release_url=release.release_url,
+                             flash_engine="stk500v2",
+                             max_concurrent_flashes=2)
+        status = update(plugin, "all")
+
+    assert status['update']['state'] == "completed"
+    assert sorted(port['port'] for port in status['ports']) == sorted(
+        board.port for board in boards)
+    assert all(port['state'] == "completed" for port in status['ports'])
+    for board in boards:
+        assert board.flash[:len(release.image)] == release.image
+
+    # Every board reports on its own before the update as a whole
+    messages = plugin._plugin_manager.statuses("port")
+    assert sorted(data['port'] for _, data in messages) == sorted(
+        board.port for board in boards)
+    _, completed = plugin._plugin_manager.statuses("completed")[-1]
+    assert len(completed['ports']) == 3
+
+
+def test_selected_boards_are_flashed(release, make_plugin):
+    with FakeBoard() as first, FakeBoard() as second:
+        plugin = make_plugin([first.port, second.port],
+                             release_url=release.release_url,
+                             flash_engine="stk500v2")
+        status = update(plugin, [second.port])
+
+    assert [port['port'] for port in status['ports']] == [second.port]
+    assert second.pages_written and not first.pages_written
+
+
+def test_one_failing_board_fails_the_update(release, make_plugin):
+    with FakeBoard() as good, FakeBoard(corrupt=True) as bad:
+        plugin = make_plugin([good.port, bad.port],
+                             release_url=release.release_url,
+                             flash_engine="stk500v2", flash_retries=0)
+        status = update(plugin, "all")
+
+    states = dict((port['port'], port['state']) for port in status['ports'])
+    assert states == {good.port: "completed", bad.port: "error"}
+    assert status['update']['state'] == "error"
+    assert status['lastError']['message'].startswith(bad.port)
+
+
+@pytest.mark.parametrize("ports", [
+    "/dev/ttyFAKE0", ["/dev/ttyFAKE0", 1], [], {"port": "/dev/ttyFAKE0"},
+    ["/dev/ttyFAKE9"],
+])
+def test_invalid_port_selection_is_refused(make_plugin, ports):
+    import flask
+
+    plugin = make_plugin(["/dev/ttyFAKE0"])
+    with flask.Flask(__name__).test_request_context():
+        response = plugin.on_api_command("update_firmware",
+                                         dict(ports=ports))
+    assert response.status_code == 400
+    assert plugin._scheduler.as_dict() == dict(current=None, queued=[])
+    assert plugin._printer.calls == []
+
+
+def test_digest_verify_mode_is_migrated(make_plugin):
+    plugin = make_plugin(verify_mode="digest")
+    plugin.on_settings_migrate(plugin.get_settings_version(), None)
+    assert plugin._settings.get(["verify_mode"]) == "none"
+
+
+# Messages in the log of the last update of plugin
+def log_messages(plugin):
+    entries, _ = plugin._logs.tail(plugin._job_log.id)
+    return [entry['message'] for entry in entries]
+
+
+# A board that times out above 57600 baud is stepped down to it, and the
+# next update starts at the rate that worked
+def test_baud_rate_is_stepped_down_and_remembered(release, make_plugin,
+                                                  monkeypatch):
+    import json
+    import os
+    from octoprint_firmwareupdate import flasher
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    monkeypatch.setenv("FAKE_AVRDUDE_MAX_BAUD", "57600")
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=release.release_url,
+                         baudrate=250000, baudrate_fallbacks=[115200, 57600],
+                         flash_retries=2)
+
+    status = update(plugin, None)
+    assert status['update']['state'] == "completed"
+    assert plugin._jobs.jobs[0].baudrate == 57600
+    with open(os.path.join(plugin.get_plugin_data_folder(),
+                           "baudrates.json")) as f:
+        assert json.load(f) == {"2341:0042:FAKE0": 57600}
+    log = log_messages(plugin)
+    assert "Stepping down to 115200 baud" in log
+    assert "Stepping down to 57600 baud" in log
+
+    # Without retries left over, the next update only succeeds by starting
+    # at the remembered rate
+    plugin._settings.set(["flash_retries"], 0)
+    status = update(plugin, None)
+    assert status['update']['state'] == "completed"
+    assert plugin._jobs.jobs[0].baudrate == 57600
+    assert not [message for message in log_messages(plugin)
+                if message.startswith("Stepping down")]
+
+
+# Flashing an image that differs from the one on the board in a single
+# page only writes that page and says how much time it saved
+def test_differential_flash(tmpdir, make_plugin):
+    import flask
+    from octoprint_firmwareupdate.hexfile import PAGE_SIZE
+    from .fakes.plugin import call_route, wait_idle
+
+    def upload(image, name):
+        path = write_firmware(str(tmpdir.join(name)), image)
+        with flask.Flask(__name__).test_request_context(
+                method="POST", data={"file.path": path}):
+            assert call_route(plugin, "upload_file").status_code == 200
+        wait_idle(plugin)
+        _, completed = plugin._plugin_manager.statuses("completed")[-1]
+        return completed
+
+    first = make_image()
+    second = bytearray(first)
+    second[3 * PAGE_SIZE + 10] ^= 0xFF
+    with FakeBoard() as board:
+        plugin = make_plugin([board.port], flash_engine="stk500v2",
+                             differential_flash=True)
+        completed = upload(first, "first.hex")
+        assert "bytesWritten" not in completed
+        written = board.pages_written
+
+        completed = upload(second, "second.hex")
+        assert board.pages_written - written == 1
+        assert board.flash[:len(second)] == second
+    assert completed['bytesWritten'] == PAGE_SIZE
+    assert completed['timeSaved'] > 0
@@ -0,0 +1,74 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from octoprint_firmwareupdate.metrics import BUCKETS, FlashMetrics
+
+
+def metrics(tmpdir, **kwargs):
+    return FlashMetrics(str(tmpdir.join("metrics.json")), **kwargs)
+
+
+def samples(text):
+    return dict(line.rsplit(" ", 1) for line in text.splitlines()
+                if not line.startswith("#"))
+
+
+def test_prometheus_text(tmpdir):
+    flashes = metrics(tmpdir)
+    flashes.add("completed", dict(write=0.4, verify=3, total=4.2,
+                                  unknown=1, boot=None),
+                port="/dev/ttyACM0", size=1024, saved=512)
+    flashes.add("error", dict(write=30, total=31), port='/dev/"odd"',
+                reason="timeout", size=256)
+    text = flashes.prometheus()
+    assert text.endswith("\n")
+    values = samples(text)
+
+    assert values['firmwareupdate_updates_total{outcome="completed"}'] == "1"
+    assert values['firmwareupdate_updates_total{outcome="error"}'] == "1"
+    assert values['firmwareupdate_flashed_bytes_total'] == "1280"
+    assert values['firmwareupdate_download_saved_bytes_total'] == "512"
+    # Buckets count every value at or below their bound
+    write = dict((bound, values['firmwareupdate_stage_seconds_bucket'
+                                '{stage="write",le="%s"}' % bound])
+                 for bound in BUCKETS)
+    assert write[0.1] == "0" and write[0.5] == "1" and write[20] == "1"
+    assert write[30] == "2" and write[300] == "2"
+    assert values['firmwareupdate_stage_seconds_bucket'
+                  '{stage="write",le="+Inf"}'] == "2"
+    assert values['firmwareupdate_stage_seconds_sum{stage="write"}'] == \
+        "30.4"
+    assert values['firmwareupdate_stage_seconds_count{stage="boot"}'] == "0"
+    assert 'stage="unknown"' not in text
+    assert values['firmwareupdate_last_total_seconds'
+                  '{port="/dev/ttyACM0"}'] == "4.2"
+    assert values['firmwareupdate_last_total_seconds'
+                  '{port="/dev/\\"odd\\""}'] == "31"
+    # Every sample has a HELP and TYPE line for its metric
+    for name in ("updates_total", "flashed_bytes_total",
+                 "download_saved_bytes_total", "stage_seconds",
+                 "last_total_seconds"):
+        assert "# HELP firmwareupdate_%s " % name in text
+        assert "# TYPE firmwareupdate_%s " % name in text
+
+
+def test_oldest_records_are_dropped(tmpdir):
+    flashes = metrics(tmpdir, capacity=3)
+    for index in range(5):
+        flashes.add("completed", dict(total=index), port="/dev/ttyACM%d"
+                    % index)
+    ports = [record['port'] for record in flashes.records]
+    assert ports == ["/dev/ttyACM2", "/dev/ttyACM3", "/dev/ttyACM4"]
+    # The counters keep counting what the records no longer hold
+    assert flashes.outcomes == dict(completed=5)
+    assert flashes.histograms['total']['count'] == 5
+    assert [record['port'] for record in flashes.summary()['recent']] == \
+        ports[::-1]
+
+    # The buffer and counters are kept across restarts
+    restarted = metrics(tmpdir, capacity=3)
+    assert [record['port'] for record in restarted.records] == ports
+    assert restarted.outcomes == dict(completed=5)
+    restarted.add("error", dict(total=1))
+    assert len(restarted.records) == 3
+    assert restarted.records[0]['port'] == "/dev/ttyACM3"
@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import os
+import sys
+from time import time
+from subprocess import Popen, PIPE, STDOUT
+
+from octoprint_firmwareupdate.monitor import AvrdudeMonitor
+
+from .fakes import AVRDUDE, make_image, write_firmware
+
+
+def run_avrdude(tmpdir, env, args=(), verify=True):
+    firmware = write_firmware(str(tmpdir.join("firmware.hex")), make_image())
+    environment = dict(os.environ)
+    environment.update(env)
+    process = Popen([sys.executable, AVRDUDE, "-p", "m2560", "-c",
+                     "stk500v2", "-b", "250000", "-D"] + list(args) +
+                    ["-U", "flash:w:%s:i" % firmware],
+                    stdout=PIPE, stderr=STDOUT, env=environment)
+    results = []
+    build_log = io.BytesIO()
+    monitor = AvrdudeMonitor(
+        process, build_log,
+        on_result=lambda monitor: results.append((monitor.result, time())),
+        progress_interval=0, verify=verify)
+    monitor.run()
+    return monitor, results, build_log
+
+
+def read_stamps(path):
+    stamps = {}
+    with open(path) as f:
+        for line in f:
+            event, moment = line.split()
+            stamps[event] = float(moment)
+    return stamps
+
+
+def feed(*lines):
+    results = []
+    monitor = AvrdudeMonitor(None, on_result=results.append)
+    for line in lines:
+        monitor.feed_line(line)
+    return monitor, results
+
+
+def test_completion_is_reported_once_verified_and_done():
+    monitor, results = feed("avrdude: 100 bytes of flash written",
+                            "avrdude: 100 bytes of flash verified",
+                            "avrdude done.  Thank you.")
+    assert monitor.result == AvrdudeMonitor.COMPLETED
+    assert len(results) == 1
+
+
+def test_done_without_verification_is_not_a_success():
+    monitor, results = feed("avrdude: 100 bytes of flash written",
+                            "avrdude done.  Thank you.")
+    assert monitor.result is None
+
+
+def test_failure_rules():
+    for line, result in [
+            ("avrdude: usbdev_open(): No device matching following was "
+             "found", AvrdudeMonitor.ERROR),
+            ("avrdude: stk500v2_paged_write: write command FAILED",
+             AvrdudeMonitor.ERROR),
+            ("avrdude: stk500v2_ReceiveMessage(): timeout",
+             AvrdudeMonitor.TIMEOUT)]:
+        monitor, results = feed(line)
+        assert monitor.result == result
+
+
+def test_progress_redraws_are_coalesced_per_phase():
+    progress = []
+    monitor = AvrdudeMonitor(None, on_progress=lambda *args:
+                             progress.append(args), progress_interval=60)
+    for percent in (0, 10, 20, 100):
+        monitor.feed_progress("Writing | ## | %d%% 0.10s" % percent)
+    monitor.feed_line("Reading | ## | 100% 0.10s")
+    assert progress == [("writing", 0), ("writing", 100),
+                        ("verifying", 100)]
+
+
+def test_completion_latency_with_fake_avrdude(tmpdir):
+    stamps = str(tmpdir.join("stamps"))
+    # avrdude lingers after its last line; the outcome must not wait for it
+    monitor, results, build_log = run_avrdude(
+        tmpdir, {"FAKE_AVRDUDE_STAMP": stamps,
+                 "FAKE_AVRDUDE_EXIT_DELAY": "2"})
+    assert [result for result, _ in results] == [AvrdudeMonitor.COMPLETED]
+    delay = results[0][1] - read_stamps(stamps)["verified"]
+    assert 0 <= delay < 0.5
+    assert b"bytes of flash verified" in build_log.getvalue()
+    assert monitor.timings[AvrdudeMonitor.PHASE_WRITING] > 0
+
+
+def test_exit_without_deciding_line_is_reported_right_away(tmpdir):
+    start = time()
+    monitor, results, _ = run_avrdude(tmpdir, {"FAKE_AVRDUDE_MODE": "fail"})
+    assert [result for result, _ in results] == [AvrdudeMonitor.ERROR]
+    assert time() - start < 5
+
+
+def test_timeout_with_fake_avrdude(tmpdir):
+    monitor, results, _ = run_avrdude(tmpdir,
+                                      {"FAKE_AVRDUDE_MODE": "timeout"})
+    assert monitor.result == AvrdudeMonitor.TIMEOUT
+
+
+def test_without_verification(tmpdir):
+    monitor, results, _ = run_avrdude(tmpdir, {}, ["-V"], verify=False)
+    assert monitor.result == AvrdudeMonitor.COMPLETED
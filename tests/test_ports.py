@@ -0,0 +1,82 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+from collections import namedtuple
+
+from octoprint_firmwareupdate.ports import PortIndex
+
+# Port info of pyserial versions with USB attributes
+PortInfo = namedtuple("PortInfo", "device description hwid vid pid "
+                                  "serial_number")
+
+
+# Lister that counts its calls and lists whatever is in devices
+class Lister(object):
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return list(self.devices)
+
+
+def test_devices_are_only_listed_again_after_a_change(tmpdir):
+    watched = tmpdir.mkdir("dev")
+    lister = Lister([("/dev/ttyACM0", "Mega", "USB VID:PID=2341:0042")])
+    ports = PortIndex(lister=lister, watched=(str(watched),
+                                              str(tmpdir.join("missing"))))
+    os.utime(str(watched), (1, 1))
+    for _ in range(3):
+        assert [port.device for port in ports.ports()] == ["/dev/ttyACM0"]
+    assert lister.calls == 1
+
+    # A device plugged in changes the watched directory
+    lister.devices.append(("/dev/ttyACM1", "Mega", "USB VID:PID=2341:0042"))
+    os.utime(str(watched), (2, 2))
+    assert [port.device for port in ports.ports()] == ["/dev/ttyACM0",
+                                                      "/dev/ttyACM1"]
+    assert lister.calls == 2
+
+
+def test_devices_are_listed_every_time_without_watched_directories(tmpdir):
+    lister = Lister([])
+    ports = PortIndex(lister=lister, watched=(str(tmpdir.join("missing")),))
+    ports.ports()
+    ports.ports()
+    assert lister.calls == 2
+
+
+def test_usb_ids_from_the_hardware_id():
+    ports = PortIndex(lister=lambda: [
+        ("/dev/ttyUSB0", "CH340", "USB VID:PID=1a86:7523 LOCATION=1-1.2"),
+        ("/dev/ttyACM0", "Mega", "USB VID:PID=2341:0042 SNR=85439303 "
+                                 "LOCATION=1-1.3"),
+        ("/dev/ttyS0", "ttyS0", "n/a"),
+    ], watched=())
+    devices = ports.ports()
+    assert [port.device for port in devices] == ["/dev/ttyACM0",
+                                                 "/dev/ttyUSB0"]
+    mega, ch340 = devices
+    assert (mega.vid, mega.pid, mega.serial_number) == (0x2341, 0x0042,
+                                                        "85439303")
+    assert mega.board == "2341:0042:85439303"
+    assert ch340.serial_number is None and ch340.board == "1a86:7523:"
+    assert mega.known and ch340.known
+
+
+def test_usb_attributes_are_preferred():
+    ports = PortIndex(lister=lambda: [
+        PortInfo("/dev/ttyACM0", "Mega", "USB VID:PID=0000:0000", 0x2341,
+                 0x0042, "A1"),
+        PortInfo("/dev/ttyACM1", "Other", "n/a", 0x1234, 0x5678, None),
+    ], watched=())
+    mega, other = ports.ports()
+    assert mega.board == "2341:0042:A1"
+    assert not other.known
+    assert ports.board_at("/dev/ttyACM0") == "2341:0042:A1"
+    assert ports.device_of("2341:0042:A1") == "/dev/ttyACM0"
+    assert ports.board_at("/dev/ttyACM9") is None
+    assert ports.device_of("1234:5678:") == "/dev/ttyACM1"
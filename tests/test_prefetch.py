@@ -0,0 +1,151 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import hashlib
+from time import time
+
+import pytest
+
+from octoprint_firmwareupdate.cache import FirmwareCache
+from octoprint_firmwareupdate.prefetch import ReleasePrefetcher
+from octoprint_firmwareupdate.releases import ReleaseClient
+
+from .fakes import NoResetSerial, make_image, write_firmware
+from .fakes.server import ReleaseServer
+
+
+@pytest.fixture
+def server(tmpdir):
+    content = open(write_firmware(str(tmpdir.join("release.hex")),
+                                  make_image(16384)), "rb").read()
+    with ReleaseServer() as server:
+        server.publish("v2", content)
+        yield server
+
+
+def prefetcher(tmpdir, server, **kwargs):
+    cache = FirmwareCache(str(tmpdir.join("cache")), 1024 * 1024)
+    releases = ReleaseClient(str(tmpdir.join("release.json")),
+                             url=server.release_url)
+    return ReleasePrefetcher(releases, cache, **kwargs)
+
+
+def test_prefetched_release_waits_to_be_installed(tmpdir, server):
+    ready = []
+    prefetch = prefetcher(tmpdir, server,
+                          on_ready=lambda key, version: ready.append(version))
+    key, version = prefetch.check()
+    assert ready == ["v2"]
+    assert prefetch.cache.get_prefetched()['key'] == key
+
+    # Checking again doesn't download it again
+    prefetch.check()
+    assert ready == ["v2"]
+    assert server.count("/files/firmware.hex") == 1
+
+    prefetch.cache.clear_prefetched()
+    assert prefetch.cache.get_prefetched() is None
+    assert prefetch.cache.get_latest()['version'] == "v2"
+
+
+def test_installed_release_is_not_prefetched(tmpdir, server):
+    prefetch = prefetcher(tmpdir, server)
+    key, version = prefetch.check()
+    prefetch.cache.set_latest(key, version)
+    assert prefetch.cache.get_prefetched() is None
+
+
+def test_resumed_prefetch_is_throttled_on_new_bytes(tmpdir, server):
+    rate = 8 * 1024
+    prefetch = prefetcher(tmpdir, server, rate_limit=rate)
+    content = server.files["firmware.hex"]
+    asset = server.release['assets'][0]
+    # All but the last 4 KB arrived in an interrupted earlier check
+    part = "%s.%s.part" % (
+        os.path.join(prefetch.cache.directory, "prefetch.hex"),
+        hashlib.sha1(asset['browser_download_url'].encode(
+            "utf-8")).hexdigest()[:12])
+    with open(part, "wb") as f:
+        f.write(content[:-4096])
+
+    started = time()
+    prefetch.check()
+    elapsed = time() - started
+    assert prefetch.cache.get_prefetched() is not None
+    # The whole file would take len(content) / rate seconds
+    assert len(content) / float(rate) > 4
+    assert elapsed < 2
+
+
+def test_custom_firmware_is_not_replaced(tmpdir, server, make_plugin):
+    import flask
+    from octoprint.events import Events
+    from .fakes.plugin import call_route, wait_idle
+
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=server.release_url)
+    plugin._prefetcher.check()
+    assert plugin._prefetched_release()['version'] == "v2"
+
+    path = write_firmware(str(tmpdir.join("custom.hex")), make_image(seed=2))
+    with flask.Flask(__name__).test_request_context(
+            method="POST", data={"file.path": path}):
+        assert call_route(plugin, "upload_file").status_code == 200
+    assert plugin._prefetched_release() is None
+    wait_idle(plugin)
+
+    plugin.on_event(Events.PRINT_DONE, {})
+    assert plugin._scheduler.as_dict() == dict(current=None, queued=[])
+    assert server.count("/files/firmware.hex") == 1
+
+
+def test_no_prefetch_without_auto_update(tmpdir, server):
+    from time import sleep
+    from .fakes.server import RELEASE_PATH
+
+    enabled = []
+    prefetch = prefetcher(tmpdir, server, interval=0.05,
+                          enabled=lambda: bool(enabled))
+    prefetch.start()
+    try:
+        sleep(0.3)
+        assert server.count(RELEASE_PATH) == 0
+        enabled.append(True)
+        deadline = time() + 10
+        while prefetch.cache.get_prefetched() is None and time() < deadline:
+            sleep(0.05)
+        assert prefetch.cache.get_prefetched()['version'] == "v2"
+    finally:
+        prefetch.stop()
+
+
+def test_prefetched_release_is_only_offered_with_auto_update(server,
+                                                             make_plugin):
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=server.release_url)
+    plugin._prefetcher.check()
+    assert plugin._prefetched_release()['version'] == "v2"
+    plugin._settings.set(["auto_update"], False)
+    assert plugin._prefetched_release() is None
+    assert plugin._status_snapshot()['ready'] is None
+
+
+# A prefetched release that can't be taken from the cache is downloaded
+# instead of ending the update without a word
+def test_lost_prefetched_release_is_downloaded(server, make_plugin,
+                                               monkeypatch):
+    from octoprint_firmwareupdate import flasher
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_idle
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=server.release_url)
+    plugin._prefetcher.check()
+    monkeypatch.setattr(plugin._cache, "restore",
+                        lambda key, destination: None)
+
+    plugin._schedule(UpdateRequest(UpdateRequest.AUTO, onstartup=True))
+    wait_idle(plugin)
+    assert plugin._update.state == "completed"
+    assert plugin._plugin_manager.statuses("completed")
+    assert open(plugin.version_file).read() == "v2"
+    assert server.count("/files/firmware.hex") == 2
@@ -0,0 +1,135 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from octoprint_firmwareupdate.releases import ReleaseClient
+
+from .fakes import NoResetSerial, make_image, write_firmware
+from .fakes.server import RELEASE_PATH, ReleaseServer
+
+
+@pytest.fixture
+def server():
+    with ReleaseServer() as server:
+        server.publish("v1", b":00000001FF\n")
+        yield server
+
+
+def client(tmpdir, server, ttl=600):
+    return ReleaseClient(str(tmpdir.join("release.json")), ttl=ttl,
+                         url=server.release_url)
+
+
+def test_release_is_reused_within_ttl(tmpdir, server):
+    releases = client(tmpdir, server)
+    for _ in range(5):
+        assert releases.latest()['tag_name'] == "v1"
+    assert server.count(RELEASE_PATH) == 1
+
+
+def test_stored_release_survives_restarts(tmpdir, server):
+    client(tmpdir, server).latest()
+    # A bank of printers rebooting at once doesn't ask GitHub again
+    for _ in range(5):
+        assert client(tmpdir, server).latest()['tag_name'] == "v1"
+    assert server.count(RELEASE_PATH) == 1
+
+
+def test_expired_release_is_revalidated(tmpdir, server):
+    releases = client(tmpdir, server, ttl=0)
+    releases.latest()
+    assert releases.latest()['tag_name'] == "v1"
+    assert server.count(RELEASE_PATH) == 2
+    revalidation = server.requests[-1]
+    assert revalidation['headers'].get("If-None-Match") == server.etag
+
+    server.publish("v2", b":00000001FF\n")
+    assert releases.latest()['tag_name'] == "v2"
+
+
+def test_explicit_lookups_skip_the_ttl(tmpdir, server):
+    releases = client(tmpdir, server)
+    releases.latest()
+    releases.latest(use_cache=False)
+    assert server.count(RELEASE_PATH) == 2
+
+
+def test_one_lookup_per_update(tmpdir, server, make_plugin, monkeypatch):
+    from octoprint_firmwareupdate import flasher
+    # The fake avrdude doesn't need a board to talk to
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    image = make_image()
+    content = open(write_firmware(str(tmpdir.join("release.hex")), image),
+                   "rb").read()
+    server.publish("v2", content)
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=server.release_url,
+                         release_ttl=0)
+    plugin._check_directories()
+    with open(plugin.version_file, "w") as f:
+        f.write("v1")
+
+    plugin._start_update(onstartup=True)
+    plugin._update_firmware_init_thread.join()
+    plugin._update_firmware_thread.join()
+
+    assert plugin._update.state == "completed"
+    assert server.count(RELEASE_PATH) == 1
+    assert server.count("/files/firmware.hex") == 1
+    assert open(plugin.version_file).read() == "v2"
+    assert not os.path.exists(plugin.firmware_file)
+
+
+# GitHub answering too slowly for every attempt must not hold the startup
+# check for all attempts and backoffs; the cached release is used instead
+def test_startup_check_deadline(tmpdir, server, make_plugin, monkeypatch):
+    from time import time
+    from octoprint_firmwareupdate import flasher
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    server.release_delay = 5
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=server.release_url,
+                         startup_check_timeout=1, startup_check_attempts=3,
+                         startup_check_backoff=1, startup_check_deadline=2.5)
+    plugin._check_directories()
+    with open(plugin.version_file, "w") as f:
+        f.write("v1")
+    plugin._cache.put(write_firmware(str(tmpdir.join("cached.hex")),
+                                     make_image()), "release:1:v2")
+    plugin._cache.set_latest("release:1:v2", "v2")
+
+    started = time()
+    plugin._start_update(onstartup=True)
+    plugin._update_firmware_init_thread.join()
+    # Attempts of one second with a second and then two seconds between
+    # them would take five
+    assert time() - started < 4
+    assert server.count(RELEASE_PATH) == 2
+    plugin._update_firmware_thread.join()
+    assert plugin._update.state == "completed"
+    assert open(plugin.version_file).read() == "v2"
+
+
+# A lookup that returns after the update was cancelled must not record its
+# release as installed, or the next boot would skip it
+def test_cancel_during_lookup(tmpdir, server, make_plugin, monkeypatch):
+    from octoprint_firmwareupdate import flasher
+    from octoprint_firmwareupdate.scheduler import UpdateRequest
+    from .fakes.plugin import wait_for, wait_idle
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    content = open(write_firmware(str(tmpdir.join("release.hex")),
+                                  make_image()), "rb").read()
+    server.publish("v2", content)
+    server.release_delay = 1
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=server.release_url)
+
+    plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+    wait_for(lambda: server.count(RELEASE_PATH) == 1)
+    assert plugin._cancel_update()
+    plugin._update_firmware_init_thread.join()
+    wait_idle(plugin)
+
+    assert plugin._update.state == "cancelled"
+    assert not os.path.exists(plugin.version_file)
+    assert not plugin._plugin_manager.statuses("completed")
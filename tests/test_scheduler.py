@@ -0,0 +1,301 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from time import sleep
+
+import pytest
+
+from octoprint_firmwareupdate.scheduler import (QueueFull, UpdateRequest,
+                                                UpdateScheduler)
+
+from .fakes import make_image, write_firmware
+from .fakes.board import FakeBoard
+from .fakes.plugin import wait_for
+from .fakes.server import ReleaseServer
+
+
+# Execute function that records the requests it carries out and how many
+# ran at once. Requests wait for release to be set before they finish.
+class Recorder(object):
+
+    def __init__(self, duration=0):
+        self.duration = duration
+        self.release = threading.Event()
+        self.release.set()
+        self.executed = []
+        self.running = 0
+        self.most = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        with self._lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+            self.executed.append(request)
+        sleep(self.duration)
+        self.release.wait(10)
+        with self._lock:
+            self.running -= 1
+        request.outcome = "completed"
+
+    # Hold back the running request and wait until it has started
+    def hold(self, scheduler, request):
+        self.release.clear()
+        scheduler.submit(request)
+        wait_for(lambda: scheduler.current is request)
+
+
+def idle(scheduler):
+    wait_for(lambda: scheduler.as_dict() == dict(current=None, queued=[]))
+
+
+# Submit each request from a thread of its own, all at the same moment.
+# Returns what submit returned or raised for each of them.
+def submit_at_once(scheduler, requests):
+    start = threading.Event()
+    results = [None] * len(requests)
+
+    def submit(index):
+        start.wait()
+        try:
+            results[index] = scheduler.submit(requests[index])
+        except QueueFull as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=submit, args=(index,))
+               for index in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_run_one_at_a_time():
+    recorder = Recorder(duration=0.01)
+    scheduler = UpdateScheduler(recorder, max_queued=50)
+    requests = [UpdateRequest(UpdateRequest.MANUAL,
+                              ports=["/dev/ttyFAKE%d" % index])
+                for index in range(20)]
+
+    assert submit_at_once(scheduler, requests) == requests
+    idle(scheduler)
+    assert recorder.most == 1
+    assert sorted(recorder.executed, key=id) == sorted(requests, key=id)
+    assert all(request.state == UpdateRequest.DONE and
+               request.outcome == "completed" for request in requests)
+
+
+def test_duplicates_join_the_running_request():
+    recorder = Recorder()
+    scheduler = UpdateScheduler(recorder)
+    running = UpdateRequest(UpdateRequest.MANUAL, ports=["/dev/ttyFAKE0"])
+    recorder.hold(scheduler, running)
+
+    duplicates = [UpdateRequest(UpdateRequest.MANUAL,
+                                ports=["/dev/ttyFAKE0"])
+                  for _ in range(10)]
+    checks = [UpdateRequest(UpdateRequest.AUTO) for _ in range(5)]
+    results = submit_at_once(scheduler, duplicates + checks)
+    assert all(result is running for result in results)
+    assert running.coalesced == 15
+    assert scheduler.as_dict()['queued'] == []
+
+    recorder.release.set()
+    idle(scheduler)
+    assert recorder.executed == [running]
+
+
+def test_ports_in_any_order_are_duplicates():
+    recorder = Recorder()
+    scheduler = UpdateScheduler(recorder)
+    running = UpdateRequest(UpdateRequest.MANUAL, ports=["/dev/ttyFAKE9"])
+    recorder.hold(scheduler, running)
+
+    queued = scheduler.submit(UpdateRequest(
+        UpdateRequest.MANUAL, ports=["/dev/ttyFAKE0", "/dev/ttyFAKE1"]))
+    assert scheduler.submit(UpdateRequest(
+        UpdateRequest.MANUAL,
+        ports=["/dev/ttyFAKE1", "/dev/ttyFAKE0"])) is queued
+    assert queued.coalesced == 1
+    recorder.release.set()
+    idle(scheduler)
+
+
+def test_uploads_run_before_update_commands():
+    recorder = Recorder()
+    scheduler = UpdateScheduler(recorder)
+    running = UpdateRequest(UpdateRequest.AUTO)
+    recorder.hold(scheduler, running)
+
+    manual = UpdateRequest(UpdateRequest.MANUAL, ports="all")
+    first = UpdateRequest(UpdateRequest.UPLOAD, digest="first")
+    second = UpdateRequest(UpdateRequest.UPLOAD, digest="second")
+    for request in (manual, first, second):
+        scheduler.submit(request)
+    assert [queued['id'] for queued in scheduler.as_dict()['queued']] == [
+        first.id, second.id, manual.id]
+
+    recorder.release.set()
+    idle(scheduler)
+    assert recorder.executed == [running, first, second, manual]
+
+
+def test_queue_is_bounded_under_concurrent_requests():
+    recorder = Recorder()
+    scheduler = UpdateScheduler(recorder, max_queued=3)
+    running = UpdateRequest(UpdateRequest.MANUAL, ports="all")
+    recorder.hold(scheduler, running)
+
+    requests = [UpdateRequest(UpdateRequest.UPLOAD, digest=str(index))
+                for index in range(12)]
+    results = submit_at_once(scheduler, requests)
+    accepted = [result for result in results
+                if isinstance(result, UpdateRequest)]
+    assert len(accepted) == 3
+    assert all(isinstance(result, QueueFull) for result in results
+               if result not in accepted)
+
+    recorder.release.set()
+    idle(scheduler)
+    assert recorder.most == 1
+    assert recorder.executed[0] is running
+    assert sorted(recorder.executed[1:], key=id) == sorted(accepted, key=id)
+
+
+def test_clear_drops_waiting_requests_only():
+    recorder = Recorder()
+    scheduler = UpdateScheduler(recorder)
+    running = UpdateRequest(UpdateRequest.MANUAL, ports="all")
+    recorder.hold(scheduler, running)
+    waiting = scheduler.submit(UpdateRequest(UpdateRequest.UPLOAD,
+                                             digest="upload"))
+
+    assert scheduler.clear() == [waiting]
+    assert waiting.state == UpdateRequest.DROPPED
+    assert scheduler.get(waiting.id) is waiting
+    recorder.release.set()
+    idle(scheduler)
+    assert recorder.executed == [running]
+    assert running.state == UpdateRequest.DONE
+
+
+def test_failing_update_keeps_the_queue_going():
+    executed = []
+
+    def execute(request):
+        executed.append(request)
+        if len(executed) == 1:
+            raise RuntimeError("Flashing went wrong")
+
+    scheduler = UpdateScheduler(execute)
+    first = scheduler.submit(UpdateRequest(UpdateRequest.MANUAL, ports="all"))
+    wait_for(lambda: first.state == UpdateRequest.DONE)
+    second = scheduler.submit(UpdateRequest(UpdateRequest.MANUAL,
+                                            ports="all"))
+    assert second is not first
+    idle(scheduler)
+    assert executed == [first, second]
+
+
+@pytest.fixture
+def release(tmpdir):
+    image = make_image()
+    content = open(write_firmware(str(tmpdir.join("release.hex")), image),
+                   "rb").read()
+    with ReleaseServer() as server:
+        server.publish("v2", content)
+        yield server
+
+
+# Many clients pressing update at once, for the same and for different
+# boards, while the boards are flashed over pty fakes
+def test_concurrent_update_commands(release, make_plugin):
+    import flask
+    from .fakes.plugin import wait_idle
+
+    with FakeBoard(page_delay=0.002) as first, \
+            FakeBoard(page_delay=0.002) as second:
+        plugin = make_plugin([first.port, second.port],
+                             release_url=release.release_url,
+                             flash_engine="stk500v2", update_queue_size=1)
+        app = flask.Flask(__name__)
+        choices = ["all", [first.port], [second.port]]
+        start = threading.Event()
+        responses = []
+        lock = threading.Lock()
+
+        def press(ports):
+            start.wait()
+            with app.test_request_context():
+                response = plugin.on_api_command("update_firmware",
+                                                 dict(ports=ports))
+            with lock:
+                responses.append((response.status_code,
+                                  response.get_json()))
+
+        threads = [threading.Thread(target=press,
+                                    args=(choices[index % 3],))
+                   for index in range(15)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        wait_idle(plugin, timeout=60)
+
+    assert len(responses) == 15
+    assert all(status in (200, 409) for status, _ in responses)
+    # Three different updates can't all fit behind the running one
+    assert any(status == 409 for status, _ in responses)
+    jobs = [answer['job'] for status, answer in responses if status == 200]
+    requests = dict((job, plugin._scheduler.get(job)) for job in set(jobs))
+    assert sum(request.coalesced + 1
+               for request in requests.values()) == len(jobs)
+    assert all(request.state == UpdateRequest.DONE and
+               request.outcome == "completed"
+               for request in requests.values())
+
+    # The updates ran one after the other, each with the printer
+    # disconnected and reconnected around it
+    ordered = sorted(requests.values(), key=lambda request: request.started)
+    for earlier, later in zip(ordered, ordered[1:]):
+        assert earlier.finished <= later.started
+    calls = [name for name, _ in plugin._printer.calls]
+    assert calls == ["disconnect", "connect"] * len(requests)
+    assert plugin._scheduler.as_dict() == dict(current=None, queued=[])
+
+
+# An error the update workers don't expect must not leave the update
+# running, which would refuse every later one
+@pytest.mark.filterwarnings(
+    "ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_crashed_update_is_failed(release, make_plugin, monkeypatch):
+    import octoprint_firmwareupdate
+    from octoprint_firmwareupdate import flasher
+    from .fakes import NoResetSerial
+    from .fakes.plugin import wait_idle
+
+    def crash(path):
+        raise RuntimeError("Unexpected")
+
+    monkeypatch.setattr(flasher, "Serial", NoResetSerial)
+    plugin = make_plugin(["/dev/ttyFAKE0"], release_url=release.release_url)
+    parse_hex = octoprint_firmwareupdate.parse_hex
+    monkeypatch.setattr(octoprint_firmwareupdate, "parse_hex", crash)
+    crashed = plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+    wait_idle(plugin)
+    assert crashed.outcome == "error"
+    assert not plugin.isUpdating
+    assert [name for name, _ in plugin._printer.calls] == [
+        "disconnect", "connect"]
+    _, failed = plugin._plugin_manager.statuses("error")[-1]
+    assert failed['message'] == "Update failed unexpectedly."
+
+    monkeypatch.setattr(octoprint_firmwareupdate, "parse_hex", parse_hex)
+    request = plugin._schedule(UpdateRequest(UpdateRequest.MANUAL))
+    assert request is not crashed
+    wait_idle(plugin)
+    assert request.outcome == "completed"
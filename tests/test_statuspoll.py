@@ -0,0 +1,92 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import threading
+from time import time
+
+import tornado.testing
+import tornado.web
+
+from octoprint_firmwareupdate.status import StatusFeed
+from octoprint_firmwareupdate.statuspoll import StatusPollHandler
+
+
+class StatusPollTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.feed = StatusFeed()
+        self.validated = []
+        return tornado.web.Application([
+            (r"/status/wait", StatusPollHandler, dict(
+                feed=self.feed, snapshot=lambda: dict(status="snapshot"),
+                access_validation=self.validate))])
+
+    def validate(self, request):
+        self.validated.append(request.uri)
+        if request.headers.get("X-Api-Key") == "wrong":
+            raise tornado.web.HTTPError(403)
+
+    def poll(self, since, timeout, **kwargs):
+        response = self.fetch("/status/wait?since=%d&timeout=%s"
+                              % (since, timeout), **kwargs)
+        return response, (json.loads(response.body.decode("utf-8"))
+                          if response.code == 200 else None)
+
+    def test_returns_on_change(self):
+        since = self.feed.sequence
+        # Changes are published from the update's threads
+        publisher = threading.Timer(0.2, self.feed.publish,
+                                    args=(dict(status="inprogress"),))
+        publisher.start()
+        started = time()
+        response, answer = self.poll(since, 5)
+        publisher.join()
+        assert time() - started < 2
+        assert answer['snapshot'] == dict(status="snapshot")
+        assert [change['status'] for change in answer['changes']] == [
+            "inprogress"]
+        assert answer['changes'][0]['sequence'] == since + 1
+        assert response.headers["Cache-Control"] == "no-cache"
+
+    def test_times_out_without_change(self):
+        since = self.feed.sequence
+        started = time()
+        _, answer = self.poll(since, 0.5)
+        assert 0.5 <= time() - started < 3
+        assert answer['changes'] == []
+
+    def test_missed_changes_are_answered_at_once(self):
+        since = self.feed.sequence
+        self.feed.publish(dict(status="inprogress"))
+        self.feed.publish(dict(status="completed"))
+        started = time()
+        _, answer = self.poll(since, 5)
+        assert time() - started < 1
+        assert [change['status'] for change in answer['changes']] == [
+            "inprogress", "completed"]
+
+    def test_access_is_validated(self):
+        response, _ = self.poll(self.feed.sequence, 0,
+                                headers={"X-Api-Key": "wrong"})
+        assert response.code == 403
+        assert len(self.validated) == 1
+
+
+# The route is registered with the validator signature of OctoPrint 1.4 and
+# later, which takes the validator and its arguments after the app
+def test_route_validates_the_status_permission(make_plugin, monkeypatch):
+    from octoprint.access.permissions import Permissions
+    from octoprint.server.util import flask as util_flask
+    from octoprint.server.util import tornado as util_tornado
+
+    calls = []
+    monkeypatch.setattr(util_tornado, "access_validation_factory",
+                        lambda *args: calls.append(args) or "validator")
+    plugin = make_plugin()
+    [(route, handler, options)] = plugin.status_routes([])
+    assert route == r"/status/wait" and handler is StatusPollHandler
+    assert options['access_validation'] == "validator"
+    [(_, validator, permission)] = calls
+    assert validator is util_flask.permission_validator
+    assert permission == Permissions.STATUS
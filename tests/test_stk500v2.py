@@ -0,0 +1,126 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import os
+import shutil
+from time import time
+
+import pytest
+
+from octoprint_firmwareupdate.flasher import AvrdudeFlasher, Flasher
+from octoprint_firmwareupdate.hexfile import FirmwareImage, page_count
+from octoprint_firmwareupdate.stk500v2 import Stk500v2Flasher
+
+from .fakes import DIRECTORY, make_image, write_firmware
+from .fakes.board import FakeBoard
+
+
+@pytest.fixture
+def board():
+    with FakeBoard() as board:
+        yield board
+
+
+def full_image(size=8192, seed=1):
+    data = make_image(size, seed)
+    return FirmwareImage(data, list(range(page_count(data))))
+
+
+def flash(board, image, **options):
+    progress = []
+    results = []
+    log = io.BytesIO()
+    options.setdefault("timeout", 0.5)
+    flasher = Stk500v2Flasher(
+        on_result=lambda flasher: results.append(flasher.result),
+        on_progress=lambda *args: progress.append(args),
+        progress_interval=0, **options)
+    flasher.flash(board.port, None, log, image)
+    return flasher, results, progress, log.getvalue()
+
+
+def test_flash_and_verify(board):
+    image = full_image()
+    flasher, results, progress, log = flash(board, image)
+    assert results == [Flasher.COMPLETED]
+    assert board.flash[:image.size] == image.data
+    assert board.pages_read == len(image.pages)
+    assert set(flasher.timings) == set(["reset", "write", "verify"])
+    assert progress[0] == (Flasher.PHASE_WRITING, 0)
+    assert progress[-1] == (Flasher.PHASE_VERIFYING, 100)
+    assert b"bytes of flash verified" in log
+    # The board starts the firmware after the bootloader is left
+    assert not board.bootloader
+
+
+def test_only_given_pages_are_written(board):
+    data = make_image(8192)
+    image = FirmwareImage(data, [2, 5])
+    flasher, results, _, _ = flash(board, image, verify=False)
+    assert results == [Flasher.COMPLETED]
+    assert board.pages_written == 2
+    assert board.pages_read == 0
+    assert board.flash[512:768] == data[512:768]
+    assert board.flash[:512] == bytearray(b"\xff") * 512
+
+
+def test_verification_error():
+    with FakeBoard(corrupt=True) as board:
+        flasher, results, _, log = flash(board, full_image())
+    assert results == [Flasher.ERROR]
+    assert "Verification error" in flasher.message
+    assert b"FAILED" in log
+
+
+def test_board_that_does_not_answer_times_out():
+    with FakeBoard(silent=True) as board:
+        start = time()
+        flasher, results, _, _ = flash(board, full_image(),
+                                       sync_attempts=2, timeout=0.2)
+    assert results == [Flasher.TIMEOUT]
+    assert time() - start < 2
+
+
+def test_board_that_stops_answering_times_out():
+    with FakeBoard(stall_after=3) as board:
+        flasher, results, _, _ = flash(board, full_image(), timeout=0.2)
+    assert results == [Flasher.TIMEOUT]
+
+
+def test_avrdude_engine_on_a_port_without_modem_lines(board, tmpdir,
+                                                     monkeypatch):
+    monkeypatch.setenv("PATH", DIRECTORY + os.pathsep + os.environ["PATH"])
+    image = full_image()
+    firmware = write_firmware(str(tmpdir.join("firmware.hex")), image.data)
+    flasher = AvrdudeFlasher(str(tmpdir), progress_interval=0)
+    assert flasher.flash(board.port, firmware, io.BytesIO()) == \
+        Flasher.COMPLETED
+
+
+# Both engines flash the same image to a simulated board. The avrdude
+# engine needs a real avrdude, which drives the fake bootloader over the
+# pty just like a board.
+@pytest.mark.skipif(shutil.which("avrdude") is None,
+                    reason="avrdude is not installed")
+def test_engine_timings_compared_with_avrdude(tmpdir, record_property):
+    image = full_image(64 * 1024)
+    firmware = write_firmware(str(tmpdir.join("firmware.hex")), image.data)
+    seconds = {}
+    for name in ("avrdude", "stk500v2"):
+        results = []
+        options = dict(on_result=lambda flasher: results.append(
+            flasher.result), progress_interval=0)
+        if name == "avrdude":
+            flasher = AvrdudeFlasher(str(tmpdir), **options)
+        else:
+            flasher = Stk500v2Flasher(**options)
+        with FakeBoard() as board:
+            start = time()
+            flasher.flash(board.port, firmware, io.BytesIO(), image)
+            seconds[name] = time() - start
+            assert results == [Flasher.COMPLETED]
+            assert board.flash[:image.size] == image.data
+        record_property(name + "_seconds", round(seconds[name], 3))
+        record_property(name + "_timings", flasher.timings)
+    assert seconds["stk500v2"] <= seconds["avrdude"] * 1.5
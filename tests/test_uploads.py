@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import pytest
+
+from octoprint_firmwareupdate.uploads import ChunkedUploads, UploadError
+
+from .fakes import make_image, write_firmware
+from .fakes.board import FakeBoard
+
+
+def chunk(tmpdir, data):
+    path = tmpdir.join("chunk")
+    path.write_binary(data)
+    return str(path)
+
+
+def test_chunks_are_appended_at_the_current_offset(tmpdir):
+    uploads = ChunkedUploads(str(tmpdir.join("uploads")))
+    assert uploads.append("a", 0, chunk(tmpdir, b"1234")) == 4
+    # A chunk sent again after a lost answer is not appended twice
+    assert uploads.append("a", 0, chunk(tmpdir, b"1234")) == 4
+    assert uploads.append("a", 4, chunk(tmpdir, b"5678")) == 8
+    assert uploads.offset("a") == 8
+
+    destination = str(tmpdir.join("firmware.hex"))
+    uploads.finish("a", destination)
+    assert open(destination, "rb").read() == b"12345678"
+
+
+def test_digest_mismatch_discards_the_upload(tmpdir):
+    uploads = ChunkedUploads(str(tmpdir.join("uploads")))
+    uploads.append("a", 0, chunk(tmpdir, b"1234"))
+    with pytest.raises(UploadError):
+        uploads.finish("a", str(tmpdir.join("firmware.hex")), "00" * 32)
+    assert uploads.offset("a") == 0
+
+
+def test_completed_uploads_are_remembered(tmpdir):
+    uploads = ChunkedUploads(str(tmpdir.join("uploads")), max_age=60)
+    assert uploads.completed("a") is None
+    uploads.complete("a", 8, "job")
+    assert uploads.completed("a") == dict(offset=8, job="job")
+
+    uploads = ChunkedUploads(str(tmpdir.join("uploads")), max_age=0)
+    uploads.complete("a", 8, "job")
+    assert uploads.completed("a") is None
+
+
+def test_invalid_upload_id(tmpdir):
+    uploads = ChunkedUploads(str(tmpdir.join("uploads")))
+    with pytest.raises(UploadError):
+        uploads.append("../a", 0, chunk(tmpdir, b"1234"))
+
+
+def test_lost_answer_to_the_last_chunk(tmpdir, make_plugin):
+    import flask
+    from .fakes.plugin import call_route, wait_idle
+
+    image = make_image()
+    content = open(write_firmware(str(tmpdir.join("upload.hex")), image),
+                   "rb").read()
+    app = flask.Flask(__name__)
+
+    def post(offset, data):
+        values = {"upload_id": "lost", "offset": str(offset),
+                  "total": str(len(content)),
+                  "chunk.path": chunk(tmpdir, data)}
+        with app.test_request_context(method="POST", data=values):
+            return call_route(plugin, "upload_chunk").get_json()
+
+    with FakeBoard() as board:
+        plugin = make_plugin([board.port], flash_engine="stk500v2")
+        half = len(content) // 2
+        assert post(0, content[:half]) == dict(offset=half, complete=False)
+        answer = post(half, content[half:])
+        assert answer['complete']
+
+        # The client never saw the answer and asks where to resume
+        with app.test_request_context():
+            resumed = call_route(plugin, "upload_chunk_offset",
+                                 "lost").get_json()
+        assert resumed == dict(offset=len(content), complete=True,
+                               job=answer['job'])
+        assert post(half, content[half:]) == resumed
+
+        wait_idle(plugin)
+        assert plugin._scheduler.get(answer['job']).outcome == "completed"
+        assert len(plugin._plugin_manager.statuses("completed")) == 1
+        assert board.flash[:len(image)] == image
+
+
+# A file that isn't text is refused like any other invalid firmware and
+# leaves no pending file behind
+def test_binary_upload_is_refused(tmpdir, make_plugin):
+    import os
+    import flask
+    from .fakes.plugin import call_route
+
+    plugin = make_plugin(["/dev/ttyFAKE0"])
+    content = b":10000000" + bytes(bytearray(range(128, 256)))
+    values = {"upload_id": "binary", "offset": "0",
+              "total": str(len(content)),
+              "chunk.path": chunk(tmpdir, content)}
+    with flask.Flask(__name__).test_request_context(method="POST",
+                                                    data=values):
+        response = call_route(plugin, "upload_chunk")
+    assert response.status_code == 400
+    assert b"Invalid firmware file" in response.get_data()
+    pending = os.path.join(plugin.get_plugin_data_folder(), "pending")
+    assert os.listdir(pending) == []
+    assert plugin._scheduler.as_dict() == dict(current=None, queued=[])
+    assert not plugin.isUpdating
+
+
+@pytest.mark.parametrize("total", [0, 100 * 1024 * 1024 + 1])
+def test_upload_size_is_capped(tmpdir, make_plugin, total):
+    import os
+    import flask
+    from .fakes.plugin import call_route
+
+    plugin = make_plugin(["/dev/ttyFAKE0"])
+    values = {"upload_id": "huge", "offset": "0", "total": str(total),
+              "chunk.path": chunk(tmpdir, b":00000001FF\n")}
+    with flask.Flask(__name__).test_request_context(method="POST",
+                                                    data=values):
+        assert call_route(plugin, "upload_chunk").status_code == 400
+    # Nothing was written for the upload
+    uploads = os.path.join(plugin.get_plugin_data_folder(), "uploads")
+    assert not os.path.isdir(uploads) or os.listdir(uploads) == []